@@ -1,10 +1,29 @@
+import re
+
 from celery import shared_task
 
 from aasemble.django.apps.buildsvc import models as buildsvc_models
 from aasemble.django.apps.buildsvc import tasks as buildsvc_tasks
 
 
+# All zeroes in "after" means the branch was deleted
+DELETED_SHA = '0' * 40
+
+SHA_RE = re.compile(r'^[0-9a-f]{40}\Z')
+
+
 @shared_task(ignore_result=True)
-def github_push_event(url):
-    for ps in buildsvc_models.PackageSource.objects.filter(git_url=url):
-        buildsvc_tasks.poll_one.delay(ps.id)
+def github_push_event(url, ref=None, after=None):
+    if ref is None or after is None or not SHA_RE.match(after):
+        # No (usable) details about the push, so poll every source using
+        # the repository
+        for ps in buildsvc_models.PackageSource.objects.filter(git_url=url):
+            buildsvc_tasks.poll_one.delay(ps.id)
+        return
+
+    if not ref.startswith('refs/heads/') or after == DELETED_SHA:
+        return
+
+    branch = ref[len('refs/heads/'):]
+    for ps in buildsvc_models.PackageSource.objects.filter(git_url=url, branch=branch).exclude(disabled=True):
+        ps.record_push(after)
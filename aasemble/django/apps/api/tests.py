@@ -1,3 +1,5 @@
+import hashlib
+import hmac
 import json
 import os.path
 import shutil
@@ -14,9 +16,11 @@ import mock
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 
+from six import BytesIO
 from six.moves.urllib.parse import urlparse
 
-from aasemble.django.apps.buildsvc.models import PackageSource, Repository
+from aasemble.django.apps.buildsvc import logarchive
+from aasemble.django.apps.buildsvc.models import Build, PackageSource, Repository
 from aasemble.django.apps.mirrorsvc.models import Mirror, Snapshot
 
 
@@ -1328,27 +1332,114 @@ class APIv3Tests(APIv2Tests):
     repository_has_build_sources_list = True
     repository_has_series_name = True
 
-    def test_build_log_serves_temporary_log_when_not_finished(self):
+    def get_temporary_log(self, log_contents, query='', **extra):
         authenticate(self.client, 'eric')
         tmpdir = tempfile.mkdtemp()
         try:
-            with open(os.path.join(tmpdir, 'f5575921-c9a1-4cc8-a235-5b1756ca59ef'), 'wb') as fp:
-                fp.write(b'Our lovely, fake log\n')
+            if log_contents is not None:
+                with open(os.path.join(tmpdir, 'f5575921-c9a1-4cc8-a235-5b1756ca59ef'), 'wb') as fp:
+                    fp.write(log_contents)
             with override_settings(AASEMBLE_BUILDSVC_BUILDLOG_TMPDIR=tmpdir):
-                response = self.client.get('%s%s/log/' % (self.build_list_url, 'f5575921-c9a1-4cc8-a235-5b1756ca59ef'))
-                self.assertEquals(response.content, b'Our lovely, fake log\n')
+                response = self.client.get('%s%s/log/%s' % (self.build_list_url, 'f5575921-c9a1-4cc8-a235-5b1756ca59ef', query), **extra)
+                content = b''.join(response.streaming_content) if response.streaming else response.content
+                return response, content
         finally:
             shutil.rmtree(tmpdir)
 
+    def test_build_log_serves_temporary_log_when_not_finished(self):
+        response, content = self.get_temporary_log(b'Our lovely, fake log\n')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(content, b'Our lovely, fake log\n')
+        self.assertEquals(response['X-Log-Size'], '21')
+
+    def test_build_log_temporary_log_missing(self):
+        response, content = self.get_temporary_log(None)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(content, b'')
+
+    def test_build_log_temporary_log_offset(self):
+        response, content = self.get_temporary_log(b'Our lovely, fake log\n', query='?offset=11')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(content, b'fake log\n')
+        self.assertEquals(response['X-Log-Size'], '21')
+
+    def test_build_log_temporary_log_invalid_offset(self):
+        response, content = self.get_temporary_log(b'Our lovely, fake log\n', query='?offset=foo')
+        self.assertEquals(response.status_code, 400)
+
+    def test_build_log_temporary_log_range(self):
+        response, content = self.get_temporary_log(b'Our lovely, fake log\n', HTTP_RANGE='bytes=4-9')
+        self.assertEquals(response.status_code, 206)
+        self.assertEquals(content, b'lovely')
+        self.assertEquals(response['Content-Range'], 'bytes 4-9/*')
+
+        response, content = self.get_temporary_log(b'Our lovely, fake log\n', HTTP_RANGE='bytes=11-')
+        self.assertEquals(response.status_code, 206)
+        self.assertEquals(content, b'fake log\n')
+        self.assertEquals(response['Content-Range'], 'bytes 11-20/*')
+
+    def test_build_log_temporary_log_range_past_end(self):
+        response, content = self.get_temporary_log(b'Our lovely, fake log\n', HTTP_RANGE='bytes=21-')
+        self.assertEquals(response.status_code, 416)
+        self.assertEquals(response['Content-Range'], 'bytes */21')
+
+    def test_build_log_temporary_log_range_backwards(self):
+        # Invalid, so ignored
+        response, content = self.get_temporary_log(b'Our lovely, fake log\n', HTTP_RANGE='bytes=10-5')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(content, b'Our lovely, fake log\n')
+        self.assertFalse(response.has_header('Content-Range'))
+
     @mock.patch('aasemble.django.apps.api.v1.views.requests')
     def test_build_log_proxies_request_to_handler_node_when_not_finished_and_not_owning_it(self, requests):
         authenticate(self.client, 'eric')
         urlpath = '%s%s/log/' % (self.build_list_url, 'f331c241-7fd6-45ce-8ffb-fcee2b9bbbfc')
-        requests.get.return_value.content = b'Oh, yeah'
+        requests.get.return_value.iter_content.return_value = iter([b'Oh, ', b'yeah'])
+        requests.get.return_value.status_code = 206
+        requests.get.return_value.headers = {'Content-Range': 'bytes 4-11/*', 'X-Log-Size': '12',
+                                             'Content-Encoding': 'gzip', 'Content-Length': '5'}
+
+        response = self.client.get(urlpath + '?offset=4', HTTP_RANGE='bytes=4-')
+        requests.get.assert_called_with('http://someothernode.foo.bar.example.com%s?offset=4' % (urlpath,),
+                                        headers={'Range': 'bytes=4-'}, stream=True)
+        self.assertEquals(response.status_code, 206)
+        self.assertEquals(b''.join(response.streaming_content), b'Oh, yeah')
+        self.assertEquals(response['Content-Range'], 'bytes 4-11/*')
+        self.assertEquals(response['X-Log-Size'], '12')
+        # requests has decoded it, so the length would be wrong
+        self.assertFalse(response.has_header('Content-Length'))
+        requests.get.return_value.close.assert_called_with()
+
+    def test_build_log_serves_archived_log_when_finished(self):
+        authenticate(self.client, 'eric')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with override_settings(BUILDSVC_REPOS_BASE_PUBLIC_DIR=tmpdir):
+                build = Build.objects.get(uuid='1dcc86aa-c925-49b0-9f1e-ffe6839150b7')
+                logarchive.write_archive(BytesIO(b'one\ntwo\nthree\n'), build.archived_log_path())
+                url = '%s%s/log/' % (self.build_list_url, '1dcc86aa-c925-49b0-9f1e-ffe6839150b7')
 
-        response = self.client.get(urlpath)
-        requests.get.assert_called_with('http://someothernode.foo.bar.example.com%s' % (urlpath,))
-        self.assertEquals(response.content, b'Oh, yeah')
+                response = self.client.get(url)
+                self.assertEquals(b''.join(response.streaming_content), b'one\ntwo\nthree\n')
+
+                response = self.client.get(url + '?lines=2')
+                self.assertEquals(response.content, b'two\nthree\n')
+
+                response = self.client.get(url, HTTP_RANGE='bytes=4-6')
+                self.assertEquals(response.status_code, 206)
+                self.assertEquals(b''.join(response.streaming_content), b'two')
+                self.assertEquals(response['Content-Range'], 'bytes 4-6/14')
+
+                response = self.client.get(url, HTTP_RANGE='bytes=14-')
+                self.assertEquals(response.status_code, 416)
+                self.assertEquals(response['Content-Range'], 'bytes */14')
+                self.assertEquals(response['X-Log-Size'], '14')
+
+                response = self.client.get(url, HTTP_RANGE='bytes=6-4')
+                self.assertEquals(response.status_code, 200)
+                self.assertEquals(b''.join(response.streaming_content), b'one\ntwo\nthree\n')
+        finally:
+            shutil.rmtree(tmpdir)
 
     def test_build_log_redirects_when_finished(self):
         authenticate(self.client, 'eric')
@@ -1385,18 +1476,88 @@ class APIDevelTests(APIv3Tests):
 class GithubHookViewTestCase(APITestCase):
     fixtures = ['complete.json']
 
+    def post_hook(self, signature=None):
+        with open(os.path.join(os.path.dirname(__file__), 'example-hook.json'), 'rb') as fp:
+            body = fp.read()
+        if signature is None:
+            signature = 'sha1=' + hmac.new(b's3cret', body, hashlib.sha1).hexdigest()
+        return self.client.post('/api/events/github/',
+                                data=body,
+                                content_type='application/json',
+                                HTTP_X_GITHUB_EVENT='push',
+                                HTTP_X_HUB_SIGNATURE=signature)
+
+    @override_settings(GITHUB_WEBHOOK_SECRET='s3cret')
     @mock.patch('aasemble.django.apps.api.tasks.github_push_event')
     def test_hook(self, github_push_event):
-        with open(os.path.join(os.path.dirname(__file__), 'example-hook.json'), 'r') as fp:
-            res = self.client.post('/api/events/github/',
-                                   data=fp.read(),
-                                   content_type='application/json',
-                                   HTTP_X_GITHUB_EVENT='push')
+        res = self.post_hook()
+        self.assertEquals(res.data, {'ok': 'thanks'})
+        github_push_event.delay.assert_called_with("https://github.com/baxterthehacker/public-repo",
+                                                   "refs/heads/changes",
+                                                   "0d1a26e67d8f5eaf1f6ba5c57fc3c7d91ac0fd1c")
+
+    @override_settings(GITHUB_WEBHOOK_SECRET='s3cret')
+    @mock.patch('aasemble.django.apps.api.tasks.github_push_event')
+    def test_hook_bad_signature_polls(self, github_push_event):
+        res = self.post_hook(signature='sha1=' + '0' * 40)
         self.assertEquals(res.data, {'ok': 'thanks'})
-        github_push_event.delay.assert_called_with("https://github.com/baxterthehacker/public-repo")
+        github_push_event.delay.assert_called_once_with("https://github.com/baxterthehacker/public-repo")
+
+    @mock.patch('aasemble.django.apps.api.tasks.github_push_event')
+    def test_hook_without_secret_polls(self, github_push_event):
+        res = self.post_hook()
+        self.assertEquals(res.data, {'ok': 'thanks'})
+        github_push_event.delay.assert_called_once_with("https://github.com/baxterthehacker/public-repo")
 
     @mock.patch('aasemble.django.apps.buildsvc.tasks.poll_one')
     def test_github_push_event(self, poll_one):
         from .tasks import github_push_event
         github_push_event("https://github.com/eric/project0")
         poll_one.delay.assert_called_with(1)
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.build')
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.poll_one')
+    def test_github_push_event_uses_pushed_revision(self, poll_one, build):
+        from .tasks import github_push_event
+        github_push_event("https://github.com/eric/project0", "refs/heads/master",
+                          "0d1a26e67d8f5eaf1f6ba5c57fc3c7d91ac0fd1c")
+        self.assertFalse(poll_one.delay.called)
+        build.delay.assert_called_once_with(1)
+        self.assertEquals(PackageSource.objects.get(id=1).last_seen_revision,
+                          "0d1a26e67d8f5eaf1f6ba5c57fc3c7d91ac0fd1c")
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.build')
+    def test_github_push_event_same_revision(self, build):
+        from .tasks import github_push_event
+        PackageSource.objects.filter(id=1).update(last_seen_revision="0d1a26e67d8f5eaf1f6ba5c57fc3c7d91ac0fd1c")
+        github_push_event("https://github.com/eric/project0", "refs/heads/master",
+                          "0d1a26e67d8f5eaf1f6ba5c57fc3c7d91ac0fd1c")
+        self.assertFalse(build.delay.called)
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.build')
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.poll_one')
+    def test_github_push_event_invalid_revision_polls(self, poll_one, build):
+        from .tasks import github_push_event
+        github_push_event("https://github.com/eric/project0", "refs/heads/master",
+                          "--upload-pack=touch /tmp/pwned")
+        poll_one.delay.assert_called_with(1)
+        self.assertFalse(build.delay.called)
+        self.assertEquals(PackageSource.objects.get(id=1).last_seen_revision,
+                          "cdf46dc0-a49c-11e5-b00a-c712eaff3d7b")
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.build')
+    def test_github_push_event_other_branch(self, build):
+        from .tasks import github_push_event
+        github_push_event("https://github.com/eric/project0", "refs/heads/stable",
+                          "0d1a26e67d8f5eaf1f6ba5c57fc3c7d91ac0fd1c")
+        github_push_event("https://github.com/eric/project0", "refs/tags/master",
+                          "0d1a26e67d8f5eaf1f6ba5c57fc3c7d91ac0fd1c")
+        self.assertFalse(build.delay.called)
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.build')
+    def test_github_push_event_branch_deleted(self, build):
+        from .tasks import github_push_event
+        github_push_event("https://github.com/eric/project0", "refs/heads/master", "0" * 40)
+        self.assertFalse(build.delay.called)
+        self.assertEquals(PackageSource.objects.get(id=1).last_seen_revision,
+                          "cdf46dc0-a49c-11e5-b00a-c712eaff3d7b")
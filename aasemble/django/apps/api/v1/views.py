@@ -1,3 +1,5 @@
+import os
+import re
 import socket
 
 from allauth.socialaccount.providers.github.views import GitHubOAuth2Adapter
@@ -6,7 +8,7 @@ from allauth.socialaccount.providers.oauth2.client import OAuth2Client
 from django.conf import settings
 from django.conf.urls import include, url
 import django.db.utils
-from django.http import HttpResponse, HttpResponsePermanentRedirect
+from django.http import HttpResponse, HttpResponsePermanentRedirect, StreamingHttpResponse
 
 import requests
 
@@ -62,6 +64,148 @@ class DjangoObjectPermissionsOrAnonReadOnly(DjangoObjectPermissions):
     authenticated_users_only = False
 
 
+LOG_CHUNK_SIZE = 64 * 1024
+LOG_RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+# Not Content-Length: requests decodes any Content-Encoding, so the
+# length of what we pass on may differ from what the other node sent.
+PROXIED_LOG_HEADERS = ('Accept-Ranges', 'Content-Range', 'X-Log-Size')
+
+
+def requested_log_range(request):
+    """Works out which part of a build log the client wants, either from a
+    "Range: bytes=start-[end]" header or an offset query parameter.
+
+    Returns (start, end, partial). end is None if the client wants
+    everything up to the current end of the log. partial tells whether
+    the answer should be a 206 Partial Content response. As per RFC 7233,
+    a syntactically invalid Range header (e.g. one ending before it
+    starts) is ignored."""
+    match = LOG_RANGE_RE.match(request.META.get('HTTP_RANGE', ''))
+    if match:
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else None
+        if end is None or end >= start:
+            return start, end, True
+
+    try:
+        offset = int(request.GET.get('offset', 0))
+    except ValueError:
+        raise ValidationError({'offset': 'Must be an integer.'})
+    return max(offset, 0), None, False
+
+
+def log_range_not_satisfiable_response(size):
+    resp = HttpResponse('', 'text/plain', status=416)
+    resp['Content-Range'] = 'bytes */%d' % (size,)
+    resp['X-Log-Size'] = str(size)
+    resp.rendered_content = ''
+    return resp
+
+
+def _log_chunks(fp, length):
+    try:
+        while length > 0:
+            data = fp.read(min(LOG_CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fp.close()
+
+
+def serve_log_file(request, path):
+    """Streams (the requested part of) the log at path. The log may well
+    still be growing, so X-Log-Size tells the client where it ended when
+    the request was made, i.e. where to pick up next time."""
+    start, end, partial = requested_log_range(request)
+    try:
+        fp = open(path, 'rb')
+        size = os.fstat(fp.fileno()).st_size
+    except IOError:
+        fp = None
+        size = 0
+
+    if partial and start >= size:
+        if fp is not None:
+            fp.close()
+        return log_range_not_satisfiable_response(size)
+
+    if fp is None:
+        resp = HttpResponse('', 'text/plain')
+        resp['X-Log-Size'] = '0'
+        resp.rendered_content = ''
+        return resp
+
+    last = size - 1 if end is None else min(end, size - 1)
+    length = max(last - start + 1, 0)
+    fp.seek(start)
+
+    resp = StreamingHttpResponse(_log_chunks(fp, length), content_type='text/plain', status=partial and 206 or 200)
+    resp['Content-Length'] = str(length)
+    resp['Accept-Ranges'] = 'bytes'
+    resp['X-Log-Size'] = str(size)
+    if partial:
+        # The log is still being written to, so its final length is unknown
+        resp['Content-Range'] = 'bytes %d-%d/*' % (start, last)
+    resp.rendered_content = ''
+    return resp
+
+
+def serve_log_archive(request, archive):
+    """Serves (the requested part of) an archived build log, decompressing
+    only the blocks involved. On top of what serve_log_file() handles, a
+    lines query parameter asks for just the last that many lines."""
+    if 'lines' in request.GET:
+        try:
+            lines = int(request.GET['lines'])
+        except ValueError:
+            raise ValidationError({'lines': 'Must be an integer.'})
+        resp = HttpResponse(archive.tail(lines), 'text/plain')
+        resp['X-Log-Size'] = str(archive.size)
+        resp.rendered_content = ''
+        return resp
+
+    start, end, partial = requested_log_range(request)
+    if partial and start >= archive.size:
+        return log_range_not_satisfiable_response(archive.size)
+
+    stop = archive.size if end is None else min(end + 1, archive.size)
+    resp = StreamingHttpResponse(archive.read(start, stop), content_type='text/plain', status=partial and 206 or 200)
+    resp['Content-Length'] = str(max(stop - start, 0))
+    resp['Accept-Ranges'] = 'bytes'
+    resp['X-Log-Size'] = str(archive.size)
+    if partial:
+        resp['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, archive.size)
+    resp.rendered_content = ''
+    return resp
+
+
+def _proxied_chunks(downstream_resp):
+    try:
+        for chunk in downstream_resp.iter_content(LOG_CHUNK_SIZE):
+            yield chunk
+    finally:
+        downstream_resp.close()
+
+
+def proxy_log(request, url):
+    """Streams the log at url (on another node) through to the client
+    without buffering it, passing any Range header along."""
+    headers = {}
+    if 'HTTP_RANGE' in request.META:
+        headers['Range'] = request.META['HTTP_RANGE']
+    downstream_resp = requests.get(url, headers=headers, stream=True)
+
+    resp = StreamingHttpResponse(_proxied_chunks(downstream_resp), content_type='text/plain',
+                                 status=downstream_resp.status_code)
+    for header in PROXIED_LOG_HEADERS:
+        if header in downstream_resp.headers:
+            resp[header] = downstream_resp.headers[header]
+    resp.rendered_content = ''
+    return resp
+
+
 class aaSembleV1Views(object):
     view_prefix = 'v1'
     default_lookup_field = 'pk'
@@ -306,18 +450,13 @@ class aaSembleV1Views(object):
                     b = self.get_object()
                     if b.state == b.BUILDING:
                         if b.handler_node == socket.getfqdn():
-                            try:
-                                resp = HttpResponse(open(b.temporary_log_path(), 'r'), 'text/plain')
-                            except:
-                                resp = HttpResponse('', 'text/plain')
-                            resp.rendered_content = ''
-                            return resp
+                            return serve_log_file(request, b.temporary_log_path())
                         else:
-                            downstream_resp = requests.get('http://%s%s' % (b.handler_node, request.path))
-                            resp = HttpResponse(downstream_resp.content, 'text/plain')
-                            resp.rendered_content = ''
-                            return resp
+                            return proxy_log(request, 'http://%s%s' % (b.handler_node, request.get_full_path()))
                     else:
+                        archive = b.log_archive()
+                        if archive is not None:
+                            return serve_log_archive(request, archive)
                         url = b.buildlog_url()
                         resp = HttpResponsePermanentRedirect(b.direct_buildlog_url())
                         resp.rendered_content = 'REDIRECT:%s' % (url,)
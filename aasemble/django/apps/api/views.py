@@ -1,13 +1,18 @@
+import hashlib
+import hmac
 import logging
 
 from allauth.account.adapter import DefaultAccountAdapter
 
 from django.conf import settings
+from django.utils.encoding import force_bytes
 
 from rest_framework.generics import CreateAPIView
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 
+from aasemble.django.apps.buildsvc.models.package_source import get_github_webhook_secret
+
 LOG = logging.getLogger(__name__)
 
 
@@ -20,12 +25,26 @@ class MyUserAdapter(DefaultAccountAdapter):
         return settings.EMAIL_CONFIRMATION_URL % (emailconfirmation.key,)
 
 
+def github_signature_valid(request):
+    """Checks the X-Hub-Signature Github computes over the request body
+    with the secret the web hook was registered with."""
+    secret = get_github_webhook_secret()
+    signature = request.META.get('HTTP_X_HUB_SIGNATURE')
+    if not secret or not signature:
+        return False
+    expected = 'sha1=' + hmac.new(force_bytes(secret), request.body, hashlib.sha1).hexdigest()
+    return hmac.compare_digest(force_bytes(expected), force_bytes(signature))
+
+
 class GithubHookView(CreateAPIView):
     permission_classes = [AllowAny]
 
     def create(self, request, *args, **kwargs):
         from .tasks import github_push_event
 
+        # Must be checked before request.data consumes the body
+        signed = github_signature_valid(request)
+
         try:
             event_type = request.META['HTTP_X_GITHUB_EVENT']
             url = request.data['repository']['url']
@@ -34,7 +53,12 @@ class GithubHookView(CreateAPIView):
             if event_type != 'push':
                 return Response({'thanks': 'cool story bro'})
 
-            github_push_event.delay(url)
+            if signed:
+                github_push_event.delay(url, request.data.get('ref'), request.data.get('after'))
+            else:
+                # Anyone can post here, so rather than take its word for
+                # what was pushed, poll the repository.
+                github_push_event.delay(url)
 
             return Response({'ok': 'thanks'})
         except KeyError:
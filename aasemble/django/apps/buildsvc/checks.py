@@ -69,7 +69,7 @@ def github_email_scope(app_configs, **kwargs):
 
 @register(deploy=True)
 def gce_config_complete(app_configs, **kwargs):
-    if getattr(settings, 'AASEMBLE_BUILDSVC_EXECUTOR') == 'GCENode':
+    if getattr(settings, 'AASEMBLE_BUILDSVC_EXECUTOR') in ('GCENode', 'PooledGCENode'):
         if not hasattr(settings, 'AASEMBLE_BUILDSVC_GCE_KEY_FILE'):
             return [E004]
         elif not os.access(settings.AASEMBLE_BUILDSVC_GCE_KEY_FILE, os.R_OK):
@@ -1,3 +1,4 @@
+import itertools
 import json
 import logging
 import os
@@ -5,14 +6,19 @@ import os.path
 
 from django.conf import settings
 
+from libcloud.common.google import ResourceNotFoundError
+from libcloud.compute.base import Node
 from libcloud.compute.providers import get_driver
-from libcloud.compute.types import Provider
+from libcloud.compute.types import NodeState, Provider
 
 from aasemble.utils import retry_for_duration_wrapper, run_cmd, ssh_get, ssh_run_cmd
 from aasemble.utils.exceptions import CommandFailed
 
 LOG = logging.getLogger(__name__)
 
+# Waits for the startup script to finish installing aasemble-pkgbuild
+WAIT_FOR_PKGBUILD_CMD = ['timeout', '500', 'bash', '-c', 'while ! aasemble-pkgbuild --help; do sleep 20; done']
+
 
 class Executor(object):
     def __init__(self, name):
@@ -59,6 +65,9 @@ class GCENode(Executor):
 
     @property
     def connection(self):
+        if self._connection is None and getattr(settings, 'AASEMBLE_BUILDSVC_GCE_FAKE_DRIVER', False):
+            self._connection = FakeGCEDriver()
+
         if self._connection is None:
             driver = get_driver(self.provider)
             driver_args, driver_kwargs = self._get_driver_args_and_kwargs()
@@ -120,9 +129,13 @@ class GCENode(Executor):
                                                 ex_metadata=self._metadata)
         self.wait_until_is_usable()
 
+    @property
+    def public_ip(self):
+        return self.node.public_ips[0]
+
     @property
     def _ssh_connect_string(self):
-        return 'ubuntu@%s' % (self.node.public_ips[0],)
+        return 'ubuntu@%s' % (self.public_ip,)
 
     def run_cmd(self, *args, **kwargs):
         return ssh_run_cmd(self._ssh_connect_string, *args, remote_cwd='workspace', **kwargs)
@@ -133,6 +146,20 @@ class GCENode(Executor):
     def destroy(self):
         self.node.destroy()
 
+    def destroy_by_name(self):
+        """Destroys the node called self.name, if it exists."""
+        try:
+            node = self.connection.ex_get_node(self.name, self._zone)
+        except ResourceNotFoundError:
+            return
+        node.destroy()
+
+    def reset(self):
+        """Removes the workspace left behind by a build. Anything the
+        build did elsewhere on the node (e.g. in the home directory or
+        docker) is left in place."""
+        ssh_run_cmd(self._ssh_connect_string, ['sudo', 'rm', '-rf', 'workspace'])
+
     def __enter__(self):
         self.launch()
         return self
@@ -144,6 +171,62 @@ class GCENode(Executor):
         self.destroy()
 
 
+class PooledGCENode(GCENode):
+    """A GCENode leased from the pool of warm build nodes (see nodepool)
+    rather than created for the build. If the pool has no idle nodes, a
+    new one is provisioned right away. Either way, the node goes back to
+    the pool afterwards."""
+    def __init__(self, name):
+        super(PooledGCENode, self).__init__(name)
+        self.build_node = None
+
+    @property
+    def public_ip(self):
+        return self.build_node.public_ip
+
+    def __enter__(self):
+        from . import nodepool
+        self.build_node = nodepool.lease_node()
+        if self.build_node is None:
+            LOG.info('No idle build nodes. Provisioning one.')
+            self.build_node = nodepool.provision_node_for_lease()
+        nodepool.schedule_maintenance()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        from . import nodepool
+        nodepool.release_node(self.build_node, self)
+
+
+class FakeGCEDriver(object):
+    """Stands in for libcloud's GCE driver (when
+    AASEMBLE_BUILDSVC_GCE_FAKE_DRIVER is set), so build nodes can be
+    managed without Google Compute Engine. Nodes only exist in memory."""
+    nodes = {}
+    ip_counter = itertools.count(1)
+
+    def create_node(self, name, size, image, location=None, **kwargs):
+        if name in self.nodes:
+            raise ValueError('Node %s already exists' % (name,))
+        node = Node(id=name, name=name, state=NodeState.RUNNING,
+                    public_ips=['192.0.2.%d' % (next(self.ip_counter) % 256,)],
+                    private_ips=[], driver=self,
+                    extra={'size': size, 'location': location, 'metadata': kwargs.get('ex_metadata')})
+        self.nodes[name] = node
+        return node
+
+    def list_nodes(self):
+        return list(self.nodes.values())
+
+    def ex_get_node(self, name, zone=None):
+        if name not in self.nodes:
+            raise ResourceNotFoundError('Node %s not found' % (name,), None, None)
+        return self.nodes[name]
+
+    def destroy_node(self, node):
+        return self.nodes.pop(node.name, None) is not None
+
+
 def get_executor_class(name=None, settings=settings):
     if name is None:
         name = getattr(settings, 'AASEMBLE_BUILDSVC_EXECUTOR', 'Local')
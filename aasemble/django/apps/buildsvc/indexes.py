@@ -0,0 +1,154 @@
+import bz2
+import gzip
+import hashlib
+import tempfile
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+CHUNK_SIZE = 64 * 1024
+
+
+class DigestingWriter(object):
+    """File-like object that passes everything written to it on to fp,
+    keeping track of size and md5/sha1/sha256 digests along the way."""
+    def __init__(self, fp):
+        self.fp = fp
+        self.size = 0
+        self.md5 = hashlib.md5()
+        self.sha1 = hashlib.sha1()
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.fp.write(data)
+        self.md5.update(data)
+        self.sha1.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def flush(self):
+        self.fp.flush()
+
+    def metadata(self):
+        return {'size': self.size,
+                'md5': self.md5.hexdigest(),
+                'sha1': self.sha1.hexdigest(),
+                'sha256': self.sha256.hexdigest()}
+
+
+class PlainOutput(object):
+    suffix = ''
+
+    def __init__(self):
+        self.fp = tempfile.TemporaryFile()
+        self.digester = DigestingWriter(self.fp)
+
+    def write(self, data):
+        self.digester.write(data)
+
+    def close(self):
+        self.fp.flush()
+        self.fp.seek(0)
+
+
+class GzipOutput(PlainOutput):
+    suffix = '.gz'
+
+    def __init__(self):
+        super(GzipOutput, self).__init__()
+        # mtime=0 keeps the output reproducible for identical input
+        self.gzfp = gzip.GzipFile(fileobj=self.digester, mode='wb', mtime=0)
+
+    def write(self, data):
+        self.gzfp.write(data)
+
+    def close(self):
+        self.gzfp.close()
+        super(GzipOutput, self).close()
+
+
+class CompressorOutput(PlainOutput):
+    def __init__(self):
+        super(CompressorOutput, self).__init__()
+        self.compressor = self.get_compressor()
+
+    def get_compressor(self):
+        raise NotImplementedError()
+
+    def write(self, data):
+        self.digester.write(self.compressor.compress(data))
+
+    def close(self):
+        self.digester.write(self.compressor.flush())
+        super(CompressorOutput, self).close()
+
+
+class Bzip2Output(CompressorOutput):
+    suffix = '.bz2'
+
+    def get_compressor(self):
+        return bz2.BZ2Compressor()
+
+
+class XzOutput(CompressorOutput):
+    suffix = '.xz'
+
+    def get_compressor(self):
+        return lzma.LZMACompressor()
+
+
+class IndexWriter(object):
+    """Writes an index to a temporary file along with any requested
+    compressed variants in a single pass.
+
+    Data is buffered and handed to the outputs CHUNK_SIZE bytes at a time,
+    so lots of small writes (e.g. one per stanza) stay cheap."""
+    def __init__(self, gzip=False, bzip2=False, xz=False):
+        self.outputs = [PlainOutput()]
+        if gzip:
+            self.outputs.append(GzipOutput())
+        if bzip2:
+            self.outputs.append(Bzip2Output())
+        if xz and lzma is not None:
+            self.outputs.append(XzOutput())
+        self.buf = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buffered += len(data)
+        if self.buffered >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        data = b''.join(self.buf)
+        if data:
+            for output in self.outputs:
+                output.write(data)
+        self.buf = []
+        self.buffered = 0
+
+    def close(self):
+        """Returns a list of (suffix, fp, metadata) tuples. The caller is
+        responsible for closing the returned file objects."""
+        self.flush()
+        for output in self.outputs:
+            output.close()
+        return [(output.suffix, output.fp, output.digester.metadata()) for output in self.outputs]
+
+
+def write_index(chunks, gzip=False, bzip2=False, xz=False):
+    """Writes chunks (either a byte string or an iterable of byte strings)
+    to a temporary file along with any requested compressed variants.
+
+    Returns a list of (suffix, fp, metadata) tuples. The caller is
+    responsible for closing the returned file objects."""
+    if isinstance(chunks, bytes):
+        chunks = [chunks]
+
+    writer = IndexWriter(gzip=gzip, bzip2=bzip2, xz=xz)
+    for chunk in chunks:
+        writer.write(chunk)
+    return writer.close()
@@ -0,0 +1,116 @@
+"""Compressed build log archives.
+
+An archive is a sequence of independently gzipped blocks. Concatenated
+gzip members make up a valid gzip file, so zcat and friends can read
+archives just fine. Next to it lives a small JSON index of where each
+block starts, which lets LogArchive serve byte ranges and the last lines
+of a log by decompressing only the blocks involved."""
+import json
+import os
+import os.path
+import tempfile
+import zlib
+
+BLOCK_SIZE = 256 * 1024
+
+# Makes zlib read and write gzip rather than raw zlib streams
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+def _write_atomically(path, write):
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            write(fp)
+        os.chmod(tmppath, 0o644)
+        os.rename(tmppath, path)
+    finally:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+
+
+def write_archive(infp, path, block_size=BLOCK_SIZE):
+    """Compresses everything read from infp into an archive at path."""
+    index = {'block_size': block_size,
+             'size': 0,
+             'blocks': []}
+
+    def write_blocks(outfp):
+        compressed_offset = 0
+        while True:
+            data = infp.read(block_size)
+            if not data:
+                break
+            compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+            compressed = compressor.compress(data) + compressor.flush()
+            outfp.write(compressed)
+            index['blocks'].append([index['size'], len(data),
+                                    compressed_offset, len(compressed),
+                                    data.count(b'\n')])
+            index['size'] += len(data)
+            compressed_offset += len(compressed)
+
+    _write_atomically(path, write_blocks)
+    _write_atomically(index_path(path), lambda fp: fp.write(json.dumps(index).encode('utf-8')))
+
+
+def remove_archive(path):
+    """Removes the archive at path, if any. Returns whether there was one."""
+    removed = False
+    for p in (path, index_path(path)):
+        if os.path.exists(p):
+            os.unlink(p)
+            removed = True
+    return removed
+
+
+class LogArchive(object):
+    def __init__(self, path):
+        self.path = path
+        with open(index_path(path), 'r') as fp:
+            index = json.load(fp)
+        self.size = index['size']
+        self.blocks = index['blocks']
+
+    def _read_block(self, fp, block):
+        offset, length, compressed_offset, compressed_length, newlines = block
+        fp.seek(compressed_offset)
+        return zlib.decompress(fp.read(compressed_length), GZIP_WBITS)
+
+    def read(self, start=0, stop=None):
+        """Generates the contents of the log from byte start up to (but not
+        including) byte stop, one block at a time."""
+        if stop is None or stop > self.size:
+            stop = self.size
+        with open(self.path, 'rb') as fp:
+            for block in self.blocks:
+                offset, length = block[:2]
+                if offset + length <= start:
+                    continue
+                if offset >= stop:
+                    break
+                data = self._read_block(fp, block)
+                yield data[max(start - offset, 0):stop - offset]
+
+    def tail(self, lines):
+        """Returns the last lines lines of the log."""
+        if lines <= 0:
+            return b''
+
+        # Walk backwards until we have seen more newlines than we need, so
+        # the first (probably partial) line can be dropped.
+        needed = []
+        newlines = 0
+        for block in reversed(self.blocks):
+            needed.insert(0, block)
+            newlines += block[4]
+            if newlines > lines:
+                break
+
+        with open(self.path, 'rb') as fp:
+            data = b''.join(self._read_block(fp, block) for block in needed)
+        return b''.join(data.splitlines(True)[-lines:])
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from aasemble.django.apps.buildsvc import storage
+
+
+class Command(BaseCommand):
+    help = 'Removes pool blobs that are no longer referenced by any repository'
+
+    def handle(self, *args, **options):
+        removed = storage.get_blob_store().collect_garbage()
+        self.stdout.write('Removed %d unreferenced blobs' % (removed,))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from aasemble.django.apps.buildsvc import tasks
+
+
+class Command(BaseCommand):
+    help = 'Queues an export of every repository'
+
+    def handle(self, *args, **options):
+        tasks.export_all.delay()
+        self.stdout.write('Queued export of all repositories')
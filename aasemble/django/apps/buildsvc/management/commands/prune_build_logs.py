@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from aasemble.django.apps.buildsvc.models.build import prune_build_logs
+
+
+class Command(BaseCommand):
+    help = 'Removes build logs older than AASEMBLE_BUILDSVC_BUILDLOG_RETENTION_DAYS'
+
+    def handle(self, *args, **options):
+        removed = prune_build_logs()
+        self.stdout.write('Removed the logs of %d builds' % (removed,))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0026_auto_20160208_0946'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='binarypackageversion',
+            name='packages_stanza',
+            field=models.TextField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='sourcepackageversion',
+            name='sources_stanza',
+            field=models.TextField(editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0027_cached_index_stanzas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repository',
+            name='export_generation',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='exported_generation',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='export_scheduled',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='export_in_progress',
+            field=models.BooleanField(default=False),
+        ),
+    ]
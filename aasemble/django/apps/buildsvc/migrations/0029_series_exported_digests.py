@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0028_repository_export_scheduling'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='series',
+            name='exported_digests',
+            field=models.TextField(default='{}', editable=False),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0029_series_exported_digests'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='series',
+            name='by_hash_history',
+            field=models.TextField(default='{}', editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0031_packagesource_poll_schedule'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='packagesource',
+            index_together=set([('git_url', 'branch')]),
+        ),
+    ]
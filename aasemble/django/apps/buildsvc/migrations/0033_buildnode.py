@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0032_packagesource_git_url_branch_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuildNode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('state', models.SmallIntegerField(choices=[(1, 'Provisioning'), (2, 'Idle'), (3, 'Leased'), (4, 'Retiring')], db_index=True, default=1)),
+                ('public_ip', models.GenericIPAddressField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('state_changed', models.DateTimeField(default=django.utils.timezone.now)),
+                ('builds', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0033_buildnode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repository',
+            name='export_started',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+    ]
@@ -4,6 +4,7 @@ from .binary_package import BinaryPackage  # noqa
 from .binary_package_version import BinaryPackageVersion  # noqa
 from .binary_package_version_user_field import BinaryPackageVersionUserField  # noqa
 from .build import Build  # noqa
+from .build_node import BuildNode  # noqa
 from .external_dependency import ExternalDependency  # noqa
 from .package_source import PackageSource  # noqa
 from .repository import Repository  # noqa
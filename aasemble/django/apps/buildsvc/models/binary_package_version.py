@@ -1,9 +1,7 @@
-import hashlib
 import os.path
 
 import deb822
 
-from django.core.files.base import File
 from django.db import models
 
 from aasemble.django.apps.buildsvc import storage
@@ -16,6 +14,7 @@ from aasemble.django.apps.buildsvc.models.binary_package import BinaryPackage
 from aasemble.django.apps.buildsvc.models.binary_package_version_user_field import BinaryPackageVersionUserField
 from aasemble.django.apps.buildsvc.models.source_package import SourcePackage
 from aasemble.django.apps.buildsvc.models.source_package_version import SourcePackageVersion
+from aasemble.django.apps.buildsvc.utils import get_fileinfo
 
 
 def split_description(description):
@@ -39,6 +38,16 @@ def _extract_info_from_deb(path):
     return deb822.Deb822(out)
 
 
+class BinaryPackageVersionQuerySet(models.QuerySet):
+    def for_index(self):
+        """Fetches everything format_for_packages() needs up front, so
+        rendering a Packages index takes a fixed number of queries no
+        matter how many package versions it holds."""
+        return (self.select_related('binary_package',
+                                    'binary_build__source_package_version__source_package')
+                .prefetch_related('binarypackageversionuserfield_set'))
+
+
 class BinaryPackageVersion(models.Model):
     BINARY_PACKAGE_TYPE_CHOICES = ((BINARY_PACKAGE_TYPE_DEB, 'Debian package (.deb)'),
                                    (BINARY_PACKAGE_TYPE_UDEB, 'Debian-installer package (.udeb)'),
@@ -76,6 +85,12 @@ class BinaryPackageVersion(models.Model):
     # Not used? wtf?
     location = models.CharField(max_length=250)
 
+    # The stanza last rendered for the Packages index. Cleared whenever
+    # anything it is derived from changes.
+    packages_stanza = models.TextField(null=True, editable=False)
+
+    objects = BinaryPackageVersionQuerySet.as_manager()
+
     # Fields that are part of the model.
     model_fields = ('Version',
                     'Architecture',
@@ -137,16 +152,48 @@ class BinaryPackageVersion(models.Model):
             data[bpvuf.name] = bpvuf.value
         return str(data)
 
+    def cached_format_for_packages(self):
+        """Like format_for_packages(), but only renders the stanza if
+        it has not been rendered by a previous export"""
+        if self.packages_stanza is None:
+            self.packages_stanza = self.format_for_packages()
+            self.save(update_fields=['packages_stanza'])
+        return self.packages_stanza
+
+    @property
+    def pool_path(self):
+        return os.path.join(self.binary_build.source_package_version.source_package.repository.user.username,
+                            self.binary_build.source_package_version.source_package.repository.name,
+                            self.filename)
+
     def store(self, fpath):
-        destpath = os.path.join(self.binary_build.source_package_version.source_package.repository.user.username,
-                                self.binary_build.source_package_version.source_package.repository.name,
-                                self.filename)
         storage_driver = storage.get_repository_storage_driver()
-        with open(fpath, 'rb') as fp:
-            storage_driver.save(destpath, File(fp))
+        storage_driver.save_pool_file(self.pool_path, fpath, self.sha256)
 
     @classmethod
-    def import_file(cls, series, path, source_package_version=None):
+    def import_files(cls, series, paths):
+        """Imports a number of debs at once. The debs are copied into the
+        pool concurrently once they have all been added to the database,
+        and only added to series once they are all in the pool."""
+        bpvs = [cls.import_file(series, path, store=False) for path in paths]
+        storage_driver = storage.get_repository_storage_driver()
+        storage.raise_for_errors(storage_driver.save_many([(bpv.pool_path, path, bpv.sha256)
+                                                           for bpv, path in zip(bpvs, paths)]))
+        for bpv in bpvs:
+            bpv.add_to_series(series)
+        return bpvs
+
+    def add_to_series(self, series):
+        series.binary_package_versions.add(self)
+
+        self.packages_stanza = None
+        self.save(update_fields=['packages_stanza'])
+
+    @classmethod
+    def import_file(cls, series, path, source_package_version=None, store=True):
+        """Imports the deb at path into series. With store=False, the deb is
+        neither copied into the pool nor added to series; that is up to the
+        caller (see import_files())."""
         control = _extract_info_from_deb(path)
 
         bb_info = {'source_package': None,
@@ -188,19 +235,19 @@ class BinaryPackageVersion(models.Model):
                 spv = source_package_version
             kwargs['binary_build'], _ = BinaryBuild.objects.get_or_create(source_package_version=spv, architecture=bb_info['architecture'])
 
-        with open(path, 'rb') as fp:
-            contents = fp.read()
-
-        kwargs['md5sum'] = hashlib.md5(contents).hexdigest()
-        kwargs['sha1'] = hashlib.sha1(contents).hexdigest()
-        kwargs['sha256'] = hashlib.sha256(contents).hexdigest()
-        kwargs['size'] = len(contents)
+        fileinfo = get_fileinfo(path)
+        kwargs['md5sum'] = fileinfo['md5']
+        kwargs['sha1'] = fileinfo['sha1']
+        kwargs['sha256'] = fileinfo['sha256']
+        kwargs['size'] = fileinfo['size']
 
         self, _ = cls.objects.get_or_create(**kwargs)
-        self.store(path)
-
-        series.binary_package_versions.add(self)
 
         for user_field in user_fields:
             user_field.binary_package_version = self
             user_field.save()
+
+        if store:
+            self.store(path)
+            self.add_to_series(series)
+        return self
@@ -1,4 +1,6 @@
+import datetime
 import errno
+import json
 import logging
 import os
 import os.path
@@ -10,10 +12,19 @@ from django.contrib.sites.models import Site
 from django.db import models
 from django.utils.timezone import now
 
+from aasemble.django.apps.buildsvc import executors, logarchive
 from aasemble.utils import ensure_dir
+from aasemble.utils.exceptions import CommandFailed
 
 LOG = logging.getLogger(__name__)
 
+# Must match aasemble.django.apps.buildsvc.pkgbuild.RESULT_MARKER
+PKGBUILD_RESULT_MARKER = 'aasemble-pkgbuild-result: '
+
+
+class PkgbuildResultMissing(Exception):
+    pass
+
 
 class Build(models.Model):
     BUILDING = 1
@@ -103,25 +114,42 @@ class Build(models.Model):
             old = Build.objects.get(pk=self.pk)
             return not old.build_finished
 
-    def _copy_temporary_log_to_final_location(self):
+    def _archive_temporary_log(self):
         try:
-            with open(self.final_log_path(), 'wb') as outfp:
-                with open(self.temporary_log_path(), 'rb') as infp:
-                    while True:
-                        buf = infp.read(4096)
-                        if not buf:
-                            break
-                        outfp.write(buf)
+            with open(self.temporary_log_path(), 'rb') as infp:
+                logarchive.write_archive(infp, self.archived_log_path())
         except IOError as e:
-            if e.errno == errno.ENOENT:
-                pass
-            raise
+            if e.errno != errno.ENOENT:
+                raise
 
     def save(self, *args, **kwargs):
         if self._build_just_finished():
-            self._copy_temporary_log_to_final_location()
+            self._archive_temporary_log()
         return super(Build, self).save(*args, **kwargs)
 
+    def archived_log_path(self):
+        return self.final_log_path() + '.gz'
+
+    def log_archive(self):
+        """Returns a LogArchive for the log of this (finished) build or
+        None if it has not been archived (e.g. because the build predates
+        log archives)."""
+        try:
+            return logarchive.LogArchive(self.archived_log_path())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def remove_log(self):
+        """Removes the archived log along with any uncompressed log from
+        before log archives. Returns whether there was anything to remove."""
+        removed = logarchive.remove_archive(self.archived_log_path())
+        if os.path.exists(self.final_log_path()):
+            os.unlink(self.final_log_path())
+            removed = True
+        return removed
+
     def final_log_path(self):
         path = os.path.join(self.source.series.repository.buildlogdir,
                             self.logpath())
@@ -160,46 +188,62 @@ class Build(models.Model):
 
         url = self.get_full_absolute_url()
 
-        executor.run_cmd(['aasemble-pkgbuild', 'checkout', url], cwd=tmpdir, logger=self.logger)
-        version = executor.run_cmd(['aasemble-pkgbuild', 'version', url], cwd=tmpdir, logger=self.logger)
-        name = executor.run_cmd(['aasemble-pkgbuild', 'name', url], cwd=tmpdir, logger=self.logger)
-
-        self.version = version
-        self.save(update_fields=['version'])
-
-        self.source.last_built_version = version
-        self.source.last_built_name = name
-        self.source.save(update_fields=['last_built_version', 'last_built_name'])
-
-        source_build_cmd = get_source_build_cmd(url)
-        executor.run_cmd(source_build_cmd, cwd=tmpdir, logger=self.logger)
+        try:
+            output = executor.run_cmd(get_run_cmd(url), cwd=tmpdir, logger=self.logger)
+        except CommandFailed as e:
+            # aasemble-pkgbuild reports the version and name before it
+            # starts building, so they can be recorded for failed builds
+            # too (which gives their logs a proper name). Garbled results
+            # must not hide why the build failed, though.
+            try:
+                result = find_pkgbuild_result(e.stdout)
+                if result is not None:
+                    self.record_pkgbuild_result(result)
+            except (KeyError, TypeError, ValueError):
+                LOG.exception('Could not record the result of failed build %s' % (self.id,))
+            raise
 
-        binary_build_cmd = get_binary_build_cmd(url)
-        executor.run_cmd(binary_build_cmd, cwd=tmpdir, logger=self.logger)
+        self.record_pkgbuild_result(parse_pkgbuild_result(output))
 
         self.update_state(self.SUCCESFULLY_BUILT)
 
         self.build_finished = now()
         self.save()
 
+    def record_pkgbuild_result(self, result):
+        self.version = result['version']
+        self.save(update_fields=['version'])
+
+        self.source.last_built_version = result['version']
+        self.source.last_built_name = result['name']
+        self.source.save(update_fields=['last_built_version', 'last_built_name'])
+
     def wait_until_pkgbuild_is_installed(self, executor):
-        executor.run_cmd(['timeout', '500', 'bash', '-c', 'while ! aasemble-pkgbuild --help; do sleep 20; done'], logger=self.logger)
+        executor.run_cmd(executors.WAIT_FOR_PKGBUILD_CMD, logger=self.logger)
 
 
-def get_binary_build_cmd(b_url, settings=settings):
-    build_cmd = ['aasemble-pkgbuild']
+def get_buildlog_retention_days():
+    return getattr(settings, 'AASEMBLE_BUILDSVC_BUILDLOG_RETENTION_DAYS', None)
 
-    if hasattr(settings, 'AASEMBLE_BUILDSVC_BUILDER_HTTP_PROXY'):
-        if settings.AASEMBLE_BUILDSVC_BUILDER_HTTP_PROXY:
-            build_cmd += ['--proxy', settings.AASEMBLE_BUILDSVC_BUILDER_HTTP_PROXY]
 
-    build_cmd += ['--parallel', str(getattr(settings, 'AASEMBLE_BUILDSVC_DEFAULT_PARALLEL', 1))]
-    build_cmd += ['binary-build', b_url]
+def prune_build_logs():
+    """Removes the logs of builds that finished more than
+    AASEMBLE_BUILDSVC_BUILDLOG_RETENTION_DAYS days ago.
 
-    return build_cmd
+    Returns the number of builds whose logs were removed."""
+    retention_days = get_buildlog_retention_days()
+    if retention_days is None:
+        return 0
+
+    cutoff = now() - datetime.timedelta(days=retention_days)
+    removed = 0
+    for build in Build.objects.filter(build_finished__lt=cutoff).select_related('source__series__repository__user'):
+        if build.remove_log():
+            removed += 1
+    return removed
 
 
-def get_source_build_cmd(b_url, settings=settings):
+def get_run_cmd(b_url, settings=settings):
     build_cmd = ['aasemble-pkgbuild']
 
     if hasattr(settings, 'AASEMBLE_BUILDSVC_BUILDER_HTTP_PROXY'):
@@ -210,6 +254,50 @@ def get_source_build_cmd(b_url, settings=settings):
     build_cmd += ['--email', settings.BUILDSVC_DEBEMAIL]
     build_cmd += ['--parallel', str(getattr(settings, 'AASEMBLE_BUILDSVC_DEFAULT_PARALLEL', 1))]
 
-    build_cmd += ['source-build', b_url]
+    build_cmd += get_git_cache_args(settings=settings)
+
+    build_cmd += ['run', b_url]
 
     return build_cmd
+
+
+def find_pkgbuild_result(output):
+    """Finds the result "aasemble-pkgbuild run" reports in its output (on
+    a line of its own, prefixed with PKGBUILD_RESULT_MARKER). Anything
+    else, such as build output or stderr noise from ssh, is ignored.
+
+    Only the first such line counts: it is reported before the build
+    starts, so any later ones come from the package being built.
+
+    Returns None if there is no result."""
+    if not output:
+        return None
+    if isinstance(output, bytes):
+        output = output.decode('utf-8', 'replace')
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith(PKGBUILD_RESULT_MARKER):
+            return json.loads(line[len(PKGBUILD_RESULT_MARKER):])
+    return None
+
+
+def parse_pkgbuild_result(output):
+    """Like find_pkgbuild_result(), but raises PkgbuildResultMissing if
+    there is no result."""
+    result = find_pkgbuild_result(output)
+    if result is None:
+        raise PkgbuildResultMissing('aasemble-pkgbuild did not report a result')
+    return result
+
+
+def get_git_cache_args(settings=settings):
+    args = []
+
+    git_cache_dir = getattr(settings, 'AASEMBLE_BUILDSVC_BUILDER_GIT_CACHE_DIR', None)
+    if git_cache_dir:
+        args += ['--git-cache-dir', git_cache_dir]
+        git_cache_size = getattr(settings, 'AASEMBLE_BUILDSVC_BUILDER_GIT_CACHE_SIZE', None)
+        if git_cache_size:
+            args += ['--git-cache-size', str(git_cache_size)]
+
+    return args
@@ -0,0 +1,40 @@
+from django.db import models
+from django.utils.encoding import python_2_unicode_compatible
+from django.utils.timezone import now
+
+
+@python_2_unicode_compatible
+class BuildNode(models.Model):
+    """A build node in the pool kept warm by nodepool"""
+    PROVISIONING = 1
+    IDLE = 2
+    LEASED = 3
+    RETIRING = 4
+
+    NODE_STATES = (
+        (PROVISIONING, 'Provisioning'),
+        (IDLE, 'Idle'),
+        (LEASED, 'Leased'),
+        (RETIRING, 'Retiring'),
+    )
+
+    name = models.CharField(max_length=100, unique=True)
+    state = models.SmallIntegerField(default=PROVISIONING, choices=NODE_STATES, db_index=True)
+    public_ip = models.GenericIPAddressField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    state_changed = models.DateTimeField(default=now)
+    builds = models.IntegerField(default=0)
+
+    def __str__(self):
+        return self.name
+
+    def transition(self, from_state, to_state, **kwargs):
+        """Moves the node from from_state to to_state, unless someone else
+        got there first. Returns whether it did."""
+        kwargs['state'] = to_state
+        kwargs['state_changed'] = now()
+        if not BuildNode.objects.filter(id=self.id, state=from_state).update(**kwargs):
+            return False
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+        return True
@@ -1,6 +1,8 @@
+import datetime
 import logging
 import os.path
 import uuid
+from collections import OrderedDict
 
 from allauth.socialaccount.models import SocialToken
 
@@ -18,13 +20,65 @@ from aasemble.django.apps.buildsvc import executors, tasks
 from aasemble.utils import TemporaryDirectory, run_cmd
 from aasemble.utils.exceptions import CommandFailed
 
+try:
+    from aasemble.utils import aio
+except ImportError:
+    # Python 2 has no asyncio, so we poll one repository at a time
+    aio = None
+
 LOG = logging.getLogger(__name__)
 
+# How long a poller may take to get around to polling the sources it has
+# claimed. After that, they are up for grabs again.
+POLL_CLAIM_TIMEOUT = datetime.timedelta(minutes=5)
+
 
 class NotAValidGithubRepository(Exception):
     pass
 
 
+def get_github_webhook_secret():
+    return getattr(settings, 'GITHUB_WEBHOOK_SECRET', None)
+
+
+def get_poll_concurrency():
+    return getattr(settings, 'AASEMBLE_BUILDSVC_POLL_CONCURRENCY', 8)
+
+
+def get_poll_min_interval():
+    return getattr(settings, 'AASEMBLE_BUILDSVC_POLL_MIN_INTERVAL', 10)
+
+
+def get_poll_max_interval():
+    return getattr(settings, 'AASEMBLE_BUILDSVC_POLL_MAX_INTERVAL', 3600)
+
+
+def ls_remote_cmd(git_url, branches):
+    return ['git', 'ls-remote', git_url] + ['refs/heads/%s' % branch for branch in branches]
+
+
+def parse_ls_remote(stdout):
+    """Parses the output of git ls-remote.
+
+    Returns a dict mapping branch names to shas."""
+    heads = {}
+    for line in stdout.decode().splitlines():
+        if '\t' not in line:
+            continue
+        sha, ref = line.split('\t', 1)
+        if ref.startswith('refs/heads/'):
+            heads[ref[len('refs/heads/'):]] = sha
+    return heads
+
+
+def ls_remote(git_url, branches):
+    """Looks up the heads of branches of the repository at git_url.
+
+    Returns a dict mapping branch names to shas. Branches that do not
+    exist are left out."""
+    return parse_ls_remote(run_cmd(ls_remote_cmd(git_url, branches)))
+
+
 @python_2_unicode_compatible
 class PackageSource(models.Model):
     uuid = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
@@ -39,6 +93,11 @@ class PackageSource(models.Model):
     last_failure_time = models.DateTimeField(null=True, blank=True)
     last_failure = models.CharField(max_length=255, null=True, blank=True)
     disabled = models.BooleanField(default=False)
+    next_poll_due = models.DateTimeField(default=now, db_index=True, editable=False)
+    poll_interval = models.IntegerField(default=0, editable=False)
+
+    class Meta:
+        index_together = (('git_url', 'branch'),)
 
     def __str__(self):
         return '%s/%s' % (self.git_url, self.branch)
@@ -48,26 +107,133 @@ class PackageSource(models.Model):
         return self.series.repository
 
     def poll(self):
-        cmd = ['git', 'ls-remote', self.git_url,
-               'refs/heads/%s' % self.branch]
         try:
-            stdout = run_cmd(cmd)
-            stdout = stdout.decode()
+            heads = ls_remote(self.git_url, [self.branch])
         except CommandFailed as e:
-            self.last_failure_time = now()
-            self.last_failure = e.stdout
-            self.disabled = True
-            self.save()
+            self.record_poll_failure(e)
             return False
 
-        sha = stdout.split('\t')[0]
+        return self.record_revision(heads.get(self.branch, ''))
 
-        if sha == self.last_seen_revision:
-            return False
+    def record_poll_failure(self, e):
+        self.last_failure_time = now()
+        self.last_failure = e.stdout
+        self.disabled = True
+        self.save()
 
+    def record_revision(self, sha):
+        """Updates last_seen_revision. Returns whether it changed.
+
+        The comparison is done by the database rather than against this
+        instance, which may be stale, so a new revision is only ever
+        reported once."""
+        updated = PackageSource.objects.filter(id=self.id).exclude(last_seen_revision=sha).update(last_seen_revision=sha)
         self.last_seen_revision = sha
-        self.save()
-        return True
+        return updated > 0
+
+    def record_push(self, sha):
+        """Records a revision pushed to the branch (as reported by a web
+        hook) and starts a build if it's new. Returns whether it was."""
+        changed = self.record_revision(sha)
+        self.schedule_next_poll(changed)
+        if changed:
+            self.build()
+        return changed
+
+    def schedule_next_poll(self, changed):
+        """Works out when to poll next. Sources that just changed are polled
+        again after the minimum interval. Otherwise, the interval doubles
+        each time, up to the maximum."""
+        min_interval = get_poll_min_interval()
+        if changed:
+            interval = min_interval
+        else:
+            interval = min(max(self.poll_interval, min_interval) * 2, get_poll_max_interval())
+
+        self.poll_interval = interval
+        self.next_poll_due = now() + datetime.timedelta(seconds=interval)
+        PackageSource.objects.filter(id=self.id).update(poll_interval=self.poll_interval,
+                                                        next_poll_due=self.next_poll_due)
+
+    @classmethod
+    def due_for_polling(cls):
+        return cls.objects.filter(webhook_registered=False,
+                                  next_poll_due__lte=now()).exclude(disabled=True)
+
+    @classmethod
+    def claim_due_for_polling(cls):
+        """Claims the sources that are due for polling, so that overlapping
+        pollers don't poll them, too. Claiming a source pushes its
+        next_poll_due out by POLL_CLAIM_TIMEOUT until schedule_next_poll()
+        sets the real one. If the poller dies, the source simply becomes
+        due again.
+
+        Returns the list of sources claimed."""
+        claimed = []
+        for source in cls.due_for_polling():
+            claimed_at = now()
+            claimed_until = claimed_at + POLL_CLAIM_TIMEOUT
+            if cls.objects.filter(id=source.id, next_poll_due__lte=claimed_at).update(next_poll_due=claimed_until):
+                source.next_poll_due = claimed_until
+                claimed.append(source)
+        return claimed
+
+    @classmethod
+    def poll_many(cls, sources, concurrency=None):
+        """Polls sources with a single ls-remote per git_url, running up to
+        concurrency of them at a time.
+
+        Returns the list of sources whose revision changed."""
+        if concurrency is None:
+            concurrency = get_poll_concurrency()
+
+        groups = OrderedDict()
+        for source in sources:
+            groups.setdefault(source.git_url, []).append(source)
+
+        git_urls = list(groups)
+        cmds = [ls_remote_cmd(git_url, sorted(set(source.branch for source in groups[git_url])))
+                for git_url in git_urls]
+
+        if aio is not None:
+            outputs = aio.run_cmds(cmds, concurrency=concurrency)
+        else:
+            outputs = []
+            for cmd in cmds:
+                try:
+                    outputs.append(run_cmd(cmd))
+                except (CommandFailed, OSError) as e:
+                    outputs.append(e)
+
+        results = []
+        for output in outputs:
+            if isinstance(output, (CommandFailed, OSError)):
+                results.append(output)
+            elif isinstance(output, Exception):
+                raise output
+            else:
+                results.append(parse_ls_remote(output))
+
+        changed = []
+        for git_url, heads in zip(git_urls, results):
+            if isinstance(heads, OSError):
+                # Probably transient (e.g. we could not fork), so just back off
+                LOG.warning('Failed to poll %s: %s' % (git_url, heads))
+            for source in groups[git_url]:
+                source_changed = False
+                if isinstance(heads, CommandFailed):
+                    source.record_poll_failure(heads)
+                elif isinstance(heads, OSError):
+                    pass
+                elif source.branch not in heads:
+                    LOG.warning('%s: branch %s not found' % (git_url, source.branch))
+                else:
+                    source_changed = source.record_revision(heads[source.branch])
+
+                source.schedule_next_poll(source_changed)
+                if source_changed:
+                    changed.append(source)
+        return changed
 
     @property
     def long_name(self):
@@ -94,13 +260,12 @@ class PackageSource(models.Model):
 
             dsc_files = filter(lambda s: s.endswith('.dsc'), os.listdir(tmpdir))
             for dsc_file in dsc_files:
-                self.series.import_dsc(dsc_file)
+                self.series.import_dsc(os.path.join(tmpdir, dsc_file))
 
             deb_files = filter(lambda s: s.endswith('.deb'), os.listdir(tmpdir))
-            for deb_file in deb_files:
-                self.series.import_deb(dsc_file)
+            self.series.import_debs([os.path.join(tmpdir, deb_file) for deb_file in deb_files])
 
-            self.series.export()
+            self.series.schedule_export()
 
     def increment_build_counter(self):
         with transaction.atomic():
@@ -157,8 +322,11 @@ class PackageSource(models.Model):
             for token in SocialToken.objects.filter(account__in=self.series.repository.user.socialaccount_set.filter(provider='github')):
                 gh = github3.GitHub(token=token.token)
                 repo = gh.repository(owner, repo)
-                if repo.create_hook(name='web', config={'url': settings.GITHUB_WEBHOOK_URL,
-                                                        'content_type': 'json'}):
+                config = {'url': settings.GITHUB_WEBHOOK_URL,
+                          'content_type': 'json'}
+                if get_github_webhook_secret():
+                    config['secret'] = get_github_webhook_secret()
+                if repo.create_hook(name='web', config=config):
                     self.webhook_registered = True
                     self.save()
                     return True
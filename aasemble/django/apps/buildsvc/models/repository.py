@@ -1,10 +1,13 @@
+import datetime
 import os.path
 import uuid
 
 from django.conf import settings
 from django.contrib.auth import models as auth_models
 from django.db import models
+from django.db.models import F, Q
 from django.utils.encoding import python_2_unicode_compatible
+from django.utils.timezone import now
 
 from aasemble.django.apps.buildsvc import tasks
 from aasemble.django.apps.buildsvc.repodrivers import get_repo_driver
@@ -20,6 +23,22 @@ class Repository(models.Model):
     key_data = models.TextField(null=False)
     extra_admins = models.ManyToManyField(auth_models.Group)
 
+    # Export bookkeeping. export_generation is bumped every time an export
+    # is requested. exported_generation is the generation covered by the
+    # last completed export. export_started identifies the export in
+    # progress, if any.
+    export_generation = models.IntegerField(default=0)
+    exported_generation = models.IntegerField(default=0)
+    export_scheduled = models.BooleanField(default=False)
+    export_in_progress = models.BooleanField(default=False)
+    export_started = models.DateTimeField(null=True, editable=False)
+
+    export_bookkeeping_fields = ('export_generation',
+                                 'exported_generation',
+                                 'export_scheduled',
+                                 'export_in_progress',
+                                 'export_started')
+
     class Meta:
         verbose_name_plural = 'repositories'
         unique_together = (('user', 'name'),)
@@ -67,18 +86,81 @@ class Repository(models.Model):
         self.first_series()
         return get_repo_driver(self).export()
 
+    def schedule_export(self):
+        """Requests an export of the repository.
+
+        Requests are coalesced: If an export task is already queued, it
+        will cover this request, too. Otherwise, one is queued to run
+        after the debounce window, so that a burst of requests results
+        in a single export."""
+        Repository.objects.filter(id=self.id).update(export_generation=F('export_generation') + 1)
+        if Repository.objects.filter(id=self.id, export_scheduled=False).update(export_scheduled=True) > 0:
+            tasks.export.apply_async((self.id,), countdown=get_export_debounce())
+            return True
+        else:
+            # Export already scheduled
+            return False
+
+    def export_if_needed(self):
+        """Performs a scheduled export, unless a previous export already
+        covered every request made so far.
+
+        An export that has been running for longer than
+        AASEMBLE_BUILDSVC_EXPORT_TIMEOUT is assumed to have died along with
+        its worker, and is taken over.
+
+        Returns True if an export was performed."""
+        started = now()
+        stale = started - datetime.timedelta(seconds=get_export_timeout())
+        # Exports marked as running without export_started predate it
+        claimable = Q(export_in_progress=False) | Q(export_started__isnull=True) | Q(export_started__lt=stale)
+        claimed = Repository.objects.filter(claimable, id=self.id).update(export_in_progress=True, export_started=started)
+        if claimed == 0:
+            # Another export is running. Try again once it's had a chance to
+            # finish. export_scheduled is still set, so any requests made in
+            # the meantime are coalesced into this single follow-up export.
+            tasks.export.apply_async((self.id,), countdown=max(get_export_debounce(), 1))
+            return False
+
+        try:
+            Repository.objects.filter(id=self.id).update(export_scheduled=False)
+            self.refresh_from_db()
+            generation = self.export_generation
+            if generation <= self.exported_generation:
+                return False
+            self.export()
+            Repository.objects.filter(id=self.id, exported_generation__lt=generation).update(exported_generation=generation)
+            return True
+        finally:
+            # Unless someone took over in the meantime
+            Repository.objects.filter(id=self.id, export_started=started).update(export_in_progress=False,
+                                                                                 export_started=None)
+
     def process_changes(self, series_name, changes_file):
         return get_repo_driver(self).process_changes(series_name, changes_file)
 
     def import_deb(self, series_name, deb_file):
         return get_repo_driver(self).import_deb(series_name, deb_file)
 
+    def import_debs(self, series_name, deb_files):
+        return get_repo_driver(self).import_debs(series_name, deb_files)
+
     def import_dsc(self, series_name, dsc_file):
         return get_repo_driver(self).import_dsc(series_name, dsc_file)
 
     def save(self, *args, **kwargs):
+        """Saves the repository and schedules an export.
+
+        The export bookkeeping fields are only ever updated atomically by
+        schedule_export() and export_if_needed(), so when the row already
+        exists, they are left out of the update rather than clobbered with
+        whatever values this instance happens to hold. New rows (including
+        ones deleted since this instance was loaded) are saved in full."""
+        if self.pk is not None and not kwargs.get('update_fields') and Repository.objects.filter(pk=self.pk).exists():
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in self.export_bookkeeping_fields]
         super(Repository, self).save(*args, **kwargs)
-        tasks.export.delay(self.id)
+        self.schedule_export()
 
     @property
     def base_url(self):
@@ -94,3 +176,11 @@ class Repository(models.Model):
         if self.extra_admins.filter(user=user).exists():
             return True
         return False
+
+
+def get_export_debounce():
+    return getattr(settings, 'AASEMBLE_BUILDSVC_EXPORT_DEBOUNCE', 5)
+
+
+def get_export_timeout():
+    return getattr(settings, 'AASEMBLE_BUILDSVC_EXPORT_TIMEOUT', 3600)
@@ -12,6 +12,17 @@ class Series(models.Model):
     source_package_versions = models.ManyToManyField('SourcePackageVersion')
     binary_package_versions = models.ManyToManyField('BinaryPackageVersion')
 
+    # JSON object mapping the path of each file generated by the last
+    # export to the sha256 digest of its contents.
+    exported_digests = models.TextField(default='{}', editable=False)
+
+    # JSON object mapping the path of each index to the sha256 digests of
+    # its most recent versions (newest first) still available by hash.
+    by_hash_history = models.TextField(default='{}', editable=False)
+
+    export_bookkeeping_fields = ('exported_digests',
+                                 'by_hash_history')
+
     def __str__(self):
         return '%s/%s' % (self.repository.name, self.name)
 
@@ -34,12 +45,24 @@ class Series(models.Model):
     class Meta:
         verbose_name_plural = 'series'
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not kwargs.get('update_fields'):
+            # The export bookkeeping fields are maintained by the repository
+            # driver. Don't clobber them with whatever values this instance
+            # happens to hold.
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in self.export_bookkeeping_fields]
+        super(Series, self).save(*args, **kwargs)
+
     def process_changes(self, changes_file):
         self.repository.process_changes(self.name, changes_file)
 
     def import_deb(self, path):
         self.repository.import_deb(self.name, path)
 
+    def import_debs(self, paths):
+        self.repository.import_debs(self.name, paths)
+
     def import_dsc(self, path):
         self.repository.import_dsc(self.name, path)
 
@@ -59,5 +82,8 @@ class Series(models.Model):
     def export(self):
         self.repository.export()
 
+    def schedule_export(self):
+        self.repository.schedule_export()
+
     def user_can_modify(self, user):
         return self.repository.user_can_modify(user)
@@ -1,4 +1,3 @@
-import hashlib
 import os.path
 import re
 from collections import OrderedDict
@@ -9,6 +8,7 @@ from debian.debian_support import version_compare
 
 from django.db import models
 
+from aasemble.django.apps.buildsvc import storage, utils
 from aasemble.django.apps.buildsvc.models.source_package import SourcePackage
 
 VALID_FORMATS = ('1.0',
@@ -110,27 +110,36 @@ def _kwargs_from_control(control, repository, dsc_file, files):
         elif k_lower in lower_known_fields:
             kwargs[k.lower().replace('-', '_')] = control[k]
         elif k_lower in ('checksums-sha1', 'checksums-sha256', 'files'):
-            hashfunc = {'files': hashlib.md5,
-                        'checksums-sha1': hashlib.sha1,
-                        'checksums-sha256': hashlib.sha256}[k_lower]
+            digest_name = {'files': 'md5',
+                           'checksums-sha1': 'sha1',
+                           'checksums-sha256': 'sha256'}[k_lower]
             for checksum, size, fname in [l.strip().split() for l in control[k].split('\n') if l.strip()]:
                 if '/' in fname:
                     raise SourcePackageValidationException('No slashes allowed in file names')
 
                 fpath = os.path.join(os.path.dirname(dsc_file), fname)
 
-                digest = hashfunc(open(fpath, 'rb').read()).hexdigest()
+                # Each file is hashed once, no matter how many checksum
+                # fields refer to it.
+                if fpath not in files:
+                    files[fpath] = utils.get_fileinfo(fpath)
+
+                digest = files[fpath][digest_name]
 
                 if digest != checksum:
                     raise SourcePackageValidationException('Checksum validation failed. %s != %s (%s)' % (digest, checksum, fname))
-                else:
-                    if fpath not in files:
-                        files[fpath] = {}
-
-                    files[fpath][k_lower] = checksum
     return kwargs
 
 
+class SourcePackageVersionQuerySet(models.QuerySet):
+    def for_index(self):
+        """Fetches everything format_for_sources() needs up front, so
+        rendering a Sources index takes a fixed number of queries no
+        matter how many package versions it holds."""
+        return (self.select_related('source_package')
+                .prefetch_related('sourcepackageversionfile_set'))
+
+
 class SourcePackageVersion(models.Model):
     source_package = models.ForeignKey(SourcePackage)
     binary = models.TextField()
@@ -146,6 +155,12 @@ class SourcePackageVersion(models.Model):
     format = models.CharField(max_length=50)
     package_source = models.ForeignKey('PackageSource', null=True)
 
+    # The stanza last rendered for the Sources index. Cleared whenever
+    # anything it is derived from changes.
+    sources_stanza = models.TextField(null=True, editable=False)
+
+    objects = SourcePackageVersionQuerySet.as_manager()
+
     def __str__(self):
         return '%s_%s' % (self.source_package, self.version)
 
@@ -170,6 +185,14 @@ class SourcePackageVersion(models.Model):
         data['Checksums-Sha256'] = ''.join(['\n %s %s %s' % (spvf.sha256sum, spvf.size, spvf.filename) for spvf in all_spvf])
         return str(data)
 
+    def cached_format_for_sources(self):
+        """Like format_for_sources(), but only renders the stanza if
+        it has not been rendered by a previous export"""
+        if self.sources_stanza is None:
+            self.sources_stanza = self.format_for_sources()
+            self.save(update_fields=['sources_stanza'])
+        return self.sources_stanza
+
     @classmethod
     def does_series_already_have_this_or_newer_version(cls, series, sp, version):
         current_spv = series.source_package_versions.filter(source_package=sp)
@@ -182,8 +205,9 @@ class SourcePackageVersion(models.Model):
     def import_file(cls, series, dsc_file, package_source=None):
         control = _extract_info_from_dsc(dsc_file)
 
+        # Maps the path of every file in the source package to its fileinfo
         files = OrderedDict()
-        files[dsc_file] = {}
+        files[dsc_file] = utils.get_fileinfo(dsc_file)
 
         kwargs = _kwargs_from_control(control, series.repository, dsc_file, files)
 
@@ -191,16 +215,13 @@ class SourcePackageVersion(models.Model):
 
         fileobjs = []
 
-        for f in files:
-            with open(f, 'rb') as fp:
-                contents = fp.read()
-
+        for f, fileinfo in files.items():
             kwargs2 = {'filename': f.split('/')[-1],
                        'file_type': guess_ftype_from_filename(f),
-                       'md5sum': hashlib.md5(contents).hexdigest(),
-                       'sha1sum': hashlib.sha1(contents).hexdigest(),
-                       'sha256sum': hashlib.sha256(contents).hexdigest(),
-                       'size': len(contents)}
+                       'md5sum': fileinfo['md5'],
+                       'sha1sum': fileinfo['sha1'],
+                       'sha256sum': fileinfo['sha256'],
+                       'size': fileinfo['size']}
             spvf = SourcePackageVersionFile(**kwargs2)
             spvf.original_filename = f
             fileobjs += [spvf]
@@ -223,7 +244,13 @@ class SourcePackageVersion(models.Model):
         for f in fileobjs:
             f.source_package_version = spv
             f.save()
-            f.store(f.original_filename)
+
+        storage_driver = storage.get_repository_storage_driver()
+        storage.raise_for_errors(storage_driver.save_many([(f.pool_path, f.original_filename, f.sha256sum)
+                                                           for f in fileobjs]))
+
+        spv.sources_stanza = None
+        spv.save(update_fields=['sources_stanza'])
 
         series.source_package_versions.add(spv)
         return spv
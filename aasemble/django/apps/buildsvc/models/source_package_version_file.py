@@ -1,6 +1,5 @@
 import os.path
 
-from django.core.files.base import File
 from django.db import models
 
 from aasemble.django.apps.buildsvc import storage
@@ -30,14 +29,16 @@ class SourcePackageVersionFile(models.Model):
     def __str__(self):
         return '%s' % (self.filename,)
 
+    @property
+    def pool_path(self):
+        return os.path.join(self.source_package_version.source_package.repository.user.username,
+                            self.source_package_version.source_package.repository.name,
+                            self.source_package_version.source_package.directory,
+                            self.filename)
+
     def store(self, fpath):
-        destpath = os.path.join(self.source_package_version.source_package.repository.user.username,
-                                self.source_package_version.source_package.repository.name,
-                                self.source_package_version.source_package.directory,
-                                self.filename)
         storage_driver = storage.get_repository_storage_driver()
-        with open(fpath, 'rb') as fp:
-            storage_driver.save(destpath, File(fp))
+        storage_driver.save_pool_file(self.pool_path, fpath, self.sha256sum)
 
     class Meta:
         unique_together = ('source_package_version', 'file_type')
@@ -0,0 +1,176 @@
+"""A pool of warm GCE build nodes.
+
+Launching a node and waiting for its startup script to install
+aasemble-pkgbuild takes minutes, so with the PooledGCENode executor we
+keep a number of provisioned, idle nodes around. Builds lease one, and
+hand it back when they are done. By default, it is then retired and
+replaced by a fresh node, so the pool only hides the launch time. If
+nodes are allowed to run more builds, they are reset in between. That
+only removes the workspace, so a build can see what earlier builds (of
+any user's packages) left behind elsewhere on the node.
+
+maintain_pool() (run periodically and whenever a node is leased) keeps
+one spare node for each build in progress. Builds waiting in the Celery
+queue can't be counted, but they tend to arrive in bursts alongside the
+ones running, so this 1:1 headroom stands in for the queue depth."""
+import datetime
+import logging
+import uuid
+
+from django.conf import settings
+from django.utils.timezone import now
+
+from aasemble.django.apps.buildsvc import executors, tasks
+from aasemble.django.apps.buildsvc.models import Build, BuildNode
+
+LOG = logging.getLogger(__name__)
+
+# Nodes stuck provisioning (or retiring) for longer than this are destroyed
+STALE_AFTER = datetime.timedelta(minutes=30)
+
+
+class NoBuildNodeAvailable(Exception):
+    pass
+
+
+def get_pool_min_idle():
+    return getattr(settings, 'AASEMBLE_BUILDSVC_GCE_POOL_MIN_IDLE', 1)
+
+
+def get_pool_max_size():
+    return getattr(settings, 'AASEMBLE_BUILDSVC_GCE_POOL_MAX_SIZE', 10)
+
+
+def get_pool_max_builds_per_node():
+    return getattr(settings, 'AASEMBLE_BUILDSVC_GCE_POOL_MAX_BUILDS_PER_NODE', 1)
+
+
+def get_pool_lease_timeout():
+    return getattr(settings, 'AASEMBLE_BUILDSVC_GCE_POOL_LEASE_TIMEOUT', 6 * 60 * 60)
+
+
+def pool_enabled():
+    return executors.get_executor_class() is executors.PooledGCENode
+
+
+def new_node_name():
+    return 'aasemble-pool-%s' % (uuid.uuid4().hex[:12],)
+
+
+def lease_node():
+    """Leases an idle node. Returns None if there are none."""
+    for build_node in BuildNode.objects.filter(state=BuildNode.IDLE).order_by('state_changed'):
+        if build_node.transition(BuildNode.IDLE, BuildNode.LEASED):
+            return build_node
+    return None
+
+
+def provision_node(build_node, state=BuildNode.IDLE):
+    """Launches build_node and waits until it's ready for builds, then moves
+    it to state. Returns whether it succeeded."""
+    executor = executors.GCENode(build_node.name)
+    try:
+        executor.launch()
+        executor.run_cmd(executors.WAIT_FOR_PKGBUILD_CMD, logger=LOG)
+    except Exception:
+        LOG.exception('Failed to provision build node %s' % (build_node,))
+        destroy_node(build_node)
+        return False
+
+    if not build_node.transition(BuildNode.PROVISIONING, state, public_ip=executor.public_ip):
+        # Retired while we were busy
+        destroy_node(build_node)
+        return False
+
+    return True
+
+
+def provision_node_for_lease():
+    """Provisions a node and leases it straight away."""
+    build_node = BuildNode.objects.create(name=new_node_name())
+    if not provision_node(build_node, state=BuildNode.LEASED):
+        raise NoBuildNodeAvailable('Failed to provision build node %s' % (build_node,))
+    return build_node
+
+
+def release_node(build_node, executor):
+    """Hands build_node back to the pool after a build, resetting it first.
+    Nodes that have done enough builds or cannot be reset are retired."""
+    builds = build_node.builds + 1
+    if builds < get_pool_max_builds_per_node():
+        try:
+            executor.reset()
+        except Exception:
+            LOG.exception('Failed to reset build node %s' % (build_node,))
+        else:
+            if build_node.transition(BuildNode.LEASED, BuildNode.IDLE, builds=builds):
+                return
+
+    retire_node(build_node, BuildNode.LEASED)
+
+
+def retire_node(build_node, from_state):
+    """Destroys build_node, unless it has moved on from from_state. Returns
+    whether it did."""
+    if not build_node.transition(from_state, BuildNode.RETIRING):
+        return False
+    destroy_node(build_node)
+    return True
+
+
+def destroy_node(build_node):
+    executors.GCENode(build_node.name).destroy_by_name()
+    build_node.delete()
+
+
+def get_builds_in_progress():
+    return Build.objects.filter(state=Build.BUILDING, build_finished__isnull=True).count()
+
+
+def remove_stale_nodes():
+    cutoff = now() - STALE_AFTER
+    for build_node in BuildNode.objects.filter(state__in=[BuildNode.PROVISIONING, BuildNode.RETIRING],
+                                               state_changed__lt=cutoff):
+        LOG.warning('Destroying stale build node %s' % (build_node,))
+        destroy_node(build_node)
+
+    # Leased for longer than any build should take, so the worker that
+    # leased it probably died without handing it back.
+    cutoff = now() - datetime.timedelta(seconds=get_pool_lease_timeout())
+    for build_node in BuildNode.objects.filter(state=BuildNode.LEASED, state_changed__lt=cutoff):
+        if retire_node(build_node, BuildNode.LEASED):
+            LOG.warning('Destroyed build node %s, which was never handed back' % (build_node,))
+
+
+def maintain_pool(demand=None):
+    """Provisions or retires idle nodes so there are demand of them (but
+    at least AASEMBLE_BUILDSVC_GCE_POOL_MIN_IDLE), without the pool growing
+    beyond AASEMBLE_BUILDSVC_GCE_POOL_MAX_SIZE nodes. demand defaults to
+    the number of builds in progress, i.e. one spare node per running
+    build, on top of the node it has leased.
+
+    Returns the number of nodes added (negative if nodes were retired)."""
+    if demand is None:
+        demand = get_builds_in_progress()
+
+    remove_stale_nodes()
+
+    leased = BuildNode.objects.filter(state=BuildNode.LEASED).count()
+    spare = BuildNode.objects.filter(state__in=[BuildNode.PROVISIONING, BuildNode.IDLE]).count()
+    target = min(max(get_pool_min_idle(), demand), max(get_pool_max_size() - leased, 0))
+
+    if spare < target:
+        for i in range(target - spare):
+            build_node = BuildNode.objects.create(name=new_node_name())
+            tasks.provision_build_node.delay(build_node.id)
+        return target - spare
+
+    retired = 0
+    for build_node in BuildNode.objects.filter(state=BuildNode.IDLE).order_by('state_changed')[:spare - target]:
+        if retire_node(build_node, BuildNode.IDLE):
+            retired += 1
+    return -retired
+
+
+def schedule_maintenance():
+    tasks.maintain_build_node_pool.delay()
@@ -2,9 +2,11 @@ from __future__ import absolute_import
 
 import argparse
 
+import errno
 import json
 import logging
 import os
+import shutil
 import sys
 
 import dbuild
@@ -22,6 +24,9 @@ import yaml
 
 LOG = logging.getLogger(__name__)
 
+# Prefixes the line "aasemble-pkgbuild run" reports its result on
+RESULT_MARKER = 'aasemble-pkgbuild-result: '
+
 
 class BuilderBackend(object):
     def __init__(self, proxy=None, parallel=1):
@@ -67,6 +72,9 @@ def fetch_build_file(path):
 
 
 def fetch_build(build_id):
+    if isinstance(build_id, dict):
+        # Already fetched
+        return build_id
     if build_id.startswith('http://') or build_id.startswith('https://'):
         return fetch_build_http(build_id)
     elif os.path.exists(build_id):
@@ -76,8 +84,10 @@ def fetch_build(build_id):
 
 class PackageBuilder(object):
     def __init__(self, basedir, build_record, backend_name='dbuild',
-                 full_name='Name not specified', email='build@example.com', **kwargs):
+                 full_name='Name not specified', email='build@example.com',
+                 git_cache=None, **kwargs):
         self.basedir = basedir
+        self.git_cache = git_cache
         self.build_dependencies = []
         self.runtime_dependencies = []
         self.build_record = fetch_build(build_record)
@@ -85,6 +95,7 @@ class PackageBuilder(object):
         self.email = email
         self.logger = LOG
         self.backend = get_build_backend(backend_name, **kwargs)
+        self._aasemble_config = None
 
     @property
     def builddir(self):
@@ -95,19 +106,79 @@ class PackageBuilder(object):
         return self.build_record['build_counter']
 
     def checkout(self):
+        git_url = self.build_record['source']['git_repository']
+        branch = self.build_record['source']['git_branch']
+        sha = self.build_record['sha']
+
+        if self.git_cache is not None:
+            self.git_cache.clone(git_url, branch, self.builddir, sha=sha)
+            return
+
+        if sha is not None and self.shallow_checkout(git_url, sha):
+            return
+
+        self.full_checkout(git_url, branch, sha)
+
+    def full_checkout(self, git_url, branch, sha):
         from aasemble.utils import run_cmd
 
         run_cmd(['git',
-                 'clone', self.build_record['source']['git_repository'],
+                 'clone', git_url,
                  '--recursive',
-                 '-b', self.build_record['source']['git_branch'],
+                 '-b', branch,
                  self.builddir], logger=self.logger)
         cmd = ['git', 'reset', '--hard']
-        build_id = self.build_record['sha']
-        if build_id is not None:
-            cmd.append(build_id)
+        if sha is not None:
+            cmd.append(sha)
         run_cmd(cmd, cwd=self.builddir, logger=self.logger)
 
+    def shallow_checkout(self, git_url, sha):
+        """Fetches nothing but sha (and shallow submodules) into builddir.
+
+        Returns False (leaving builddir empty) if a full checkout is needed
+        instead: because the source asks for one, the builder needs the
+        history or the server refuses to hand out sha on its own."""
+        from aasemble.utils import run_cmd
+        from aasemble.utils.exceptions import CommandFailed
+
+        run_cmd(['git', 'init', self.builddir], logger=self.logger)
+        run_cmd(['git', 'remote', 'add', 'origin', git_url], cwd=self.builddir, logger=self.logger)
+        try:
+            run_cmd(['git', 'fetch', '--depth', '1', 'origin', sha], cwd=self.builddir, logger=self.logger)
+            run_cmd(['git', 'checkout', '-q', 'FETCH_HEAD'], cwd=self.builddir, logger=self.logger)
+
+            try:
+                wants_full_checkout = self.wants_full_checkout()
+            finally:
+                # That looked at a provisional tree (without submodules and
+                # possibly about to be replaced), so later phases must not
+                # go by what was detected or parsed.
+                remove_manifest(self.builddir)
+                self._aasemble_config = None
+
+            if wants_full_checkout:
+                self.logger.info('Full history needed. Not doing a shallow checkout.')
+                shutil.rmtree(self.builddir)
+                return False
+
+            run_cmd(['git', 'submodule', 'update', '--init', '--recursive', '--depth', '1'],
+                    cwd=self.builddir, logger=self.logger)
+        except CommandFailed:
+            self.logger.info('Shallow checkout failed. Falling back to a full checkout.')
+            shutil.rmtree(self.builddir)
+            return False
+
+        return True
+
+    def wants_full_checkout(self):
+        """Whether the build needs the history of the source. Sources can say
+        so explicitly with checkout: {shallow: true/false} in .aasemble.yml.
+        Otherwise, it's up to the builder that will be building it."""
+        shallow = self.get_aasemble_config().get('checkout', {}).get('shallow')
+        if shallow is not None:
+            return not shallow
+        return choose_builder(self.builddir).needs_history(self.builddir)
+
     def source_build(self):
         self.logger.debug('Using %s to build' % (type(self)))
 
@@ -154,11 +225,20 @@ class PackageBuilder(object):
         return self.get_aasemble_config().get('build', {})
 
     def get_aasemble_config(self):
+        if self._aasemble_config is not None:
+            return self._aasemble_config
+
         aasemble_config = os.path.join(self.builddir, '.aasemble.yml')
         if os.path.exists(aasemble_config):
             with open(aasemble_config, 'r') as fp:
-                return yaml.load(fp)
-        return {}
+                config = yaml.load(fp) or {}
+        else:
+            config = {}
+
+        # Until the source has been checked out, there's nothing to remember
+        if os.path.isdir(self.builddir):
+            self._aasemble_config = config
+        return config
 
     def detect_runtime_dependencies(self):
         return []
@@ -260,6 +340,10 @@ class PackageBuilder(object):
     def is_suitable(cls, path):
         return False
 
+    @classmethod
+    def needs_history(cls, path):
+        return False
+
 
 class PackageBuilderRegistry(object):
     builders = []
@@ -269,12 +353,123 @@ class PackageBuilderRegistry(object):
         cls.builders.append(builder)
 
 
+# How deep into the source tree to look when detecting languages
+DETECTION_DEPTH = 3
+
+LANGUAGE_EXTENSIONS = {'.go': 'golang'}
+
+
+def manifest_path(path):
+    # Next to the source tree rather than in it, so it does not end up in
+    # the source package
+    return os.path.join(os.path.dirname(os.path.abspath(path)), '.aasemble-manifest.json')
+
+
+def load_manifest(path):
+    """Returns what has been detected about the source tree at path so far
+    (by this or an earlier aasemble-pkgbuild invocation)."""
+    try:
+        with open(manifest_path(path), 'r') as fp:
+            return json.load(fp)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return {}
+
+
+def update_manifest(path, **kwargs):
+    # Until the source has been checked out, there's nothing to remember
+    if not os.path.isdir(path):
+        return
+    manifest = load_manifest(path)
+    manifest.update(kwargs)
+    with open(manifest_path(path), 'w') as fp:
+        json.dump(manifest, fp)
+
+
+def remove_manifest(path):
+    try:
+        os.unlink(manifest_path(path))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def scan_languages(path, max_depth=DETECTION_DEPTH):
+    """Looks for source files of the languages in LANGUAGE_EXTENSIONS at
+    most max_depth directories deep, stopping as soon as all of them have
+    been found."""
+    wanted = set(LANGUAGE_EXTENSIONS.values())
+    languages = set()
+    top_depth = os.path.abspath(path).count(os.sep)
+    for root, dirs, files in os.walk(os.path.abspath(path)):
+        if '.git' in dirs:
+            dirs.remove('.git')
+        for f in files:
+            language = LANGUAGE_EXTENSIONS.get(os.path.splitext(f)[1])
+            if language is not None:
+                languages.add(language)
+        if languages == wanted:
+            break
+        if root.count(os.sep) - top_depth >= max_depth:
+            del dirs[:]
+    return sorted(languages)
+
+
+def detect_languages(path):
+    languages = load_manifest(path).get('languages')
+    if languages is None:
+        languages = scan_languages(path)
+        update_manifest(path, languages=languages)
+    return languages
+
+
 def choose_builder(path):
+    builder_name = load_manifest(path).get('builder')
+    for builder in PackageBuilderRegistry.builders:
+        if builder.__name__ == builder_name:
+            return builder
+
     for builder in PackageBuilderRegistry.builders:
         if builder.is_suitable(path):
+            update_manifest(path, builder=builder.__name__)
             return builder
 
 
+def report_result(result, fp=None):
+    """Writes result where whoever runs "aasemble-pkgbuild run" can find
+    it: on a line of its own, prefixed with RESULT_MARKER."""
+    fp = fp or sys.stdout
+    fp.write('\n%s%s\n' % (RESULT_MARKER, json.dumps(result)))
+    fp.flush()
+
+
+def run_build(basedir, build_record, report=None, **kwargs):
+    """Checks out and builds the source in one go, fetching the build
+    record and working out the version and name just once.
+
+    Returns a dict with the name of the builder used and the version and
+    name of the package. If given, report is called with it before the
+    build starts, so it is known even if the build fails."""
+    build_record = fetch_build(build_record)
+
+    PackageBuilder(basedir, build_record, **kwargs).checkout()
+
+    builder_class = choose_builder(os.path.join(basedir, 'build'))
+    builder = builder_class(basedir, build_record, **kwargs)
+
+    result = {'builder': builder_class.__name__,
+              'version': builder.package_version,
+              'name': builder.sanitized_package_name}
+    if report is not None:
+        report(result)
+
+    builder.source_build()
+    builder.binary_build()
+
+    return result
+
+
 def main(argv=sys.argv[1:]):
     if not settings.configured:
         settings.configure(TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -289,7 +484,9 @@ def main(argv=sys.argv[1:]):
     parser.add_argument('--fullname', default='aaSemble Build Service', help='Full name to use in changelog')
     parser.add_argument('--email', default='autobuild@aasemble.com', help='E-mail to use in changelog')
     parser.add_argument('--backend', default='dbuild', help='Builder backend [default=dbuild]')
-    parser.add_argument('action', choices=['source-build', 'binary-build', 'name', 'version', 'checkout'])
+    parser.add_argument('--git-cache-dir', help='Directory to keep mirrors of git repositories in')
+    parser.add_argument('--git-cache-size', type=int, help='Maximum size of the git cache in MB')
+    parser.add_argument('action', choices=['source-build', 'binary-build', 'name', 'version', 'checkout', 'run'])
     parser.add_argument('build_record', help='build_record ID (URL)')
 
     options = parser.parse_args(argv)
@@ -299,11 +496,26 @@ def main(argv=sys.argv[1:]):
     from . import golang  # noqa
     from . import generic  # noqa
 
+    if options.git_cache_dir:
+        from .gitcache import GitMirrorCache
+        max_size = options.git_cache_size and options.git_cache_size * 1024 * 1024
+        git_cache = GitMirrorCache(options.git_cache_dir, max_size=max_size)
+    else:
+        git_cache = None
+
+    builder_kwargs = {'backend_name': options.backend,
+                      'full_name': options.fullname,
+                      'email': options.email,
+                      'git_cache': git_cache,
+                      'parallel': options.parallel,
+                      'proxy': options.proxy}
+
+    if options.action == 'run':
+        run_build(options.basedir, options.build_record, report=report_result, **builder_kwargs)
+        return
+
     builder_class = choose_builder(options.basedir + '/build')
-    builder = builder_class(options.basedir, options.build_record,
-                            backend_name=options.backend,
-                            parallel=options.parallel,
-                            proxy=options.proxy)
+    builder = builder_class(options.basedir, options.build_record, **builder_kwargs)
 
     if options.action == 'version':
         sys.stdout.write(builder.package_version)
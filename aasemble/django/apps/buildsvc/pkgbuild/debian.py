@@ -4,6 +4,8 @@ import os.path
 
 import debian.deb822
 
+from django.utils.functional import cached_property
+
 from aasemble.django.apps.buildsvc.pkgbuild import PackageBuilder, PackageBuilderRegistry
 from aasemble.utils import run_cmd
 
@@ -13,7 +15,7 @@ class DebianBuilder(PackageBuilder):
     def is_suitable(cls, path):
         return os.path.isdir(os.path.join(path, 'debian'))
 
-    @property
+    @cached_property
     def native_version(self):
         cmd = ['dpkg-parsechangelog', '--show-field', 'Version']
         v = run_cmd(cmd, cwd=self.builddir).strip().decode()
@@ -23,7 +25,7 @@ class DebianBuilder(PackageBuilder):
             v = v.split('-')[0]
         return v
 
-    @property
+    @cached_property
     def package_name(self):
         ctrl = debian.deb822.Deb822(open(os.path.join(self.builddir, 'debian/control'), 'r'))
         return ctrl['Source']
@@ -0,0 +1,199 @@
+"""Local cache of bare git mirrors.
+
+Each repository a build checks out (submodules included) gets a mirror
+under the cache directory. Mirrors are fetched into incrementally, so a
+checkout only transfers what changed since the last build of the same
+repository. The least recently used mirrors are evicted once the cache
+grows beyond its maximum size.
+
+Each mirror has a lock file next to it. Updating or evicting a mirror
+takes an exclusive lock, while builds hold a shared lock for as long as
+they use the mirror."""
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from aasemble.utils import run_cmd
+from aasemble.utils.exceptions import CommandFailed
+
+LOG = logging.getLogger(__name__)
+
+
+def directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+    return size
+
+
+class GitMirrorCache(object):
+    def __init__(self, cache_dir, max_size=None, logger=LOG):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.logger = logger
+
+    def mirror_path(self, git_url):
+        return os.path.join(self.cache_dir, hashlib.sha1(git_url.encode('utf-8')).hexdigest() + '.git')
+
+    def lock_path(self, mirror_path):
+        return mirror_path + '.lock'
+
+    @contextmanager
+    def lock(self, mirror_path, blocking=True, shared=False):
+        """Holds an exclusive (or shared) lock on mirror_path. Yields whether
+        the lock was acquired, which is always the case when blocking."""
+        lock_path = self.lock_path(mirror_path)
+        flags = shared and fcntl.LOCK_SH or fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+
+        while True:
+            fp = open(lock_path, 'a')
+            try:
+                fcntl.flock(fp, flags)
+            except IOError as e:
+                fp.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                yield False
+                return
+
+            # evict() removes the lock file along with the mirror. If that
+            # happened while we were waiting, we hold a lock nobody else
+            # will see, so start over with a fresh lock file.
+            try:
+                current = os.stat(lock_path).st_ino
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                current = None
+            if current == os.fstat(fp.fileno()).st_ino:
+                break
+            fp.close()
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+            fp.close()
+
+    def update(self, git_url):
+        """Creates or updates the mirror of git_url. Returns its path."""
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        path = self.mirror_path(git_url)
+        with self.lock(path):
+            if os.path.isdir(path):
+                run_cmd(['git', 'fetch', '--prune', 'origin'], cwd=path, logger=self.logger)
+            else:
+                tmpdir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp')
+                try:
+                    run_cmd(['git', 'clone', '--mirror', git_url, os.path.join(tmpdir, 'mirror.git')], logger=self.logger)
+                    os.rename(os.path.join(tmpdir, 'mirror.git'), path)
+                finally:
+                    shutil.rmtree(tmpdir)
+            # The mtime of the mirror is what eviction goes by
+            os.utime(path, None)
+        return path
+
+    @contextmanager
+    def mirror(self, git_url):
+        """Creates or updates the mirror of git_url and yields its path,
+        holding a shared lock on it so it can't be evicted while in use."""
+        path = self.mirror_path(git_url)
+        while True:
+            self.update(git_url)
+            with self.lock(path, shared=True):
+                if os.path.isdir(path):
+                    yield path
+                    return
+            # Evicted before we got hold of it
+
+    def clone(self, git_url, branch, dest, sha=None):
+        """Clones branch of git_url into dest, checks out sha (if given)
+        and initialises submodules, getting as much as possible from the
+        cache."""
+        with self.mirror(git_url) as mirror:
+            # A local clone hardlinks the objects, so it stays intact even if
+            # the mirror is evicted later on.
+            run_cmd(['git', 'clone', '-b', branch, mirror, dest], logger=self.logger)
+            run_cmd(['git', 'remote', 'set-url', 'origin', git_url], cwd=dest, logger=self.logger)
+
+            cmd = ['git', 'reset', '--hard']
+            if sha is not None:
+                cmd.append(sha)
+            run_cmd(cmd, cwd=dest, logger=self.logger)
+
+            self.update_submodules(dest)
+        self.evict()
+
+    def submodules(self, path):
+        """Returns a list of (name, path) tuples for the submodules of the
+        checkout at path."""
+        if not os.path.exists(os.path.join(path, '.gitmodules')):
+            return []
+
+        try:
+            out = run_cmd(['git', 'config', '-f', '.gitmodules', '--get-regexp', r'^submodule\..*\.path$'],
+                          cwd=path, logger=self.logger)
+        except CommandFailed:
+            # No submodules listed
+            return []
+
+        submodules = []
+        for line in out.decode().splitlines():
+            key, subpath = line.split(' ', 1)
+            submodules.append((key[len('submodule.'):-len('.path')], subpath))
+        return submodules
+
+    def update_submodules(self, path):
+        submodules = self.submodules(path)
+        if not submodules:
+            return
+
+        # Resolves relative submodule URLs against origin
+        run_cmd(['git', 'submodule', 'init'], cwd=path, logger=self.logger)
+
+        for name, subpath in submodules:
+            url = run_cmd(['git', 'config', '--get', 'submodule.%s.url' % (name,)],
+                          cwd=path, logger=self.logger).strip().decode()
+            with self.mirror(url) as mirror:
+                run_cmd(['git', 'submodule', 'update', '--reference', mirror, '--dissociate', '--', subpath],
+                        cwd=path, logger=self.logger)
+            self.update_submodules(os.path.join(path, subpath))
+
+    def evict(self):
+        """Removes the least recently used mirrors until the cache is no
+        larger than max_size. Mirrors in use are left alone."""
+        if self.max_size is None:
+            return
+
+        mirrors = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.git') and os.path.isdir(path):
+                mirrors.append((os.stat(path).st_mtime, path, directory_size(path)))
+
+        total = sum(size for mtime, path, size in mirrors)
+        for mtime, path, size in sorted(mirrors):
+            if total <= self.max_size:
+                break
+            with self.lock(path, blocking=False) as locked:
+                if not locked:
+                    continue
+                self.logger.info('Evicting %s from git cache' % (path,))
+                shutil.rmtree(path)
+                os.unlink(self.lock_path(path))
+            total -= size
@@ -1,6 +1,4 @@
-import os.path
-
-from ..pkgbuild import PackageBuilder, PackageBuilderRegistry
+from ..pkgbuild import PackageBuilder, PackageBuilderRegistry, detect_languages
 
 
 class GolangBuilder(PackageBuilder):
@@ -9,10 +7,7 @@ class GolangBuilder(PackageBuilder):
 
     @classmethod
     def is_suitable(cls, path):
-        for root, dirs, files in os.walk(path):
-            if any([f.endswith('.go') for f in files]):
-                return True
-        return False
+        return 'golang' in detect_languages(path)
 
 
 PackageBuilderRegistry.register_builder(GolangBuilder)
@@ -1,6 +1,7 @@
 import os.path
 
 from django.template.loader import render_to_string
+from django.utils.functional import cached_property
 
 from aasemble.django.apps.buildsvc.pkgbuild import PackageBuilder, PackageBuilderRegistry
 from aasemble.utils import run_cmd
@@ -11,6 +12,18 @@ class PythonBuilder(PackageBuilder):
     def is_suitable(cls, path):
         return os.path.exists(os.path.join(path, 'setup.py'))
 
+    @classmethod
+    def needs_history(cls, path):
+        """pbr and setuptools_scm derive the version from git tags"""
+        for fname in ('setup.py', 'setup.cfg'):
+            fpath = os.path.join(path, fname)
+            if os.path.exists(fpath):
+                with open(fpath, 'r') as fp:
+                    contents = fp.read()
+                if 'pbr' in contents or 'setuptools_scm' in contents:
+                    return True
+        return False
+
     def retry_if_has_newlines(self, cmd, logger):
         """Sometimes the first run will have noise in it"""
         def run_it():
@@ -23,12 +36,12 @@ class PythonBuilder(PackageBuilder):
 
         return out.decode()
 
-    @property
+    @cached_property
     def native_version(self):
         return self.retry_if_has_newlines(['python', 'setup.py', '--version'],
                                           logger=self.logger)
 
-    @property
+    @cached_property
     def package_name(self):
         return self.retry_if_has_newlines(['python', 'setup.py', '--name'],
                                           logger=self.logger)
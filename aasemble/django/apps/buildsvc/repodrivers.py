@@ -1,22 +1,25 @@
-import gzip as gzipmod
 import hashlib
+import json
 import logging
 import os.path
-import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 
 import deb822
 
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.cache import cache
+from django.core.files.base import ContentFile, File
+from django.db import connection
 from django.template.loader import render_to_string
 from django.utils.module_loading import import_string
 
 import gnupg
 
-from six import BytesIO
-
-from aasemble.django.apps.buildsvc import storage
+from aasemble.django.apps.buildsvc import indexes, storage
+from aasemble.django.apps.buildsvc.models.architecture import Architecture
 from aasemble.django.apps.buildsvc.models.binary_package_version import BinaryPackageVersion
+from aasemble.django.apps.buildsvc.models.series import Series
 from aasemble.django.apps.buildsvc.models.source_package_version import SourcePackageVersion
 from aasemble.django.common.utils import user_has_feature
 from aasemble.django.utils import recursive_render
@@ -25,11 +28,25 @@ from aasemble.utils import ensure_dir, run_cmd
 LOG = logging.getLogger(__name__)
 
 
+_gpg_instances = {}
+_gpg_instances_lock = threading.Lock()
+
+
+def get_gpg(gnupghome):
+    """Returns a GPG wrapper for gnupghome, shared by every signature
+    driver in this process. Setting one up spawns gpg to probe its
+    version, so there's no point in doing it over and over."""
+    with _gpg_instances_lock:
+        if gnupghome not in _gpg_instances:
+            _gpg_instances[gnupghome] = gnupg.GPG(gnupghome=gnupghome)
+        return _gpg_instances[gnupghome]
+
+
 class RepositorySignatureDriver(object):
     EXPIRE_DATE_NEVER_EXPIRES = 0
 
     def __init__(self, home=None):
-        self.gnupg = gnupg.GPG(gnupghome=self.get_default_gpghome())
+        self.gnupg = get_gpg(self.get_default_gpghome())
 
     def get_default_gpghome(self):
         return getattr(settings, 'BUILDSVC_GPGHOME', None)
@@ -47,18 +64,24 @@ class RepositorySignatureDriver(object):
         if repository.key_id:
             return self.gnupg.export_keys([repository.key_id]).encode('utf-8')
 
+    def _cached_signature(self, kind, contents, key_id, sign):
+        """Signatures are cached by key ID and the digest of what was
+        signed, so exporting an unchanged series never signs again."""
+        cache_key = 'buildsvc-signature:%s:%s:%s' % (kind, key_id, hashlib.sha256(contents).hexdigest())
+        signature = cache.get(cache_key)
+        if signature is None:
+            signature = sign()
+            if signature:
+                cache.set(cache_key, signature, get_signature_cache_timeout())
+        return signature
+
     def sign_inline(self, contents, key_id):
-        return str(self.gnupg.sign(contents, keyid=key_id)).encode('utf-8')
+        return self._cached_signature('inline', contents, key_id,
+                                      lambda: self.gnupg.sign(contents, keyid=key_id).data)
 
     def get_signature(self, contents, key_id):
-        fd, tmpfile = tempfile.mkstemp()
-        try:
-            os.close(fd)
-            self.gnupg.sign(contents, detach=True, output=tmpfile, keyid=key_id)
-            with open(tmpfile, 'rb') as fp:
-                return fp.read()
-        finally:
-            os.unlink(tmpfile)
+        return self._cached_signature('detached', contents, key_id,
+                                      lambda: self.gnupg.sign(contents, detach=True, keyid=key_id).data)
 
 
 class FakeRepositorySignatureDriver(RepositorySignatureDriver):
@@ -95,12 +118,15 @@ class RepositoryDriver(object):
         self.reposity_signature_driver = get_repository_signature_driver()
 
     def ensure_key(self):
+        # This runs as part of an export, so update the key fields directly
+        # rather than through save(), which would schedule another export.
+        repositories = type(self.repository).objects.filter(id=self.repository.id)
         if not self.repository.key_id:
             self.repository.key_id = self.generate_key()
-            self.repository.save()
+            repositories.update(key_id=self.repository.key_id)
         if not self.repository.key_data:
             self.repository.key_data = self.key_data().decode('utf-8')
-            self.repository.save()
+            repositories.update(key_data=self.repository.key_data)
 
     def generate_key(self):
         """Generates key if one does not already exist.
@@ -126,6 +152,14 @@ class RepositoryDriver(object):
         process_changes. Not both."""
         raise NotImplementedError()
 
+    def import_debs(self, series_name, fpaths):
+        """Import a number of debs into the given series
+
+        Drivers that can do better than importing them one at a
+        time should override this."""
+        for fpath in fpaths:
+            self.import_deb(series_name, fpath)
+
     def import_dsc(self, series_name, fpath):
         """Import dsc into the given series
 
@@ -142,6 +176,10 @@ class RepositoryDriver(object):
 
 
 class AasembleDriver(RepositoryDriver):
+    # The pool layout has no notion of other components (yet), so
+    # everything lives in main.
+    components = ['main']
+
     def __init__(self, *args, **kwargs):
         self.storage = storage.get_repository_storage_driver()
         super(AasembleDriver, self).__init__(*args, **kwargs)
@@ -152,99 +190,233 @@ class AasembleDriver(RepositoryDriver):
     def key_data(self):
         return self.reposity_signature_driver.key_data(self.repository)
 
-    def get_metadata(self, contents):
-        return {'size': len(contents),
-                'md5': hashlib.md5(contents).hexdigest(),
-                'sha1': hashlib.sha1(contents).hexdigest(),
-                'sha256': hashlib.sha256(contents).hexdigest()}
-
-    def store(self, path, contents, metadata, gzip=False, bzip2=False):
-        metadata[path] = self.get_metadata(contents)
-        self.storage.save(path, ContentFile(contents), overwrite=True)
-        if gzip:
-            gzpath = path + '.gz'
-            fp = BytesIO()
-            with gzipmod.GzipFile(fileobj=fp, mode='wb') as gzfp:
-                gzfp.write(contents)
-                gzfp.close()
-            metadata[gzpath] = self.get_metadata(fp.getvalue())
-            self.storage.save(gzpath, ContentFile(fp.getvalue()), overwrite=True)
-        if bzip2:
-            bzpath = path + '.bz2'
-            bzdata = bzip2.compress(contents)
-            metadata[bzpath] = self.get_metadata(bzdata)
-            self.storage.save(bzpath, ContentFile(bzdata), overwrite=True)
+    def store(self, path, contents, metadata, gzip=False, bzip2=False, xz=False, digests=None, by_hash=None):
+        """Stores contents (a byte string or an iterable of byte strings)
+        at path, optionally along with compressed variants.
+
+        Everything is streamed through temporary files, so memory use
+        does not grow with the size of the index.
+
+        digests, if given, maps paths to the sha256 digest of what was
+        last stored there. Files whose contents have not changed are left
+        alone, and digests is updated for the ones that are written.
+
+        by_hash, if given, is the by-hash history of the series (see
+        record_by_hash()) and makes each file available by hash as well."""
+        self.store_outputs(path, indexes.write_index(contents, gzip=gzip, bzip2=bzip2, xz=xz),
+                           metadata, digests=digests, by_hash=by_hash)
+
+    def store_outputs(self, path, outputs, metadata, digests=None, by_hash=None):
+        """Like store(), but takes the (suffix, fp, metadata) tuples
+        of an index that has already been written with IndexWriter."""
+        try:
+            by_hash_files = []
+            files = []
+            for suffix, fp, file_metadata in outputs:
+                fpath = path + suffix
+                metadata[fpath] = file_metadata
+                if by_hash is not None:
+                    by_hash_path = self.record_by_hash(fpath, file_metadata['sha256'], by_hash)
+                    if not self.storage.exists(by_hash_path):
+                        by_hash_files.append((by_hash_path, File(fp)))
+                if digests is not None:
+                    if digests.get(fpath) == file_metadata['sha256'] and self.storage.exists(fpath):
+                        continue
+                    digests[fpath] = file_metadata['sha256']
+                files.append((fpath, File(fp)))
+
+            # The by-hash copies go first, so they are in place by the
+            # time anything refers to them. Each batch reads every file
+            # at most once, so they can share the file objects.
+            storage.raise_for_errors(self.storage.publish_many(by_hash_files))
+            storage.raise_for_errors(self.storage.publish_many(files))
+        finally:
+            for suffix, fp, file_metadata in outputs:
+                fp.close()
+
+    def by_hash_path(self, path, sha256):
+        return os.path.join(os.path.dirname(path), 'by-hash', 'SHA256', sha256)
+
+    def record_by_hash(self, path, sha256, history):
+        """Returns the path under which the version of path with the given
+        sha256 should be available by hash: by-hash/SHA256/<sha256> next
+        to path.
+
+        Clients that support it fetch indexes by hash, so they always get
+        the ones matching the Release file they have, even if a newer
+        export is being published at the same time.
+
+        history maps paths to the digests of their most recent versions,
+        newest first. prune_by_hash() uses it to remove old versions."""
+        history[path] = [sha256] + [d for d in history.get(path, []) if d != sha256]
+        return self.by_hash_path(path, sha256)
+
+    def prune_by_hash(self, history):
+        """Removes the by-hash files of all but the most recent versions
+        of each index."""
+        retention = get_by_hash_retention()
+        keep = set()
+        remove = set()
+        for path, entries in history.items():
+            keep.update(self.by_hash_path(path, sha256) for sha256 in entries[:retention])
+            remove.update(self.by_hash_path(path, sha256) for sha256 in entries[retention:])
+            history[path] = entries[:retention]
+
+        # Different versions of different files in the same directory might
+        # well have the same contents.
+        for by_hash_path in remove - keep:
+            if self.storage.exists(by_hash_path):
+                self.storage.delete(by_hash_path)
 
     def render_to_bytes(self, tmpl, **context):
         return render_to_string(os.path.join(os.path.dirname(__file__),
                                 'templates/buildsvc/repodriver', tmpl),
                                 context).encode('utf-8')
 
+    def packages_indexes(self, series, architectures):
+        """Writes the Packages indexes for all the given architectures in
+        a single pass over the binary package versions in the series.
+        Each index holds the packages built for its architecture plus the
+        Architecture: all ones. Only versions added since the last export
+        need to be rendered.
+
+        Returns a dict mapping each architecture to the output of
+        IndexWriter.close()."""
+        writers = dict((architecture, indexes.IndexWriter(gzip=True, xz=True)) for architecture in architectures)
+        for bpv in series.binary_package_versions.for_index():
+            if bpv.architecture == 'all':
+                targets = writers.values()
+            elif bpv.architecture in writers:
+                targets = [writers[bpv.architecture]]
+            else:
+                continue
+            stanza = ('%s\n' % (bpv.cached_format_for_packages(),)).encode('utf-8')
+            for writer in targets:
+                writer.write(stanza)
+        return dict((architecture, writer.close()) for architecture, writer in writers.items())
+
+    def sources_index(self, series):
+        """Generates the Sources index for the series one stanza at a
+        time. Only versions added since the last export need to be
+        rendered."""
+        for spv in series.source_package_versions.for_index():
+            yield ('%s\n' % (spv.cached_format_for_sources(),)).encode('utf-8')
+
     def import_dsc(self, series_name, fpath):
-        series = self.repository.series_set.get(name=series_name)
+        series = self.repository.series.get(name=series_name)
         SourcePackageVersion.import_file(series, fpath)
 
     def import_deb(self, series_name, fpath):
-        series = self.repository.series_set.get(name=series_name)
+        series = self.repository.series.get(name=series_name)
         BinaryPackageVersion.import_file(series, fpath)
 
+    def import_debs(self, series_name, fpaths):
+        series = self.repository.series.get(name=series_name)
+        BinaryPackageVersion.import_files(series, fpaths)
+
     def process_changes(self, series_name, changes_file):
         pass
 
     def export(self):
         self.ensure_key()
-        metadata = {}
-        repo_dir = os.path.join(self.repository.user.username,
-                                self.repository.name)
-        dists_dir = os.path.join(repo_dir, 'dists')
-        for series in self.repository.series.all():
-            series_dir = os.path.join(dists_dir,
-                                      series.name)
-            for component in ['main']:
-                for architecture in ['amd64']:
-                    arch_dir = os.path.join(series_dir, component,
-                                            'binary-%s' % (architecture,))
-                    self.store(os.path.join(arch_dir, 'Packages'),
-                               self.render_to_bytes('Packages.tmpl',
-                                                    series=series),
-                               metadata, gzip=True)
-                    self.store(os.path.join(arch_dir, 'Release'),
-                               self.render_to_bytes('archrelease.tmpl',
-                                                    series=series,
-                                                    architecture=architecture,
-                                                    component=component), metadata)
-                for architecture in ['source']:
-                    arch_dir = os.path.join(series_dir,
-                                            component,
-                                            architecture)
-                    self.store(os.path.join(arch_dir, 'Sources'),
-                               self.render_to_bytes('Sources.tmpl',
-                                                    series=series),
-                               metadata=metadata, gzip=True)
-                    self.store(os.path.join(arch_dir, 'Release'),
-                               self.render_to_bytes('archrelease.tmpl',
-                                                    series=series,
-                                                    architecture=architecture,
-                                                    component=component), metadata)
-
-            strip_len = len(series_dir) + 1
+        series_list = list(self.repository.series.all())
+        concurrency = min(get_export_concurrency(), len(series_list))
+        if concurrency > 1:
+            pool = ThreadPool(concurrency)
+            try:
+                pool.map(self._export_series_in_thread, series_list)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for series in series_list:
+                self.export_series(series)
+
+        repo_file = os.path.join(self.repo_dir, 'repo.key')
+        if not self.storage.exists(repo_file):
+            self.storage.save(repo_file, ContentFile(self.repository.key_data))
 
-            files = []
-            for f in sorted(metadata.keys()):
-                metadata[f]['path'] = f[strip_len:]
-                files.append(metadata[f])
+    @property
+    def repo_dir(self):
+        return os.path.join(self.repository.user.username,
+                            self.repository.name)
 
-            release_data = self.render_to_bytes('distrelease.tmpl', series=series, files=files)
+    def _export_series_in_thread(self, series):
+        try:
+            self.export_series(series)
+        finally:
+            # Each thread gets its own database connection. Don't leak it.
+            connection.close()
 
-            self.store(os.path.join(series_dir, 'InRelease'),
+    def export_series(self, series):
+        metadata = {}
+        digests = json.loads(series.exported_digests)
+        by_hash = json.loads(series.by_hash_history)
+        dists_dir = os.path.join(self.repo_dir, 'dists')
+        series_dir = os.path.join(dists_dir,
+                                  series.name)
+        architectures = get_index_architectures()
+        for component in self.components:
+            packages_indexes = self.packages_indexes(series, architectures)
+            for architecture in architectures:
+                arch_dir = os.path.join(series_dir, component,
+                                        'binary-%s' % (architecture,))
+                self.store_outputs(os.path.join(arch_dir, 'Packages'),
+                                   packages_indexes[architecture],
+                                   metadata, digests=digests, by_hash=by_hash)
+                self.store(os.path.join(arch_dir, 'Release'),
+                           self.render_to_bytes('archrelease.tmpl',
+                                                series=series,
+                                                architecture=architecture,
+                                                component=component), metadata, digests=digests, by_hash=by_hash)
+            for architecture in ['source']:
+                arch_dir = os.path.join(series_dir,
+                                        component,
+                                        architecture)
+                self.store(os.path.join(arch_dir, 'Sources'),
+                           self.sources_index(series),
+                           metadata=metadata, gzip=True, xz=True, digests=digests, by_hash=by_hash)
+                self.store(os.path.join(arch_dir, 'Release'),
+                           self.render_to_bytes('archrelease.tmpl',
+                                                series=series,
+                                                architecture=architecture,
+                                                component=component), metadata, digests=digests, by_hash=by_hash)
+
+        strip_len = len(series_dir) + 1
+
+        files = []
+        for f in sorted(metadata.keys()):
+            metadata[f]['path'] = f[strip_len:]
+            files.append(metadata[f])
+
+        release_data = self.render_to_bytes('distrelease.tmpl', series=series, files=files,
+                                            architectures=architectures + ['source'],
+                                            components=self.components)
+
+        release_path = os.path.join(series_dir, 'Release')
+        inrelease_path = os.path.join(series_dir, 'InRelease')
+        release_gpg_path = os.path.join(series_dir, 'Release.gpg')
+
+        # If Release is unchanged, so are the signatures
+        release_changed = any([digests.get(release_path) != hashlib.sha256(release_data).hexdigest(),
+                               not self.storage.exists(inrelease_path),
+                               not self.storage.exists(release_gpg_path)])
+
+        if release_changed:
+            self.store(inrelease_path,
                        self.reposity_signature_driver.sign_inline(release_data, series.repository.key_id), metadata)
-            self.store(os.path.join(series_dir, 'Release'),
-                       release_data, metadata)
-            self.store(os.path.join(series_dir, 'Release.gpg'),
+        self.store(release_path,
+                   release_data, metadata, digests=digests)
+        if release_changed:
+            self.store(release_gpg_path,
                        self.reposity_signature_driver.get_signature(release_data, series.repository.key_id), metadata)
-            repo_file = os.path.join(repo_dir, 'repo.key')
-            if not self.storage.exists(repo_file):
-                self.storage.save(repo_file, ContentFile(self.repository.key_data))
+
+        # Only now that the new Release file is in place can the by-hash
+        # files of older versions go.
+        self.prune_by_hash(by_hash)
+
+        Series.objects.filter(id=series.id).update(exported_digests=json.dumps(digests, sort_keys=True),
+                                                   by_hash_history=json.dumps(by_hash, sort_keys=True))
 
 
 class RepreproDriver(RepositoryDriver):
@@ -300,6 +472,26 @@ class RepreproDriver(RepositoryDriver):
                        override_env={'GNUPGHOME': self.reposity_signature_driver.get_default_gpghome()})
 
 
+def get_export_concurrency():
+    return int(getattr(settings, 'AASEMBLE_BUILDSVC_EXPORT_CONCURRENCY', 1))
+
+
+def get_index_architectures():
+    """Architectures to generate Packages indexes for. Packages for
+    Architecture: all are included in all of them."""
+    return list(Architecture.objects.exclude(name__in=['all', 'source'])
+                                    .order_by('name')
+                                    .values_list('name', flat=True))
+
+
+def get_by_hash_retention():
+    return int(getattr(settings, 'AASEMBLE_BUILDSVC_BY_HASH_RETENTION', 3))
+
+
+def get_signature_cache_timeout():
+    return getattr(settings, 'AASEMBLE_BUILDSVC_SIGNATURE_CACHE_TIMEOUT', 7 * 24 * 60 * 60)
+
+
 def get_repository_signature_driver():
     if getattr(settings, 'AASEMBLE_BUILDSVC_USE_FAKE_SIGNATURE_DRIVER', False):
         return FakeRepositorySignatureDriver()
@@ -1,5 +1,35 @@
+import collections
+import errno
+import hashlib
+import io
+import json
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import File
 from django.core.files.storage import FileSystemStorage
+from django.utils.encoding import force_bytes
+
+from aasemble.utils import ensure_dir
+
+LOG = logging.getLogger(__name__)
+
+# The outcome of one of the writes done by Storage.save_many() or
+# Storage.publish_many(). error is None if the write succeeded.
+SaveResult = collections.namedtuple('SaveResult', ['path', 'error'])
+
+# Blobs added (or re-added) more recently than this many seconds ago are
+# left alone by garbage collection, as they may be about to be linked.
+BLOB_GRACE_PERIOD = 3600
 
 
 class Storage(object):
@@ -17,6 +47,392 @@ class Storage(object):
             self.delete(path)
         return self.django_storage.save(path, *args, **kwargs)
 
+    def publish(self, path, content):
+        """Stores content at path, replacing whatever is already there.
 
-def get_repository_storage_driver():
+        On the local filesystem the new file is written under a temporary
+        name and renamed into place, so readers see either the old or the
+        new file, but never a missing or partially written one."""
+        try:
+            dest = self.django_storage.path(path)
+        except NotImplementedError:
+            return self.save(path, content, overwrite=True)
+
+        dest_dir = ensure_dir(os.path.dirname(dest))
+        fd, tmppath = tempfile.mkstemp(dir=dest_dir, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                for chunk in content.chunks():
+                    fp.write(chunk)
+            os.chmod(tmppath, self.django_storage.file_permissions_mode or 0o644)
+            os.rename(tmppath, dest)
+        finally:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+        return path
+
+    def save_pool_file(self, path, fpath, sha256):
+        """Stores the file at fpath as path, sharing the underlying data
+        with every other pool file with the same sha256.
+
+        Storage backends that do not live on the local filesystem just
+        get a regular copy."""
+        try:
+            dest = self.django_storage.path(path)
+        except NotImplementedError:
+            with open(fpath, 'rb') as fp:
+                return self.save(path, File(fp), overwrite=True)
+
+        blob_store = get_blob_store()
+        blob_store.link(blob_store.add(fpath, sha256), dest)
+        return path
+
+    def save_many(self, pool_files, concurrency=None):
+        """Calls save_pool_file() for each (path, fpath, sha256) tuple in
+        pool_files, up to concurrency (BUILDSVC_STORAGE_CONCURRENCY by
+        default) at a time.
+
+        Returns a SaveResult for each file, in the same order."""
+        return self._write_many(self.save_pool_file, pool_files, concurrency)
+
+    def publish_many(self, files, concurrency=None):
+        """Calls publish() for each (path, content) tuple in files, like
+        save_many() does for pool files."""
+        return self._write_many(self.publish, files, concurrency)
+
+    def _write_many(self, write, argslist, concurrency):
+        argslist = list(argslist)
+
+        def do_write(args):
+            try:
+                write(*args)
+            except Exception as e:
+                LOG.exception('Failed to store %s' % (args[0],))
+                return SaveResult(args[0], e)
+            return SaveResult(args[0], None)
+
+        concurrency = min(concurrency or get_storage_concurrency(), len(argslist))
+        if concurrency <= 1:
+            return [do_write(args) for args in argslist]
+
+        pool = ThreadPool(concurrency)
+        try:
+            return pool.map(do_write, argslist)
+        finally:
+            pool.close()
+            pool.join()
+
+
+class ObjectStorage(Storage):
+    """Keeps repositories in an S3 compatible object store instead of on
+    the local filesystem, so any number of nodes can publish to them.
+
+    client is an S3Client or a FakeObjectStoreClient. Objects larger
+    than multipart_threshold are uploaded in parts of part_size bytes,
+    upload_concurrency of them at a time."""
+    def __init__(self, client, multipart_threshold=None, part_size=None, upload_concurrency=None):
+        self.client = client
+        self.multipart_threshold = multipart_threshold or get_object_store_multipart_threshold()
+        self.part_size = part_size or get_object_store_part_size()
+        self.upload_concurrency = upload_concurrency or get_object_store_upload_concurrency()
+
+    def exists(self, path):
+        return self.client.head(path) is not None
+
+    def delete(self, path):
+        self.client.delete(path)
+
+    def save(self, path, content, overwrite=False):
+        # Uploads replace whatever is there, so overwrite is implied.
+        self.upload(path, content)
+        return path
+
+    def publish(self, path, content):
+        # Objects only ever become visible once completely uploaded
+        return self.save(path, content)
+
+    def save_pool_file(self, path, fpath, sha256):
+        head = self.client.head(path)
+        if head is not None and head.get('sha256') == sha256:
+            return path
+        with open(fpath, 'rb') as fp:
+            self.upload(path, File(fp), metadata={'sha256': sha256})
+        return path
+
+    def upload(self, path, content, metadata=None):
+        metadata = metadata or {}
+        size = content.size
+        content.seek(0)
+        if size < self.multipart_threshold:
+            self.client.put(path, force_bytes(content.read()), metadata)
+            return
+
+        part_count = (size + self.part_size - 1) // self.part_size
+        upload_id = self.client.create_multipart_upload(path, metadata)
+        lock = threading.Lock()
+
+        def upload_part(part_number):
+            with lock:
+                content.seek((part_number - 1) * self.part_size)
+                data = content.read(self.part_size)
+            return {'PartNumber': part_number,
+                    'ETag': self.client.upload_part(path, upload_id, part_number, data)}
+
+        pool = ThreadPool(min(self.upload_concurrency, part_count))
+        try:
+            parts = pool.map(upload_part, range(1, part_count + 1))
+        except Exception:
+            self.client.abort_multipart_upload(path, upload_id)
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        self.client.complete_multipart_upload(path, upload_id, parts)
+
+
+class S3Client(object):
+    """The handful of object store operations ObjectStorage needs, on top
+    of boto3. Credentials are found the usual boto3 way (environment,
+    ~/.aws/credentials, instance metadata...)."""
+    def __init__(self, bucket, endpoint_url=None):
+        import boto3
+        self.bucket = bucket
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def head(self, key):
+        """Returns the metadata of the object at key or None if there is
+        no such object."""
+        import botocore.exceptions
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return response['Metadata']
+
+    def put(self, key, data, metadata):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, Metadata=metadata)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def create_multipart_upload(self, key, metadata):
+        return self.client.create_multipart_upload(Bucket=self.bucket, Key=key, Metadata=metadata)['UploadId']
+
+    def upload_part(self, key, upload_id, part_number, data):
+        return self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                       PartNumber=part_number, Body=data)['ETag']
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                              MultipartUpload={'Parts': parts})
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+
+
+class FakeObjectStoreClient(object):
+    """Stand-in for S3Client that keeps objects on the local filesystem,
+    for testing and development without an object store at hand.
+
+    Objects are stored under location with their metadata next to them
+    in .metadata/. Parts of multipart uploads are kept in .uploads/ until
+    the upload is completed."""
+    def __init__(self, location):
+        self.location = location
+
+    def _path(self, *parts):
+        return os.path.join(self.location, *parts)
+
+    def _write(self, key, fps, metadata):
+        dest = self._path(key)
+        fd, tmppath = tempfile.mkstemp(dir=ensure_dir(os.path.dirname(dest)), prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as outfp:
+                for fp in fps:
+                    shutil.copyfileobj(fp, outfp)
+            metadata_path = self._path('.metadata', key)
+            ensure_dir(os.path.dirname(metadata_path))
+            with open(metadata_path, 'w') as fp:
+                json.dump(metadata, fp)
+            os.rename(tmppath, dest)
+        finally:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+
+    def head(self, key):
+        if not os.path.isfile(self._path(key)):
+            return None
+        with open(self._path('.metadata', key), 'r') as fp:
+            return json.load(fp)
+
+    def put(self, key, data, metadata):
+        self._write(key, [io.BytesIO(data)], metadata)
+
+    def delete(self, key):
+        for path in (self._path(key), self._path('.metadata', key)):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def create_multipart_upload(self, key, metadata):
+        upload_id = uuid.uuid4().hex
+        upload_dir = ensure_dir(self._path('.uploads', upload_id))
+        with open(os.path.join(upload_dir, 'metadata'), 'w') as fp:
+            json.dump({'key': key, 'metadata': metadata}, fp)
+        return upload_id
+
+    def upload_part(self, key, upload_id, part_number, data):
+        with open(self._path('.uploads', upload_id, 'part-%d' % (part_number,)), 'wb') as fp:
+            fp.write(data)
+        return hashlib.md5(data).hexdigest()
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        upload_dir = self._path('.uploads', upload_id)
+        with open(os.path.join(upload_dir, 'metadata'), 'r') as fp:
+            upload = json.load(fp)
+        assert upload['key'] == key, 'Upload %s is for %s, not %s' % (upload_id, upload['key'], key)
+        fps = [open(os.path.join(upload_dir, 'part-%d' % (part['PartNumber'],)), 'rb')
+               for part in sorted(parts, key=lambda part: part['PartNumber'])]
+        try:
+            self._write(key, fps, upload['metadata'])
+        finally:
+            for fp in fps:
+                fp.close()
+        shutil.rmtree(upload_dir)
+
+    def abort_multipart_upload(self, key, upload_id):
+        shutil.rmtree(self._path('.uploads', upload_id), ignore_errors=True)
+
+
+class BlobStore(object):
+    """Content addressed store for pool files.
+
+    Pool files are hardlinks to blobs in the store, so a blob's link
+    count doubles as its reference count. Blobs that are no longer
+    linked from anywhere are removed by collect_garbage()."""
+    def __init__(self, location):
+        self.location = location
+
+    def path(self, sha256):
+        return os.path.join(self.location, sha256[:2], sha256)
+
+    def add(self, fpath, sha256):
+        blob_path = self.path(sha256)
+        if os.path.exists(blob_path):
+            # Keeps collect_garbage() away until we have linked it
+            try:
+                os.utime(blob_path, None)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        if not os.path.exists(blob_path):
+            blob_dir = ensure_dir(os.path.dirname(blob_path))
+            fd, tmppath = tempfile.mkstemp(dir=blob_dir, prefix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as outfp, open(fpath, 'rb') as infp:
+                    shutil.copyfileobj(infp, outfp)
+                os.rename(tmppath, blob_path)
+            finally:
+                if os.path.exists(tmppath):
+                    os.unlink(tmppath)
+        return blob_path
+
+    def link(self, blob_path, dest):
+        ensure_dir(os.path.dirname(dest))
+        if os.path.exists(dest):
+            if os.path.samefile(blob_path, dest):
+                return
+            os.unlink(dest)
+        try:
+            os.link(blob_path, dest)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM):
+                raise
+            LOG.warning('Could not hardlink %s to %s. Copying instead.' % (blob_path, dest))
+            shutil.copyfile(blob_path, dest)
+
+    def refcount(self, sha256):
+        try:
+            return os.stat(self.path(sha256)).st_nlink - 1
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return 0
+            raise
+
+    def collect_garbage(self, grace_period=BLOB_GRACE_PERIOD):
+        """Removes blobs that are not referenced by any pool file. Blobs
+        added within the last grace_period seconds are kept, as add() and
+        link() may be racing with us.
+
+        Returns the number of blobs removed."""
+        cutoff = time.time() - grace_period
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(self.location):
+            for filename in filenames:
+                if filename.startswith('.tmp'):
+                    continue
+                blob_path = os.path.join(dirpath, filename)
+                st = os.stat(blob_path)
+                if st.st_nlink == 1 and st.st_mtime < cutoff:
+                    os.unlink(blob_path)
+                    removed += 1
+        return removed
+
+
+def get_blob_store():
+    location = getattr(settings, 'BUILDSVC_BLOB_STORE_DIR', None)
+    if location is None:
+        location = os.path.join(settings.BUILDSVC_REPOS_BASE_DIR, 'blobs')
+    return BlobStore(location)
+
+
+def raise_for_errors(results):
+    """Raises the first error in results from save_many() or
+    publish_many(), if any."""
+    for result in results:
+        if result.error is not None:
+            raise result.error
+
+
+def get_storage_concurrency():
+    return int(getattr(settings, 'BUILDSVC_STORAGE_CONCURRENCY', 4))
+
+
+def get_object_store_client():
+    fake_dir = getattr(settings, 'BUILDSVC_OBJECT_STORE_FAKE_DIR', None)
+    if fake_dir:
+        return FakeObjectStoreClient(fake_dir)
+    return S3Client(settings.BUILDSVC_OBJECT_STORE_BUCKET,
+                    endpoint_url=getattr(settings, 'BUILDSVC_OBJECT_STORE_ENDPOINT_URL', None))
+
+
+def get_object_store_multipart_threshold():
+    return int(getattr(settings, 'BUILDSVC_OBJECT_STORE_MULTIPART_THRESHOLD', 16 * 1024 * 1024))
+
+
+def get_object_store_part_size():
+    return int(getattr(settings, 'BUILDSVC_OBJECT_STORE_PART_SIZE', 8 * 1024 * 1024))
+
+
+def get_object_store_upload_concurrency():
+    return int(getattr(settings, 'BUILDSVC_OBJECT_STORE_UPLOAD_CONCURRENCY', 4))
+
+
+def get_filesystem_storage():
     return Storage(FileSystemStorage(location=settings.BUILDSVC_REPOS_BASE_PUBLIC_DIR))
+
+
+def get_object_storage():
+    return ObjectStorage(get_object_store_client())
+
+
+STORAGE_BACKENDS = {'FileSystem': get_filesystem_storage,
+                    'ObjectStore': get_object_storage}
+
+
+def get_repository_storage_driver():
+    backend = getattr(settings, 'BUILDSVC_STORAGE_BACKEND', 'FileSystem')
+    if backend not in STORAGE_BACKENDS:
+        raise ImproperlyConfigured('Unknown BUILDSVC_STORAGE_BACKEND: %s' % (backend,))
+    return STORAGE_BACKENDS[backend]()
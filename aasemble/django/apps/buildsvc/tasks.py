@@ -12,7 +12,20 @@ def reprepro(repository_id, *args):
 def export(repository_id):
     from .models import Repository
     r = Repository.objects.get(id=repository_id)
-    r.export()
+    r.export_if_needed()
+
+
+@shared_task(ignore_result=True)
+def export_all():
+    from .models import Repository
+    for r in Repository.objects.all():
+        r.schedule_export()
+
+
+@shared_task(ignore_result=True)
+def prune_build_logs():
+    from .models.build import prune_build_logs
+    prune_build_logs()
 
 
 @shared_task(ignore_result=True)
@@ -33,5 +46,19 @@ def poll_one(package_source_id):
 @shared_task(ignore_result=True)
 def poll_all():
     from .models import PackageSource
-    for ps in PackageSource.objects.filter(webhook_registered=False).exclude(disabled=True):
-        poll_one.delay(ps.id)
+    for ps in PackageSource.poll_many(PackageSource.claim_due_for_polling()):
+        ps.build()
+
+
+@shared_task(ignore_result=True)
+def provision_build_node(build_node_id):
+    from . import nodepool
+    from .models import BuildNode
+    nodepool.provision_node(BuildNode.objects.get(id=build_node_id))
+
+
+@shared_task(ignore_result=True)
+def maintain_build_node_pool():
+    from . import nodepool
+    if nodepool.pool_enabled():
+        nodepool.maintain_pool()
@@ -1,28 +1,42 @@
+import bz2
+import datetime
 import gzip
+import hashlib
+import json
 import os.path
 import shutil
 import subprocess
 import sys
 import tempfile
+import zlib
+from multiprocessing.pool import ThreadPool
 
 import deb822
 
 from django.conf import settings
 from django.contrib.auth import models as auth_models
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
 from django.db.utils import IntegrityError
 from django.test import override_settings
 from django.test.utils import skipIf
+from django.utils.timezone import now
 
 import github3
 
 import mock
 
-from six import StringIO
+from six import BytesIO, StringIO
 
-from aasemble.django.apps.buildsvc import executors, repodrivers
-from aasemble.django.apps.buildsvc.models import BinaryPackage, BinaryPackageVersion, Build, PackageSource, Repository, Series, SourcePackage, SourcePackageVersion, SourcePackageVersionFile
+from aasemble.django.apps.buildsvc import executors, indexes, logarchive, nodepool, repodrivers, storage
+from aasemble.django.apps.buildsvc.models import Architecture, BinaryBuild, BinaryPackage, BinaryPackageVersion, BinaryPackageVersionUserField, Build, BuildNode, PackageSource, Repository, Series, SourcePackage, SourcePackageVersion, SourcePackageVersionFile
+from aasemble.django.apps.buildsvc.models import package_source
+from aasemble.django.apps.buildsvc.models.build import PKGBUILD_RESULT_MARKER, PkgbuildResultMissing, get_run_cmd, parse_pkgbuild_result, prune_build_logs
 from aasemble.django.apps.buildsvc.models.package_source import NotAValidGithubRepository
 from aasemble.django.apps.buildsvc.models.source_package_version_file import SOURCE_PACKAGE_FILE_TYPE_DSC, SOURCE_PACKAGE_FILE_TYPE_NATIVE
+from aasemble.django.apps.buildsvc.pkgbuild import gitcache
+from aasemble.django.apps.buildsvc.utils import get_fileinfo
 from aasemble.django.tests import AasembleLiveServerTestCase as LiveServerTestCase
 from aasemble.django.tests import AasembleTestCase as TestCase
 from aasemble.utils import run_cmd
@@ -188,6 +202,119 @@ class RepositoryTestCase(TestCase):
         self.assertEquals(repo.base_url, 'http://example.com/some/dir/eric/eric5')
 
 
+@mock.patch('aasemble.django.apps.buildsvc.models.repository.get_repo_driver')
+@mock.patch('aasemble.django.apps.buildsvc.tasks.export')
+class ExportSchedulingTestCase(TestCase):
+    def test_schedule_export_coalesces_requests(self, export, get_repo_driver):
+        repo = Repository.objects.get(id=1)
+        self.assertTrue(repo.schedule_export())
+        self.assertFalse(repo.schedule_export())
+        self.assertFalse(repo.schedule_export())
+        export.apply_async.assert_called_once_with((1,), countdown=5)
+
+        repo.refresh_from_db()
+        self.assertEquals(repo.export_generation, 3)
+        self.assertTrue(repo.export_scheduled)
+
+    @override_settings(AASEMBLE_BUILDSVC_EXPORT_DEBOUNCE=30)
+    def test_schedule_export_debounce_setting(self, export, get_repo_driver):
+        Repository.objects.get(id=1).schedule_export()
+        export.apply_async.assert_called_once_with((1,), countdown=30)
+
+    def test_save_does_not_clobber_bookkeeping(self, export, get_repo_driver):
+        repo = Repository.objects.get(id=1)
+        Repository.objects.filter(id=1).update(export_in_progress=True, export_generation=10)
+        repo.save()
+
+        repo.refresh_from_db()
+        self.assertTrue(repo.export_in_progress)
+        self.assertEquals(repo.export_generation, 11)
+
+    def test_export_if_needed(self, export, get_repo_driver):
+        repo = Repository.objects.get(id=1)
+        repo.schedule_export()
+        repo.schedule_export()
+
+        self.assertTrue(repo.export_if_needed())
+        self.assertEquals(get_repo_driver.return_value.export.call_count, 1)
+
+        # Both requests were covered by that export
+        self.assertFalse(repo.export_if_needed())
+        self.assertEquals(get_repo_driver.return_value.export.call_count, 1)
+
+        repo.refresh_from_db()
+        self.assertEquals(repo.exported_generation, 2)
+        self.assertFalse(repo.export_scheduled)
+        self.assertFalse(repo.export_in_progress)
+
+    def test_requests_during_export_trigger_one_follow_up(self, export, get_repo_driver):
+        repo = Repository.objects.get(id=1)
+        repo.schedule_export()
+        export.reset_mock()
+
+        pending_requests = [3]
+
+        def request_exports():
+            while pending_requests[0]:
+                pending_requests[0] -= 1
+                repo.schedule_export()
+
+        get_repo_driver.return_value.export.side_effect = request_exports
+
+        self.assertTrue(repo.export_if_needed())
+        export.apply_async.assert_called_once_with((1,), countdown=5)
+
+        self.assertTrue(repo.export_if_needed())
+        self.assertFalse(repo.export_if_needed())
+        self.assertEquals(get_repo_driver.return_value.export.call_count, 2)
+
+    def test_export_if_needed_while_export_in_progress(self, export, get_repo_driver):
+        repo = Repository.objects.get(id=1)
+        repo.schedule_export()
+        export.reset_mock()
+        Repository.objects.filter(id=1).update(export_in_progress=True, export_started=now())
+
+        self.assertFalse(repo.export_if_needed())
+        get_repo_driver.return_value.export.assert_not_called()
+        export.apply_async.assert_called_once_with((1,), countdown=5)
+
+        repo.refresh_from_db()
+        self.assertTrue(repo.export_scheduled)
+
+    def test_export_if_needed_takes_over_stale_export(self, export, get_repo_driver):
+        repo = Repository.objects.get(id=1)
+        repo.schedule_export()
+        export.reset_mock()
+        # Its worker was killed before it could clear export_in_progress
+        Repository.objects.filter(id=1).update(export_in_progress=True,
+                                               export_started=now() - datetime.timedelta(hours=2))
+
+        self.assertTrue(repo.export_if_needed())
+        get_repo_driver.return_value.export.assert_called_once_with()
+        export.apply_async.assert_not_called()
+
+        repo.refresh_from_db()
+        self.assertFalse(repo.export_in_progress)
+        self.assertIsNone(repo.export_started)
+
+    def test_save_deleted_repository(self, export, get_repo_driver):
+        repo = Repository.objects.get(id=1)
+        Repository.objects.filter(id=1).delete()
+        repo.save()
+        self.assertTrue(Repository.objects.filter(id=1).exists())
+
+    def test_export_all(self, export, get_repo_driver):
+        from aasemble.django.apps.buildsvc import tasks
+        tasks.export_all()
+        self.assertEquals(export.apply_async.call_count, Repository.objects.count())
+
+    def test_export_all_command(self, export, get_repo_driver):
+        from aasemble.django.apps.buildsvc.management.commands.export_all import Command as ExportAll
+        with mock.patch('aasemble.django.apps.buildsvc.tasks.export_all') as export_all:
+            ExportAll().handle()
+        export_all.delay.assert_called_once_with()
+
+
 class PackageSourceTestCase(TestCase):
     @mock.patch('aasemble.django.apps.buildsvc.tasks.reprepro')
     def test_post_delete(self, reprepro):
@@ -269,6 +396,24 @@ class PackageSourceTestCase(TestCase):
         ps.refresh_from_db()
         self.assertTrue(ps.webhook_registered)
 
+    @mock.patch('github3.GitHub')
+    @override_settings(GITHUB_WEBHOOK_URL='https://example.com/api/github/')
+    @override_settings(GITHUB_WEBHOOK_SECRET='s3cret')
+    @override_settings(AASEMBLE_BUILDSVC_USE_WEBHOOKS=True)
+    def test_register_webhook_with_secret(self, GitHub):
+        ps = PackageSource.objects.create(series_id=1,
+                                          git_url='https://github.com/owner/repo',
+                                          branch='master',
+                                          last_built_name='something')
+
+        ps.register_webhook()
+
+        repository = GitHub.return_value.repository.return_value
+        repository.create_hook.assert_called_with(name='web',
+                                                  config={'url': 'https://example.com/api/github/',
+                                                          'content_type': 'json',
+                                                          'secret': 's3cret'})
+
     @mock.patch('github3.GitHub')
     @override_settings(GITHUB_WEBHOOK_URL='https://example.com/api/github/')
     @override_settings(AASEMBLE_BUILDSVC_USE_WEBHOOKS=True)
@@ -369,6 +514,130 @@ class PackageSourceTestCase(TestCase):
         self.assertTrue(ps.last_failure_time)
         self.assertEquals(ps.last_failure, "fatal: could not read Username for 'https://github.com': No such device or address\n")
 
+    @mock.patch('aasemble.django.apps.buildsvc.models.package_source.aio', None)
+    @mock.patch('aasemble.django.apps.buildsvc.models.package_source.run_cmd')
+    def test_poll_many_one_ls_remote_per_git_url(self, run_cmd):
+        PackageSource.objects.create(series_id=1, git_url='https://github.com/eric/project0', branch='stable')
+        PackageSource.objects.create(series_id=1, git_url='https://github.com/eric/project0', branch='gone')
+        run_cmd.return_value = (b'cdf46dc0-a49c-11e5-b00a-c712eaff3d7b\trefs/heads/master\n'
+                                b'0123456789abcdef0123456789abcdef01234567\trefs/heads/stable\n')
+        sources = PackageSource.objects.filter(git_url='https://github.com/eric/project0').order_by('id')
+
+        changed = PackageSource.poll_many(sources)
+
+        run_cmd.assert_called_once_with(['git', 'ls-remote', 'https://github.com/eric/project0',
+                                         'refs/heads/gone', 'refs/heads/master', 'refs/heads/stable'])
+        self.assertEquals([ps.branch for ps in changed], ['stable'])
+        self.assertEquals(PackageSource.objects.get(branch='stable').last_seen_revision,
+                          '0123456789abcdef0123456789abcdef01234567')
+        self.assertIsNone(PackageSource.objects.get(branch='gone').last_seen_revision)
+
+    @mock.patch('aasemble.django.apps.buildsvc.models.package_source.aio')
+    def test_poll_many_concurrently(self, aio):
+        aio.run_cmds.return_value = [b'0123456789abcdef0123456789abcdef01234567\trefs/heads/master\n',
+                                     CommandFailed('failed', [], 128, 'fatal: repository not found\n'),
+                                     b'0123456789abcdef0123456789abcdef01234567\trefs/heads/master\n']
+        sources = PackageSource.objects.filter(id__in=[1, 2, 3]).order_by('id')
+
+        changed = PackageSource.poll_many(sources, concurrency=2)
+
+        aio.run_cmds.assert_called_once_with([['git', 'ls-remote', ps.git_url, 'refs/heads/master'] for ps in sources],
+                                             concurrency=2)
+        self.assertEquals([ps.id for ps in changed], [1, 3])
+        failed = PackageSource.objects.get(id=2)
+        self.assertTrue(failed.disabled)
+        self.assertEquals(failed.last_failure, 'fatal: repository not found\n')
+
+    @mock.patch('aasemble.django.apps.buildsvc.models.package_source.aio')
+    def test_poll_many_reraises_unexpected_errors(self, aio):
+        aio.run_cmds.return_value = [ValueError('boom')]
+
+        self.assertRaises(ValueError, PackageSource.poll_many, [PackageSource.objects.get(id=1)])
+
+    @skipIf(package_source.aio is None, 'Needs asyncio')
+    def test_poll_many_real_git(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        run_cmd(['git', 'init', '-q', tmpdir])
+        run_cmd(['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com',
+                 'commit', '-q', '--allow-empty', '-m', 'Initial commit'], cwd=tmpdir)
+        run_cmd(['git', 'branch', '-M', 'master'], cwd=tmpdir)
+        sha = run_cmd(['git', 'rev-parse', 'master'], cwd=tmpdir).decode().strip()
+        PackageSource.objects.filter(id=1).update(git_url='file://' + tmpdir)
+
+        changed = PackageSource.poll_many([PackageSource.objects.get(id=1)])
+
+        self.assertEquals([ps.id for ps in changed], [1])
+        self.assertEquals(PackageSource.objects.get(id=1).last_seen_revision, sha)
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.build')
+    @mock.patch('aasemble.django.apps.buildsvc.models.package_source.aio', None)
+    @mock.patch('aasemble.django.apps.buildsvc.models.package_source.run_cmd')
+    def test_poll_all_builds_changed_sources(self, run_cmd, build):
+        from aasemble.django.apps.buildsvc.tasks import poll_all
+        PackageSource.objects.exclude(id__in=[1, 2]).update(disabled=True)
+        run_cmd.return_value = b'cdf46dc0-a49c-11e5-b00a-c712eaff3d7b\trefs/heads/master\n'
+
+        poll_all()
+
+        self.assertEquals(run_cmd.call_count, 2)
+        build.delay.assert_called_once_with(2)
+
+    @override_settings(AASEMBLE_BUILDSVC_POLL_MIN_INTERVAL=10, AASEMBLE_BUILDSVC_POLL_MAX_INTERVAL=60)
+    @mock.patch('aasemble.django.apps.buildsvc.models.package_source.aio', None)
+    @mock.patch('aasemble.django.apps.buildsvc.models.package_source.run_cmd')
+    def test_poll_many_backs_off(self, run_cmd):
+        run_cmd.return_value = b'cdf46dc0-a49c-11e5-b00a-c712eaff3d7b\trefs/heads/master\n'
+        ps = PackageSource.objects.get(id=1)
+
+        intervals = []
+        for i in range(4):
+            PackageSource.poll_many([ps])
+            intervals.append(PackageSource.objects.get(id=1).poll_interval)
+        self.assertEquals(intervals, [20, 40, 60, 60])
+
+        before = now()
+        run_cmd.return_value = b'0123456789abcdef0123456789abcdef01234567\trefs/heads/master\n'
+        self.assertEquals(PackageSource.poll_many([ps]), [ps])
+        ps = PackageSource.objects.get(id=1)
+        self.assertEquals(ps.poll_interval, 10)
+        self.assertGreaterEqual(ps.next_poll_due, before + datetime.timedelta(seconds=10))
+
+    @mock.patch('aasemble.django.apps.buildsvc.models.package_source.aio', None)
+    @mock.patch('aasemble.django.apps.buildsvc.models.package_source.run_cmd')
+    def test_poll_many_backs_off_after_transient_failure(self, run_cmd):
+        run_cmd.side_effect = OSError(12, 'Cannot allocate memory')
+        ps = PackageSource.objects.get(id=1)
+
+        self.assertEquals(PackageSource.poll_many([ps]), [])
+
+        ps = PackageSource.objects.get(id=1)
+        self.assertFalse(ps.disabled)
+        self.assertEquals(ps.poll_interval, 20)
+        self.assertGreater(ps.next_poll_due, now())
+
+    def test_due_for_polling(self):
+        PackageSource.objects.filter(id=1).update(next_poll_due=now() + datetime.timedelta(minutes=5))
+        PackageSource.objects.filter(id=2).update(webhook_registered=True)
+        PackageSource.objects.filter(id=3).update(disabled=True)
+
+        due = set(PackageSource.due_for_polling().values_list('id', flat=True))
+        self.assertEquals(due, set(PackageSource.objects.exclude(id__in=[1, 2, 3]).values_list('id', flat=True)))
+
+    def test_claim_due_for_polling(self):
+        due = set(PackageSource.due_for_polling().values_list('id', flat=True))
+        self.assertEquals(set(ps.id for ps in PackageSource.claim_due_for_polling()), due)
+
+        # An overlapping poller gets nothing
+        self.assertEquals(PackageSource.claim_due_for_polling(), [])
+        self.assertFalse(PackageSource.due_for_polling().exists())
+
+    def test_record_revision_with_stale_instance(self):
+        ps = PackageSource.objects.get(id=1)
+        stale = PackageSource.objects.get(id=1)
+        self.assertTrue(ps.record_revision('0123456789abcdef0123456789abcdef01234567'))
+        self.assertFalse(stale.record_revision('0123456789abcdef0123456789abcdef01234567'))
+
     @mock.patch('aasemble.django.apps.buildsvc.tasks.build')
     def test_build(self, build):
         ps = PackageSource.objects.get(id=1)
@@ -380,23 +649,143 @@ class PackageSourceTestCase(TestCase):
         def run_cmd_side_effect(cmd, *args, **kwargs):
             if cmd[0] == 'timeout':
                 return ''
-            if cmd[0] == 'aasemble-pkgbuild':
-                if cmd[1] == 'version':
-                    return '124'
-                if cmd[1] == 'name':
-                    return 'detectedname'
-                if 'source-build' in cmd[1:]:
-                    return ''
-                if 'binary-build' in cmd[1:]:
-                    return ''
-                if cmd[1] == 'checkout':
-                    return ''
+            if cmd[0] == 'aasemble-pkgbuild' and cmd[-2] == 'run':
+                return (b'Checking out\n'
+                        b'aasemble-pkgbuild-result: {"builder": "PythonBuilder", "version": "124", "name": "detectedname"}\n'
+                        b'Lots of build output\n'
+                        b'Connection to 192.0.2.1 closed.\n')
             raise Exception('Unexpected command')
 
         run_cmd.side_effect = run_cmd_side_effect
         ps = PackageSource.objects.get(id=7)
         ps.build_real()
 
+        ps = PackageSource.objects.get(id=7)
+        self.assertEquals(ps.last_built_version, '124')
+        self.assertEquals(ps.last_built_name, 'detectedname')
+        self.assertEquals(Build.objects.filter(source=ps).order_by('-build_counter')[0].version, '124')
+
+    @mock.patch('aasemble.django.apps.buildsvc.executors.run_cmd')
+    def test_build_real_failure_records_version(self, run_cmd):
+        def run_cmd_side_effect(cmd, *args, **kwargs):
+            if cmd[0] == 'timeout':
+                return ''
+            raise CommandFailed('failed', cmd, 2,
+                                b'aasemble-pkgbuild-result: {"builder": "PythonBuilder", "version": "125", "name": "detectedname"}\n'
+                                b'error: compilation failed\n')
+
+        run_cmd.side_effect = run_cmd_side_effect
+        ps = PackageSource.objects.get(id=7)
+        self.assertRaises(CommandFailed, ps.build_real)
+
+        ps = PackageSource.objects.get(id=7)
+        self.assertEquals(ps.last_built_version, '125')
+        build = Build.objects.filter(source=ps).order_by('-build_counter')[0]
+        self.assertEquals(build.version, '125')
+        self.assertEquals(build.state, Build.FAILED_TO_BUILD)
+        self.assertFalse(build.logpath().endswith('.tmp.log'))
+
+    @mock.patch('aasemble.django.apps.buildsvc.executors.run_cmd')
+    def test_build_real_failure_with_garbled_result(self, run_cmd):
+        def run_cmd_side_effect(cmd, *args, **kwargs):
+            if cmd[0] == 'timeout':
+                return ''
+            raise CommandFailed('failed', cmd, 2, b'aasemble-pkgbuild-result: {"version": \n')
+
+        run_cmd.side_effect = run_cmd_side_effect
+        ps = PackageSource.objects.get(id=7)
+        self.assertRaises(CommandFailed, ps.build_real)
+
+        build = Build.objects.filter(source=ps).order_by('-build_counter')[0]
+        self.assertEquals(build.state, Build.FAILED_TO_BUILD)
+
+
+class LogArchiveTestCase(TestCase):
+    def setUp(self):
+        super(LogArchiveTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'build.log.gz')
+        self.data = b''.join([('Compiling foo%d.c\n' % (i,)).encode('utf-8') for i in range(1000)]) + b'Done'
+        logarchive.write_archive(BytesIO(self.data), self.path, block_size=1000)
+        self.archive = logarchive.LogArchive(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(LogArchiveTestCase, self).tearDown()
+
+    def test_archive_is_gzip_file(self):
+        with gzip.open(self.path, 'rb') as fp:
+            self.assertEquals(fp.read(), self.data)
+        self.assertLess(os.path.getsize(self.path), len(self.data))
+
+    def test_read(self):
+        self.assertEquals(self.archive.size, len(self.data))
+        self.assertEquals(b''.join(self.archive.read()), self.data)
+        for start, stop in [(0, 10), (995, 1005), (5000, 12345), (len(self.data) - 2, None), (len(self.data), None)]:
+            self.assertEquals(b''.join(self.archive.read(start, stop)), self.data[start:stop])
+
+    def test_read_only_decompresses_needed_blocks(self):
+        with mock.patch('aasemble.django.apps.buildsvc.logarchive.zlib.decompress', wraps=zlib.decompress) as decompress:
+            self.assertEquals(b''.join(self.archive.read(995, 1005)), self.data[995:1005])
+        self.assertEquals(decompress.call_count, 2)
+
+    def test_tail(self):
+        self.assertEquals(self.archive.tail(3), b'Compiling foo998.c\nCompiling foo999.c\nDone')
+        self.assertEquals(self.archive.tail(0), b'')
+        self.assertEquals(self.archive.tail(5000), self.data)
+
+    def test_remove_archive(self):
+        self.assertTrue(logarchive.remove_archive(self.path))
+        self.assertEquals(os.listdir(self.tmpdir), [])
+        self.assertFalse(logarchive.remove_archive(self.path))
+
+
+class BuildLogTestCase(TestCase):
+    def setUp(self):
+        super(BuildLogTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings_override = override_settings(AASEMBLE_BUILDSVC_BUILDLOG_TMPDIR=os.path.join(self.tmpdir, 'tmp'),
+                                                   BUILDSVC_REPOS_BASE_PUBLIC_DIR=os.path.join(self.tmpdir, 'public'))
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.tmpdir)
+        super(BuildLogTestCase, self).tearDown()
+
+    def finish_build(self):
+        build = Build.objects.get(uuid='f5575921-c9a1-4cc8-a235-5b1756ca59ef')
+        with open(build.temporary_log_path(), 'wb') as fp:
+            fp.write(b'Building\nStill building\nDone\n')
+        build.build_finished = now()
+        build.save()
+        return build
+
+    def test_log_archived_when_build_finishes(self):
+        build = self.finish_build()
+        archive = build.log_archive()
+        self.assertEquals(b''.join(archive.read()), b'Building\nStill building\nDone\n')
+        self.assertEquals(archive.tail(1), b'Done\n')
+
+    def test_no_log_archive(self):
+        build = Build.objects.get(uuid='f5575921-c9a1-4cc8-a235-5b1756ca59ef')
+        self.assertIsNone(build.log_archive())
+
+    def test_prune_build_logs_keeps_logs_by_default(self):
+        build = self.finish_build()
+        self.assertEquals(prune_build_logs(), 0)
+        self.assertIsNotNone(build.log_archive())
+
+    @override_settings(AASEMBLE_BUILDSVC_BUILDLOG_RETENTION_DAYS=30)
+    def test_prune_build_logs(self):
+        build = self.finish_build()
+        self.assertEquals(prune_build_logs(), 0)
+
+        Build.objects.filter(id=build.id).update(build_finished=now() - datetime.timedelta(days=31))
+        self.assertEquals(prune_build_logs(), 1)
+        self.assertIsNone(build.log_archive())
+        self.assertEquals(prune_build_logs(), 0)
+
 
 class ExecutorTestCase(TestCase):
     @mock.patch('aasemble.django.apps.buildsvc.executors.GCENode.destroy')
@@ -419,6 +808,691 @@ class ExecutorTestCase(TestCase):
         self.assertEquals(executors.get_executor_class(settings=Settings()), executors.GCENode)
 
 
+@override_settings(AASEMBLE_BUILDSVC_EXECUTOR='PooledGCENode',
+                   AASEMBLE_BUILDSVC_GCE_FAKE_DRIVER=True,
+                   AASEMBLE_BUILDSVC_GCE_IMAGE='ubuntu-1404',
+                   AASEMBLE_BUILDSVC_GCE_POOL_MIN_IDLE=2,
+                   AASEMBLE_BUILDSVC_GCE_POOL_MAX_SIZE=3,
+                   AASEMBLE_BUILDSVC_GCE_POOL_MAX_BUILDS_PER_NODE=2)
+class NodePoolTestCase(TestCase):
+    def setUp(self):
+        super(NodePoolTestCase, self).setUp()
+        executors.FakeGCEDriver.nodes.clear()
+        self.patches = [mock.patch('aasemble.django.apps.buildsvc.executors.ssh_run_cmd'),
+                        mock.patch('aasemble.django.apps.buildsvc.tasks.provision_build_node'),
+                        mock.patch('aasemble.django.apps.buildsvc.tasks.maintain_build_node_pool'),
+                        mock.patch.object(executors.GCENode, '_ssh_public_key_data', 'ssh-rsa AAAA eric@example.com')]
+        self.ssh_run_cmd, self.provision_build_node, self.maintain_build_node_pool, _ = [p.start() for p in self.patches]
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        super(NodePoolTestCase, self).tearDown()
+
+    def create_idle_node(self, builds=0):
+        build_node = BuildNode.objects.create(name=nodepool.new_node_name(), builds=builds)
+        self.assertTrue(nodepool.provision_node(build_node))
+        return build_node
+
+    def test_pool_enabled(self):
+        self.assertTrue(nodepool.pool_enabled())
+        with override_settings(AASEMBLE_BUILDSVC_EXECUTOR='GCENode'):
+            self.assertFalse(nodepool.pool_enabled())
+
+    def test_maintain_pool_provisions_min_idle(self):
+        self.assertEquals(nodepool.maintain_pool(demand=0), 2)
+        self.assertEquals(self.provision_build_node.delay.call_count, 2)
+        self.assertEquals(BuildNode.objects.filter(state=BuildNode.PROVISIONING).count(), 2)
+
+        # Already provisioning, so nothing more to do
+        self.assertEquals(nodepool.maintain_pool(demand=0), 0)
+
+    def test_maintain_pool_scales_to_demand(self):
+        self.create_idle_node().transition(BuildNode.IDLE, BuildNode.LEASED)
+        self.assertEquals(nodepool.maintain_pool(demand=5), 2)
+
+    @override_settings(AASEMBLE_BUILDSVC_GCE_POOL_MAX_SIZE=10)
+    def test_maintain_pool_keeps_one_spare_node_per_build(self):
+        Build.objects.filter(state=Build.BUILDING).update(build_finished=now())
+        for i in range(3):
+            Build.objects.create(source_id=1, state=Build.BUILDING)
+            self.create_idle_node().transition(BuildNode.IDLE, BuildNode.LEASED)
+
+        self.assertEquals(nodepool.maintain_pool(), 3)
+        self.assertEquals(BuildNode.objects.filter(state=BuildNode.LEASED).count(), 3)
+        self.assertEquals(BuildNode.objects.filter(state=BuildNode.PROVISIONING).count(), 3)
+
+    def test_maintain_pool_retires_excess_idle_nodes(self):
+        oldest = self.create_idle_node()
+        for i in range(2):
+            self.create_idle_node()
+        BuildNode.objects.filter(id=oldest.id).update(state_changed=now() - datetime.timedelta(minutes=5))
+
+        self.assertEquals(nodepool.maintain_pool(demand=0), -1)
+        self.assertFalse(BuildNode.objects.filter(id=oldest.id).exists())
+        self.assertEquals(len(executors.FakeGCEDriver.nodes), 2)
+
+    def test_maintain_pool_removes_stale_nodes(self):
+        BuildNode.objects.create(name='stuck', state_changed=now() - datetime.timedelta(hours=1))
+        nodepool.maintain_pool(demand=0)
+        self.assertFalse(BuildNode.objects.filter(name='stuck').exists())
+
+    @override_settings(AASEMBLE_BUILDSVC_GCE_POOL_LEASE_TIMEOUT=3600)
+    def test_maintain_pool_reclaims_abandoned_leases(self):
+        abandoned = self.create_idle_node()
+        abandoned.transition(BuildNode.IDLE, BuildNode.LEASED)
+        BuildNode.objects.filter(id=abandoned.id).update(state_changed=now() - datetime.timedelta(hours=2))
+        busy = self.create_idle_node()
+        busy.transition(BuildNode.IDLE, BuildNode.LEASED)
+
+        nodepool.maintain_pool(demand=0)
+
+        self.assertFalse(BuildNode.objects.filter(id=abandoned.id).exists())
+        self.assertNotIn(abandoned.name, executors.FakeGCEDriver.nodes)
+        self.assertEquals(BuildNode.objects.get(id=busy.id).state, BuildNode.LEASED)
+
+    def test_provision_node(self):
+        build_node = self.create_idle_node()
+        build_node = BuildNode.objects.get(id=build_node.id)
+        self.assertEquals(build_node.state, BuildNode.IDLE)
+        self.assertEquals(build_node.public_ip, executors.FakeGCEDriver.nodes[build_node.name].public_ips[0])
+        self.ssh_run_cmd.assert_called_with('ubuntu@%s' % (build_node.public_ip,), executors.WAIT_FOR_PKGBUILD_CMD,
+                                            remote_cwd='workspace', logger=nodepool.LOG)
+
+    def test_provision_node_fails(self):
+        build_node = BuildNode.objects.create(name=nodepool.new_node_name())
+        with mock.patch('aasemble.django.apps.buildsvc.executors.retry_for_duration_wrapper',
+                        side_effect=CommandFailed('failed', ['true'], 255, '')):
+            self.assertFalse(nodepool.provision_node(build_node))
+        self.assertFalse(BuildNode.objects.filter(id=build_node.id).exists())
+        self.assertEquals(executors.FakeGCEDriver.nodes, {})
+
+    def test_lease_and_release(self):
+        build_node = self.create_idle_node()
+
+        with executors.PooledGCENode('b-build') as executor:
+            self.assertEquals(executor.build_node, build_node)
+            self.assertEquals(BuildNode.objects.get(id=build_node.id).state, BuildNode.LEASED)
+            executor.run_cmd(['make'])
+            self.ssh_run_cmd.assert_called_with('ubuntu@%s' % (build_node.public_ip,), ['make'], remote_cwd='workspace')
+
+        self.maintain_build_node_pool.delay.assert_called_with()
+        self.ssh_run_cmd.assert_called_with('ubuntu@%s' % (build_node.public_ip,), ['sudo', 'rm', '-rf', 'workspace'])
+        build_node = BuildNode.objects.get(id=build_node.id)
+        self.assertEquals(build_node.state, BuildNode.IDLE)
+        self.assertEquals(build_node.builds, 1)
+
+    def test_cold_start_when_pool_is_empty(self):
+        with executors.PooledGCENode('b-build') as executor:
+            self.assertEquals(executor.build_node.state, BuildNode.LEASED)
+            self.assertIn(executor.build_node.name, executors.FakeGCEDriver.nodes)
+        self.assertEquals(BuildNode.objects.get().state, BuildNode.IDLE)
+
+    def test_node_retired_after_max_builds(self):
+        build_node = self.create_idle_node(builds=1)
+        with executors.PooledGCENode('b-build'):
+            pass
+        self.assertFalse(BuildNode.objects.filter(id=build_node.id).exists())
+        self.assertEquals(executors.FakeGCEDriver.nodes, {})
+
+    def test_node_used_for_one_build_by_default(self):
+        build_node = self.create_idle_node()
+        with self.settings():
+            del settings.AASEMBLE_BUILDSVC_GCE_POOL_MAX_BUILDS_PER_NODE
+            with executors.PooledGCENode('b-build'):
+                pass
+        self.assertFalse(BuildNode.objects.filter(id=build_node.id).exists())
+        self.assertEquals(executors.FakeGCEDriver.nodes, {})
+        self.assertFalse(self.ssh_run_cmd.called)
+
+    def test_node_retired_if_reset_fails(self):
+        build_node = self.create_idle_node()
+        self.ssh_run_cmd.side_effect = CommandFailed('failed', ['sudo'], 255, '')
+        with executors.PooledGCENode('b-build'):
+            pass
+        self.assertFalse(BuildNode.objects.filter(id=build_node.id).exists())
+
+    def test_node_retired_if_reset_errors(self):
+        build_node = self.create_idle_node()
+        self.ssh_run_cmd.side_effect = OSError(12, 'Cannot allocate memory')
+        with executors.PooledGCENode('b-build'):
+            pass
+        self.assertFalse(BuildNode.objects.filter(id=build_node.id).exists())
+        self.assertEquals(executors.FakeGCEDriver.nodes, {})
+
+
+class GitReposTestCase(TestCase):
+    def setUp(self):
+        super(GitReposTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        # Submodules in local repositories need file:// to be allowed
+        self.env = mock.patch.dict(os.environ, {'GIT_CONFIG_PARAMETERS': "'protocol.file.allow=always'",
+                                                'GIT_AUTHOR_NAME': 'Eric', 'GIT_AUTHOR_EMAIL': 'eric@example.com',
+                                                'GIT_COMMITTER_NAME': 'Eric', 'GIT_COMMITTER_EMAIL': 'eric@example.com'})
+        self.env.start()
+        self.sub = self.create_repo('sub')
+        self.main = self.create_repo('main')
+        run_cmd(['git', 'submodule', 'add', self.sub, 'sub'], cwd=self.main)
+        self.sha = self.commit(self.main, 'Add submodule')
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.tmpdir)
+        super(GitReposTestCase, self).tearDown()
+
+    def create_repo(self, name):
+        path = os.path.join(self.tmpdir, name)
+        run_cmd(['git', 'init', path])
+        run_cmd(['git', 'checkout', '-b', 'master'], cwd=path)
+        with open(os.path.join(path, 'README'), 'w') as fp:
+            fp.write(name)
+        self.commit(path, 'Initial commit')
+        return path
+
+    def commit(self, path, msg):
+        run_cmd(['git', 'add', '-A'], cwd=path)
+        run_cmd(['git', 'commit', '-m', msg], cwd=path)
+        return run_cmd(['git', 'rev-parse', 'HEAD'], cwd=path).strip().decode()
+
+
+class GitMirrorCacheTestCase(GitReposTestCase):
+    def setUp(self):
+        super(GitMirrorCacheTestCase, self).setUp()
+        self.cache = gitcache.GitMirrorCache(os.path.join(self.tmpdir, 'cache'))
+
+    def test_clone(self):
+        dest = os.path.join(self.tmpdir, 'build')
+        self.cache.clone(self.main, 'master', dest, sha=self.sha)
+
+        self.assertEquals(run_cmd(['git', 'rev-parse', 'HEAD'], cwd=dest).strip().decode(), self.sha)
+        self.assertEquals(run_cmd(['git', 'remote', 'get-url', 'origin'], cwd=dest).strip().decode(), self.main)
+        with open(os.path.join(dest, 'sub', 'README'), 'r') as fp:
+            self.assertEquals(fp.read(), 'sub')
+        self.assertTrue(os.path.isdir(self.cache.mirror_path(self.main)))
+        self.assertTrue(os.path.isdir(self.cache.mirror_path(self.sub)))
+
+    def test_clone_fetches_new_commits(self):
+        self.cache.clone(self.main, 'master', os.path.join(self.tmpdir, 'build1'))
+        with open(os.path.join(self.main, 'README'), 'w') as fp:
+            fp.write('changed')
+        sha = self.commit(self.main, 'Change README')
+
+        dest = os.path.join(self.tmpdir, 'build2')
+        self.cache.clone(self.main, 'master', dest, sha=sha)
+        with open(os.path.join(dest, 'README'), 'r') as fp:
+            self.assertEquals(fp.read(), 'changed')
+
+    def test_evict_least_recently_used(self):
+        self.cache.update(self.sub)
+        self.cache.update(self.main)
+        os.utime(self.cache.mirror_path(self.sub), (0, 0))
+
+        self.cache.max_size = gitcache.directory_size(self.cache.mirror_path(self.main))
+        self.cache.evict()
+
+        self.assertFalse(os.path.exists(self.cache.mirror_path(self.sub)))
+        self.assertFalse(os.path.exists(self.cache.lock_path(self.cache.mirror_path(self.sub))))
+        self.assertTrue(os.path.exists(self.cache.mirror_path(self.main)))
+
+    def test_evict_skips_mirrors_in_use(self):
+        self.cache.max_size = 0
+        with self.cache.mirror(self.sub) as mirror:
+            self.cache.evict()
+            self.assertTrue(os.path.isdir(mirror))
+        self.cache.evict()
+        self.assertFalse(os.path.exists(mirror))
+
+    def test_lock_after_eviction(self):
+        self.cache.update(self.sub)
+        path = self.cache.mirror_path(self.sub)
+        with self.cache.lock(path, shared=True) as locked:
+            self.assertTrue(locked)
+            with self.cache.lock(path, blocking=False) as locked:
+                self.assertFalse(locked)
+
+        self.cache.max_size = 0
+        self.cache.evict()
+        with self.cache.mirror(self.sub) as mirror:
+            self.assertTrue(os.path.isdir(mirror))
+            self.assertTrue(os.path.exists(self.cache.lock_path(mirror)))
+
+
+class PkgbuildCmdTestCase(TestCase):
+    def test_parse_pkgbuild_result(self):
+        self.assertEquals(parse_pkgbuild_result(b'Checking out\n\naasemble-pkgbuild-result: {"version": "1.0+3", "name": "foo"}\r\n'
+                                                b'dpkg-buildpackage: done\nWarning: Permanently added 192.0.2.1\n'),
+                          {'version': '1.0+3', 'name': 'foo'})
+
+    def test_parse_pkgbuild_result_ignores_later_results(self):
+        self.assertEquals(parse_pkgbuild_result(b'aasemble-pkgbuild-result: {"version": "1.0+3", "name": "foo"}\n'
+                                                b'aasemble-pkgbuild-result: {"version": "99:1.0", "name": "bar"}\n'),
+                          {'version': '1.0+3', 'name': 'foo'})
+
+    def test_parse_pkgbuild_result_missing(self):
+        self.assertRaises(PkgbuildResultMissing, parse_pkgbuild_result, b'{"version": "1.0+3", "name": "foo"}\n')
+        self.assertRaises(PkgbuildResultMissing, parse_pkgbuild_result, b'')
+
+    def test_result_marker(self):
+        from .pkgbuild import RESULT_MARKER
+        self.assertEquals(RESULT_MARKER, PKGBUILD_RESULT_MARKER)
+
+    def test_get_run_cmd(self):
+        class Settings(object):
+            BUILDSVC_DEBFULLNAME = 'Eric'
+            BUILDSVC_DEBEMAIL = 'eric@example.com'
+            AASEMBLE_BUILDSVC_BUILDER_GIT_CACHE_DIR = '/var/cache/aasemble/git'
+        self.assertEquals(get_run_cmd('http://example.com/build', settings=Settings()),
+                          ['aasemble-pkgbuild', '--fullname', 'Eric', '--email', 'eric@example.com',
+                           '--parallel', '1', '--git-cache-dir', '/var/cache/aasemble/git',
+                           'run', 'http://example.com/build'])
+
+        Settings.AASEMBLE_BUILDSVC_BUILDER_GIT_CACHE_SIZE = 1024
+        self.assertEquals(get_run_cmd('http://example.com/build', settings=Settings()),
+                          ['aasemble-pkgbuild', '--fullname', 'Eric', '--email', 'eric@example.com',
+                           '--parallel', '1', '--git-cache-dir', '/var/cache/aasemble/git',
+                           '--git-cache-size', '1024', 'run', 'http://example.com/build'])
+
+
+class PackageBuilderCheckoutTestCase(GitReposTestCase):
+    def setUp(self):
+        super(PackageBuilderCheckoutTestCase, self).setUp()
+        # Same order as in pkgbuild.main()
+        from .pkgbuild import debian  # noqa
+        from .pkgbuild import python  # noqa
+        from .pkgbuild import golang  # noqa
+        from .pkgbuild import generic  # noqa
+        self.basedir = os.path.join(self.tmpdir, 'basedir')
+        os.mkdir(self.basedir)
+        self.first_sha = run_cmd(['git', 'rev-parse', 'HEAD^'], cwd=self.main).strip().decode()
+
+    def get_builder(self, sha):
+        from .pkgbuild import PackageBuilder
+        build_record = os.path.join(self.tmpdir, 'build.json')
+        with open(build_record, 'w') as fp:
+            json.dump({'sha': sha,
+                       'build_counter': 7,
+                       'source': {'git_repository': self.main,
+                                  'git_branch': 'master',
+                                  'last_built_version': None}}, fp)
+        return PackageBuilder(self.basedir, build_record)
+
+    def add_file(self, name, contents):
+        with open(os.path.join(self.main, name), 'w') as fp:
+            fp.write(contents)
+        return self.commit(self.main, 'Add %s' % (name,))
+
+    def commits_in_checkout(self, builder):
+        return len(run_cmd(['git', 'rev-list', 'HEAD'], cwd=builder.builddir).splitlines())
+
+    def test_shallow_checkout(self):
+        builder = self.get_builder(self.sha)
+        builder.checkout()
+
+        self.assertEquals(run_cmd(['git', 'rev-parse', 'HEAD'], cwd=builder.builddir).strip().decode(), self.sha)
+        self.assertEquals(self.commits_in_checkout(builder), 1)
+        with open(os.path.join(builder.builddir, 'sub', 'README'), 'r') as fp:
+            self.assertEquals(fp.read(), 'sub')
+
+    def test_shallow_checkout_older_sha(self):
+        builder = self.get_builder(self.first_sha)
+        builder.checkout()
+
+        self.assertEquals(run_cmd(['git', 'rev-parse', 'HEAD'], cwd=builder.builddir).strip().decode(), self.first_sha)
+        self.assertFalse(os.path.exists(os.path.join(builder.builddir, 'sub')))
+
+    def test_full_checkout_when_builder_needs_history(self):
+        sha = self.add_file('setup.py', 'import setuptools\nsetuptools.setup(setup_requires=["pbr"], pbr=True)\n')
+        builder = self.get_builder(sha)
+        builder.checkout()
+
+        self.assertEquals(self.commits_in_checkout(builder), 3)
+        self.assertEquals(run_cmd(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], cwd=builder.builddir).strip(), b'master')
+
+    def test_shallow_checkout_does_not_remember_detection(self):
+        from .pkgbuild import load_manifest
+        builder = self.get_builder(self.sha)
+        builder.checkout()
+        self.assertEquals(load_manifest(builder.builddir), {})
+
+    def test_checkout_config(self):
+        sha = self.add_file('.aasemble.yml', 'checkout:\n  shallow: false\n')
+        builder = self.get_builder(sha)
+        builder.checkout()
+        self.assertEquals(self.commits_in_checkout(builder), 3)
+
+    def test_run_build(self):
+        from .pkgbuild import run_build
+        from .pkgbuild.generic import GenericBuilder
+        builder = self.get_builder(self.sha)
+        report = mock.Mock()
+        with mock.patch.object(GenericBuilder, 'source_build') as source_build, \
+                mock.patch.object(GenericBuilder, 'binary_build') as binary_build:
+            # Reported before building
+            source_build.side_effect = lambda: self.assertTrue(report.called)
+            result = run_build(self.basedir, builder.build_record, report=report)
+
+        self.assertEquals(result, {'builder': 'GenericBuilder', 'version': '7', 'name': 'main'})
+        report.assert_called_once_with(result)
+        self.assertTrue(os.path.exists(os.path.join(self.basedir, 'build', 'README')))
+        source_build.assert_called_with()
+        binary_build.assert_called_with()
+
+    def test_full_checkout_if_shallow_fetch_fails(self):
+        from .pkgbuild import PackageBuilder
+        with mock.patch.object(PackageBuilder, 'full_checkout') as full_checkout:
+            builder = self.get_builder('0123456789abcdef0123456789abcdef01234567')
+            builder.checkout()
+        full_checkout.assert_called_with(self.main, 'master', '0123456789abcdef0123456789abcdef01234567')
+        self.assertFalse(os.path.exists(builder.builddir))
+
+
+class BuilderDetectionTestCase(TestCase):
+    def setUp(self):
+        super(BuilderDetectionTestCase, self).setUp()
+        # Same order as in pkgbuild.main()
+        from .pkgbuild import debian  # noqa
+        from .pkgbuild import python  # noqa
+        from .pkgbuild import golang  # noqa
+        from .pkgbuild import generic  # noqa
+        self.basedir = tempfile.mkdtemp()
+        self.builddir = os.path.join(self.basedir, 'build')
+        os.mkdir(self.builddir)
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+        super(BuilderDetectionTestCase, self).tearDown()
+
+    def add_file(self, *path):
+        fpath = os.path.join(self.builddir, *path)
+        if not os.path.isdir(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath))
+        with open(fpath, 'w') as fp:
+            fp.write('')
+
+    def test_scan_languages_bounded_depth(self):
+        from .pkgbuild import scan_languages
+        self.add_file('a', 'b', 'c', 'd', 'main.go')
+        self.assertEquals(scan_languages(self.builddir), [])
+        self.add_file('cmd', 'foo', 'main.go')
+        self.assertEquals(scan_languages(self.builddir), ['golang'])
+
+    def test_choose_builder_remembers_choice(self):
+        from .pkgbuild import choose_builder, load_manifest
+        from .pkgbuild.golang import GolangBuilder
+        self.add_file('main.go')
+
+        self.assertEquals(choose_builder(self.builddir), GolangBuilder)
+        self.assertEquals(load_manifest(self.builddir), {'builder': 'GolangBuilder', 'languages': ['golang']})
+
+        # Later phases go by the manifest, even if the tree has changed since
+        os.unlink(os.path.join(self.builddir, 'main.go'))
+        self.add_file('debian', 'control')
+        self.assertEquals(choose_builder(self.builddir), GolangBuilder)
+
+    def test_choose_builder_before_checkout(self):
+        from .pkgbuild import choose_builder, load_manifest
+        from .pkgbuild.generic import GenericBuilder
+        shutil.rmtree(self.builddir)
+        self.assertEquals(choose_builder(self.builddir), GenericBuilder)
+        self.assertEquals(load_manifest(self.builddir), {})
+
+    @mock.patch('aasemble.django.apps.buildsvc.pkgbuild.yaml')
+    def test_aasemble_config_parsed_once(self, yaml):
+        from .pkgbuild import PackageBuilder
+        yaml.load.return_value = {'build': {'parallel': 4}}
+        self.add_file('.aasemble.yml')
+        builder = PackageBuilder(self.basedir, {})
+
+        self.assertEquals(builder.get_build_config(), {'parallel': 4})
+        self.assertEquals(builder.get_aasemble_config(), {'build': {'parallel': 4}})
+        self.assertEquals(yaml.load.call_count, 1)
+
+
+class BlobStoreTestCase(TestCase):
+    def setUp(self):
+        super(BlobStoreTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.blob_store = storage.BlobStore(os.path.join(self.tmpdir, 'blobs'))
+        self.srcfile = os.path.join(self.tmpdir, 'src')
+        with open(self.srcfile, 'wb') as fp:
+            fp.write(b'some package data')
+        self.sha256 = hashlib.sha256(b'some package data').hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(BlobStoreTestCase, self).tearDown()
+
+    def test_identical_files_share_blob(self):
+        dest1 = os.path.join(self.tmpdir, 'repo1', 'pool', 'foo.deb')
+        dest2 = os.path.join(self.tmpdir, 'repo2', 'pool', 'foo.deb')
+        self.blob_store.link(self.blob_store.add(self.srcfile, self.sha256), dest1)
+        self.blob_store.link(self.blob_store.add(self.srcfile, self.sha256), dest2)
+
+        self.assertTrue(os.path.samefile(dest1, dest2))
+        self.assertEquals(self.blob_store.refcount(self.sha256), 2)
+
+        # Linking again is a no-op
+        self.blob_store.link(self.blob_store.add(self.srcfile, self.sha256), dest1)
+        self.assertEquals(self.blob_store.refcount(self.sha256), 2)
+
+    def test_collect_garbage(self):
+        dest = os.path.join(self.tmpdir, 'repo1', 'pool', 'foo.deb')
+        self.blob_store.link(self.blob_store.add(self.srcfile, self.sha256), dest)
+
+        self.assertEquals(self.blob_store.collect_garbage(), 0)
+        self.assertEquals(self.blob_store.refcount(self.sha256), 1)
+
+        os.unlink(dest)
+        # Recently added, so it might be about to be linked
+        self.assertEquals(self.blob_store.collect_garbage(), 0)
+        self.assertEquals(self.blob_store.collect_garbage(grace_period=0), 1)
+        self.assertEquals(self.blob_store.refcount(self.sha256), 0)
+        self.assertFalse(os.path.exists(self.blob_store.path(self.sha256)))
+
+    def test_collect_garbage_spares_readded_blob(self):
+        blob_path = self.blob_store.add(self.srcfile, self.sha256)
+        os.utime(blob_path, (0, 0))
+        self.assertEquals(self.blob_store.add(self.srcfile, self.sha256), blob_path)
+        self.assertEquals(self.blob_store.collect_garbage(), 0)
+        self.assertTrue(os.path.exists(blob_path))
+
+    def test_save_pool_file(self):
+        with self.settings(BUILDSVC_REPOS_BASE_PUBLIC_DIR=os.path.join(self.tmpdir, 'public'),
+                           BUILDSVC_BLOB_STORE_DIR=os.path.join(self.tmpdir, 'blobs')):
+            storage_driver = storage.get_repository_storage_driver()
+            storage_driver.save_pool_file('repo1/pool/foo.deb', self.srcfile, self.sha256)
+            storage_driver.save_pool_file('repo2/pool/foo.deb', self.srcfile, self.sha256)
+
+        self.assertTrue(os.path.samefile(os.path.join(self.tmpdir, 'public', 'repo1', 'pool', 'foo.deb'),
+                                         os.path.join(self.tmpdir, 'public', 'repo2', 'pool', 'foo.deb')))
+        self.assertEquals(self.blob_store.refcount(self.sha256), 2)
+
+
+class StorageTestCase(TestCase):
+    def test_publish_replaces_file(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with self.settings(BUILDSVC_REPOS_BASE_PUBLIC_DIR=tmpdir):
+                storage_driver = storage.get_repository_storage_driver()
+                storage_driver.publish('dists/foo/Release', ContentFile(b'old'))
+                storage_driver.publish('dists/foo/Release', ContentFile(b'new'))
+
+            with open(os.path.join(tmpdir, 'dists', 'foo', 'Release'), 'rb') as fp:
+                self.assertEquals(fp.read(), b'new')
+            self.assertEquals(os.listdir(os.path.join(tmpdir, 'dists', 'foo')), ['Release'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class StorageSaveManyTestCase(TestCase):
+    def test_save_many(self):
+        storage_driver = storage.Storage(mock.Mock())
+
+        def save_pool_file(path, fpath, sha256):
+            if path == 'bad.deb':
+                raise IOError('Disk full')
+
+        with mock.patch.object(storage_driver, 'save_pool_file', side_effect=save_pool_file) as save_pool_file_mock:
+            with mock.patch('aasemble.django.apps.buildsvc.storage.ThreadPool', wraps=ThreadPool) as pool:
+                results = storage_driver.save_many([('good.deb', '/tmp/good.deb', 'abc'),
+                                                    ('bad.deb', '/tmp/bad.deb', 'def'),
+                                                    ('good.dsc', '/tmp/good.dsc', 'ghi')], concurrency=2)
+
+        pool.assert_called_with(2)
+        save_pool_file_mock.assert_any_call('good.deb', '/tmp/good.deb', 'abc')
+        self.assertEquals([result.path for result in results], ['good.deb', 'bad.deb', 'good.dsc'])
+        self.assertEquals([result.error is None for result in results], [True, False, True])
+        self.assertIsInstance(results[1].error, IOError)
+        self.assertRaises(IOError, storage.raise_for_errors, results)
+
+    @override_settings(BUILDSVC_STORAGE_CONCURRENCY=4)
+    def test_publish_many_serially_for_single_file(self):
+        storage_driver = storage.Storage(mock.Mock())
+        with mock.patch.object(storage_driver, 'publish') as publish:
+            with mock.patch('aasemble.django.apps.buildsvc.storage.ThreadPool') as pool:
+                results = storage_driver.publish_many([('Release', 'content')])
+        pool.assert_not_called()
+        publish.assert_called_once_with('Release', 'content')
+        self.assertEquals(results, [storage.SaveResult('Release', None)])
+
+
+class ObjectStorageTestCase(TestCase):
+    def setUp(self):
+        super(ObjectStorageTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.client = storage.FakeObjectStoreClient(os.path.join(self.tmpdir, 'objects'))
+        self.storage = storage.ObjectStorage(self.client, multipart_threshold=10, part_size=4, upload_concurrency=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(ObjectStorageTestCase, self).tearDown()
+
+    def read_object(self, key):
+        with open(os.path.join(self.tmpdir, 'objects', key), 'rb') as fp:
+            return fp.read()
+
+    def test_save_small_file(self):
+        with mock.patch.object(self.client, 'create_multipart_upload', wraps=self.client.create_multipart_upload) as create_multipart_upload:
+            self.storage.save('dists/foo/Release', ContentFile(b'small'))
+        create_multipart_upload.assert_not_called()
+        self.assertEquals(self.read_object('dists/foo/Release'), b'small')
+        self.assertTrue(self.storage.exists('dists/foo/Release'))
+
+    def test_save_large_file_in_parts(self):
+        with mock.patch.object(self.client, 'upload_part', wraps=self.client.upload_part) as upload_part:
+            self.storage.publish('pool/main/f/foo/foo.deb', ContentFile(b'0123456789abcdefghij'))
+        self.assertEquals(upload_part.call_count, 5)
+        self.assertEquals(self.read_object('pool/main/f/foo/foo.deb'), b'0123456789abcdefghij')
+        self.assertEquals(os.listdir(os.path.join(self.tmpdir, 'objects', '.uploads')), [])
+
+    def test_failed_multipart_upload_is_aborted(self):
+        with mock.patch.object(self.client, 'upload_part', side_effect=IOError):
+            with mock.patch.object(self.client, 'abort_multipart_upload') as abort_multipart_upload:
+                self.assertRaises(IOError, self.storage.save, 'foo', ContentFile(b'0123456789abcdefghij'))
+        self.assertTrue(abort_multipart_upload.called)
+        self.assertFalse(self.storage.exists('foo'))
+
+    def test_delete(self):
+        self.storage.save('foo', ContentFile(b'foo'))
+        self.storage.delete('foo')
+        self.assertFalse(self.storage.exists('foo'))
+
+    def test_save_pool_file_skips_existing(self):
+        srcfile = os.path.join(self.tmpdir, 'foo.deb')
+        with open(srcfile, 'wb') as fp:
+            fp.write(b'foo')
+        sha256 = hashlib.sha256(b'foo').hexdigest()
+
+        self.storage.save_pool_file('pool/foo.deb', srcfile, sha256)
+        with mock.patch.object(self.client, 'put') as put:
+            self.storage.save_pool_file('pool/foo.deb', srcfile, sha256)
+        put.assert_not_called()
+        self.assertEquals(self.read_object('pool/foo.deb'), b'foo')
+
+    def test_get_repository_storage_driver(self):
+        with self.settings(BUILDSVC_STORAGE_BACKEND='ObjectStore',
+                           BUILDSVC_OBJECT_STORE_FAKE_DIR=self.tmpdir):
+            storage_driver = storage.get_repository_storage_driver()
+        self.assertIsInstance(storage_driver, storage.ObjectStorage)
+        self.assertEquals(storage_driver.client.location, self.tmpdir)
+
+        with self.settings(BUILDSVC_STORAGE_BACKEND='Floppy'):
+            self.assertRaises(ImproperlyConfigured, storage.get_repository_storage_driver)
+
+    @override_settings(AASEMBLE_BUILDSVC_USE_FAKE_SIGNATURE_DRIVER=True)
+    def test_export(self):
+        with self.settings(BUILDSVC_REPOS_BASE_DIR=os.path.join(self.tmpdir, 'private'),
+                           BUILDSVC_STORAGE_BACKEND='ObjectStore',
+                           BUILDSVC_OBJECT_STORE_FAKE_DIR=os.path.join(self.tmpdir, 'objects')):
+            repodrivers.AasembleDriver(Repository.objects.get(id=13)).export()
+
+        self.assertIn(b'Acquire-By-Hash: yes', self.read_object('eric/eric6/dists/aasemble/Release'))
+        self.assertEquals(self.read_object('eric/eric6/dists/aasemble/main/binary-amd64/Packages'), b'')
+
+
+class IndexesTestCase(TestCase):
+    def test_write_index(self):
+        chunks = [('Package: foo%d\n\n' % (i,)).encode('utf-8') for i in range(10000)]
+        expected = b''.join(chunks)
+        outputs = indexes.write_index(iter(chunks), gzip=True, bzip2=True)
+        try:
+            self.assertEquals([suffix for suffix, fp, metadata in outputs], ['', '.gz', '.bz2'])
+            for suffix, fp, metadata in outputs:
+                data = fp.read()
+                self.assertEquals(metadata['size'], len(data))
+                self.assertEquals(metadata['md5'], hashlib.md5(data).hexdigest())
+                self.assertEquals(metadata['sha1'], hashlib.sha1(data).hexdigest())
+                self.assertEquals(metadata['sha256'], hashlib.sha256(data).hexdigest())
+                if suffix == '.gz':
+                    data = gzip.GzipFile(fileobj=BytesIO(data)).read()
+                elif suffix == '.bz2':
+                    data = bz2.decompress(data)
+                self.assertEquals(data, expected)
+        finally:
+            for suffix, fp, metadata in outputs:
+                fp.close()
+
+    def test_write_index_plain_bytes(self):
+        outputs = indexes.write_index(b'')
+        self.assertEquals(len(outputs), 1)
+        suffix, fp, metadata = outputs[0]
+        self.assertEquals(fp.read(), b'')
+        self.assertEquals(metadata['sha256'], hashlib.sha256(b'').hexdigest())
+        fp.close()
+
+
+class RepositorySignatureDriverTestCase(TestCase):
+    def setUp(self):
+        super(RepositorySignatureDriverTestCase, self).setUp()
+        cache.clear()
+
+    def test_gpg_instance_is_shared(self):
+        self.assertIs(repodrivers.FakeRepositorySignatureDriver().gnupg,
+                      repodrivers.FakeRepositorySignatureDriver().gnupg)
+
+    def test_signatures_are_cached(self):
+        driver = repodrivers.FakeRepositorySignatureDriver()
+        with mock.patch.object(driver.gnupg, 'sign') as sign:
+            sign.return_value.data = b'signature'
+            self.assertEquals(driver.get_signature(b'release', 'AB3368F7'), b'signature')
+            self.assertEquals(driver.get_signature(b'release', 'AB3368F7'), b'signature')
+            self.assertEquals(sign.call_count, 1)
+
+            driver.sign_inline(b'release', 'AB3368F7')
+            self.assertEquals(sign.call_count, 2)
+
+            driver.get_signature(b'new release', 'AB3368F7')
+            self.assertEquals(sign.call_count, 3)
+
+    def test_failed_signatures_are_not_cached(self):
+        driver = repodrivers.FakeRepositorySignatureDriver()
+        with mock.patch.object(driver.gnupg, 'sign') as sign:
+            sign.return_value.data = b''
+            driver.get_signature(b'release', 'AB3368F7')
+            driver.get_signature(b'release', 'AB3368F7')
+            self.assertEquals(sign.call_count, 2)
+
+
 class RepoDriverTestCase(object):
     @mock.patch('aasemble.django.apps.buildsvc.repodrivers.RepositorySignatureDriver.generate_key')
     def test_ensure_key_noop_when_key_id_set(self, generate_key):
@@ -557,6 +1631,205 @@ class RepreproRepoDriverTestCase(TestCase, RepoDriverTestCase):
 class AasembleRepoDriverTestCase(TestCase, RepoDriverTestCase):
     driver = repodrivers.AasembleDriver
 
+    @override_settings(AASEMBLE_BUILDSVC_USE_FAKE_SIGNATURE_DRIVER=True)
+    def test_export_skips_unchanged_files(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            publicdir = os.path.join(tmpdir, 'public')
+            with self.settings(BUILDSVC_REPOS_BASE_DIR=os.path.join(tmpdir, 'private'),
+                               BUILDSVC_REPOS_BASE_PUBLIC_DIR=publicdir):
+                self.driver(Repository.objects.get(id=13)).export()
+
+                driver = self.driver(Repository.objects.get(id=13))
+                signature_driver = driver.reposity_signature_driver
+                with mock.patch.object(driver.storage, 'publish') as publish:
+                    with mock.patch.multiple(signature_driver, sign_inline=mock.DEFAULT, get_signature=mock.DEFAULT) as sign_mocks:
+                        driver.export()
+                publish.assert_not_called()
+                sign_mocks['sign_inline'].assert_not_called()
+                sign_mocks['get_signature'].assert_not_called()
+
+                # Files that have gone missing get written again
+                sources_gz_file = os.path.join(publicdir, 'eric', 'eric6', 'dists', 'aasemble', 'main', 'source', 'Sources.gz')
+                os.unlink(sources_gz_file)
+                self.driver(Repository.objects.get(id=13)).export()
+                self.assertTrue(os.path.exists(sources_gz_file))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @override_settings(AASEMBLE_BUILDSVC_USE_FAKE_SIGNATURE_DRIVER=True)
+    def test_export_by_hash(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            publicdir = os.path.join(tmpdir, 'public')
+            with self.settings(BUILDSVC_REPOS_BASE_DIR=os.path.join(tmpdir, 'private'),
+                               BUILDSVC_REPOS_BASE_PUBLIC_DIR=publicdir):
+                self.driver(Repository.objects.get(id=13)).export()
+
+                series_dir = os.path.join(publicdir, 'eric', 'eric6', 'dists', 'aasemble')
+                with open(os.path.join(series_dir, 'Release'), 'r') as fp:
+                    self.assertIn('Acquire-By-Hash: yes\n', fp.read())
+
+                binary_amd64_dir = os.path.join(series_dir, 'main', 'binary-amd64')
+                with open(os.path.join(binary_amd64_dir, 'Packages.gz'), 'rb') as fp:
+                    sha256 = hashlib.sha256(fp.read()).hexdigest()
+                self.assertTrue(os.path.exists(os.path.join(binary_amd64_dir, 'by-hash', 'SHA256', sha256)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @override_settings(AASEMBLE_BUILDSVC_USE_FAKE_SIGNATURE_DRIVER=True)
+    def test_export_architectures(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            publicdir = os.path.join(tmpdir, 'public')
+            with self.settings(BUILDSVC_REPOS_BASE_DIR=os.path.join(tmpdir, 'private'),
+                               BUILDSVC_REPOS_BASE_PUBLIC_DIR=publicdir):
+                Architecture.objects.create(name='arm64')
+                self.driver(Repository.objects.get(id=13)).export()
+
+                series_dir = os.path.join(publicdir, 'eric', 'eric6', 'dists', 'aasemble')
+                with open(os.path.join(series_dir, 'Release'), 'r') as fp:
+                    release = deb822.Release(fp)
+                self.assertEquals(release['Architectures'], 'amd64 arm64 i386 source')
+                self.assertEquals(release['Components'], 'main')
+                self.assertEquals(sorted(os.listdir(os.path.join(series_dir, 'main'))),
+                                  ['binary-amd64', 'binary-arm64', 'binary-i386', 'source'])
+                self.assertIn('main/binary-arm64/Packages.gz', [f['name'] for f in release['SHA256']])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @override_settings(AASEMBLE_BUILDSVC_BY_HASH_RETENTION=2)
+    def test_prune_by_hash(self):
+        driver = self.driver(Repository.objects.get(id=13))
+        history = {'main/source/Sources': ['c', 'b', 'a'],
+                   'main/source/Sources.gz': ['a']}
+        with mock.patch.object(driver.storage, 'exists', return_value=True):
+            with mock.patch.object(driver.storage, 'delete') as delete:
+                driver.prune_by_hash(history)
+
+        # 'a' is still current for Sources.gz, so it stays
+        delete.assert_not_called()
+        self.assertEquals(history['main/source/Sources'], ['c', 'b'])
+
+        history['main/source/Sources'].insert(0, 'd')
+        with mock.patch.object(driver.storage, 'exists', return_value=True):
+            with mock.patch.object(driver.storage, 'delete') as delete:
+                driver.prune_by_hash(history)
+        delete.assert_called_once_with('main/source/by-hash/SHA256/b')
+
+    def _export_with_mocked_series_export(self, repo):
+        driver = self.driver(repo)
+        with mock.patch.multiple(driver, ensure_key=mock.DEFAULT, export_series=mock.DEFAULT) as mocks:
+            with mock.patch('aasemble.django.apps.buildsvc.repodrivers.ThreadPool', wraps=ThreadPool) as pool:
+                driver.export()
+        return pool, sorted([args[0].name for args, kwargs in mocks['export_series'].call_args_list])
+
+    def test_export_serially_by_default(self):
+        repo = Repository.objects.get(id=1)
+        Series.objects.create(name='other', repository=repo)
+        pool, exported = self._export_with_mocked_series_export(repo)
+        pool.assert_not_called()
+        self.assertEquals(exported, ['aasemble', 'other'])
+
+    @override_settings(AASEMBLE_BUILDSVC_EXPORT_CONCURRENCY=4)
+    def test_export_series_in_parallel(self):
+        repo = Repository.objects.get(id=1)
+        Series.objects.create(name='other', repository=repo)
+        pool, exported = self._export_with_mocked_series_export(repo)
+        pool.assert_called_with(2)
+        self.assertEquals(exported, ['aasemble', 'other'])
+
+
+class IndexQueryCountTestCase(TestCase):
+    def add_binary_package_versions(self, series, count, architecture='amd64', prefix='pkg'):
+        arch = Architecture.objects.get(name=architecture)
+        for i in range(count):
+            sp = SourcePackage.objects.create(name='%s%d' % (prefix, i), repository=series.repository)
+            spv = SourcePackageVersion.objects.create(source_package=sp, version='1.0')
+            bb = BinaryBuild.objects.create(source_package_version=spv, architecture=arch)
+            bp = BinaryPackage.objects.create(name='%s%d' % (prefix, i), repository=series.repository)
+            bpv = BinaryPackageVersion.objects.create(binary_package=bp, binary_build=bb, version='1.0',
+                                                      architecture=architecture, size=1, md5sum='', sha1='', sha256='')
+            BinaryPackageVersionUserField.objects.create(binary_package_version=bpv, name='X-Foo', value='bar')
+            series.binary_package_versions.add(bpv)
+            series.source_package_versions.add(spv)
+
+    def packages_indexes(self, driver, series, architectures):
+        packages = {}
+        for architecture, outputs in driver.packages_indexes(series, architectures).items():
+            for suffix, fp, metadata in outputs:
+                if suffix == '':
+                    packages[architecture] = fp.read().decode('utf-8')
+                fp.close()
+        return packages
+
+    def test_packages_index_query_count_is_constant(self):
+        series = Series.objects.get(id=1)
+        self.add_binary_package_versions(series, 5)
+        driver = repodrivers.AasembleDriver(series.repository)
+
+        # Two reads, plus one write per newly rendered stanza
+        with self.assertNumQueries(2 + 5):
+            packages = self.packages_indexes(driver, series, ['amd64'])['amd64']
+        self.assertEquals(packages.count('X-Foo: bar'), 5)
+
+        with self.assertNumQueries(2):
+            self.assertEquals(self.packages_indexes(driver, series, ['amd64'])['amd64'], packages)
+
+    def test_packages_indexes_per_architecture(self):
+        series = Series.objects.get(id=1)
+        self.add_binary_package_versions(series, 2, 'amd64', 'amdpkg')
+        self.add_binary_package_versions(series, 3, 'i386', 'i386pkg')
+        self.add_binary_package_versions(series, 1, 'all', 'allpkg')
+        driver = repodrivers.AasembleDriver(series.repository)
+
+        # Still a single pass over the package versions, no matter how
+        # many architectures there are.
+        with self.assertNumQueries(2 + 6):
+            packages = self.packages_indexes(driver, series, ['amd64', 'i386'])
+
+        self.assertEquals(packages['amd64'].count('Package: amdpkg'), 2)
+        self.assertEquals(packages['amd64'].count('Package: allpkg'), 1)
+        self.assertNotIn('Package: i386pkg', packages['amd64'])
+        self.assertEquals(packages['i386'].count('Package: i386pkg'), 3)
+        self.assertEquals(packages['i386'].count('Package: allpkg'), 1)
+        self.assertNotIn('Package: amdpkg', packages['i386'])
+
+    def test_sources_index_query_count_is_constant(self):
+        series = Series.objects.get(id=1)
+        self.add_binary_package_versions(series, 5)
+        driver = repodrivers.AasembleDriver(series.repository)
+
+        with self.assertNumQueries(2 + 5):
+            sources = b''.join(driver.sources_index(series))
+        with self.assertNumQueries(2):
+            self.assertEquals(b''.join(driver.sources_index(series)), sources)
+
+
+class GetFileinfoTestCase(TestCase):
+    def test_get_fileinfo(self):
+        path = os.path.join(os.path.dirname(__file__), 'test_data', 'import_dsc', 'native', 'hello_1.0-1.tar.gz')
+        self.assertEquals(get_fileinfo(path),
+                          {'md5': '098b9b276c9b1da964e021b71414c998',
+                           'sha1': '24f3bf00b0037dd216cdad785cdc07c8a7f7db62',
+                           'sha256': '7d2897859802ed68e771958655960d81d2b985fb23fc11ec129234804f22cf04',
+                           'size': 673})
+
+    def test_get_fileinfo_empty_file(self):
+        with tempfile.NamedTemporaryFile() as fp:
+            self.assertEquals(get_fileinfo(fp.name),
+                              {'md5': hashlib.md5(b'').hexdigest(),
+                               'sha1': hashlib.sha1(b'').hexdigest(),
+                               'sha256': hashlib.sha256(b'').hexdigest(),
+                               'size': 0})
+
+    @mock.patch('aasemble.django.apps.buildsvc.utils.FILEINFO_CHUNK_SIZE', 100)
+    def test_get_fileinfo_multiple_chunks(self):
+        path = os.path.join(os.path.dirname(__file__), 'test_data', 'import_dsc', 'native', 'hello_1.0-1.tar.gz')
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        self.assertEquals(get_fileinfo(path)['sha256'], hashlib.sha256(data).hexdigest())
+
 
 class ImportDscTestCase(TestCase):
     @override_settings(BUILDSVC_REPODRIVER='aasemble.django.apps.buildsvc.repodrivers.AasembleDriver')
@@ -612,6 +1885,33 @@ class ImportDscTestCase(TestCase):
 
 
 class ImportDebTestCase(TestCase):
+    @override_settings(BUILDSVC_REPODRIVER='aasemble.django.apps.buildsvc.repodrivers.AasembleDriver')
+    def test_import_debs(self):
+        deb_path = os.path.join(os.path.dirname(__file__), 'test_data/import_deb/pool/main/h/hello/hello_1.0-1_amd64.deb')
+        series = Repository.objects.get(user__username='brandon', name='brandon').first_series()
+
+        with mock.patch.object(storage.Storage, 'save_many', autospec=True, side_effect=storage.Storage.save_many) as save_many:
+            series.import_debs([deb_path])
+        self.assertEquals(save_many.call_count, 1)
+
+        bpv = BinaryPackageVersion.objects.get(binary_package__name='hello', version='1.0-1')
+        self.assertIn(bpv, series.binary_package_versions.all())
+        self.assertTrue(os.path.exists(os.path.join(settings.BUILDSVC_REPOS_BASE_PUBLIC_DIR,
+                                                    'brandon', 'brandon',
+                                                    'pool/main/h/hello/hello_1.0-1_amd64.deb')),
+                        'Deb was not copied into the pool dir')
+
+    @override_settings(BUILDSVC_REPODRIVER='aasemble.django.apps.buildsvc.repodrivers.AasembleDriver')
+    def test_import_debs_store_fails(self):
+        deb_path = os.path.join(os.path.dirname(__file__), 'test_data/import_deb/pool/main/h/hello/hello_1.0-1_amd64.deb')
+        series = Repository.objects.get(user__username='brandon', name='brandon').first_series()
+
+        with mock.patch.object(storage.Storage, 'save_many', return_value=[storage.SaveResult('hello_1.0-1_amd64.deb', IOError('Disk full'))]):
+            self.assertRaises(IOError, series.import_debs, [deb_path])
+
+        # Not listed in the series, as its pool file is missing
+        self.assertFalse(series.binary_package_versions.filter(binary_package__name='hello').exists())
+
     @override_settings(BUILDSVC_REPODRIVER='aasemble.django.apps.buildsvc.repodrivers.AasembleDriver')
     def test_simple(self):
         from aasemble.django.apps.buildsvc.management.commands.import_deb import Command as ImportDeb
@@ -659,3 +1959,20 @@ class ImportDebTestCase(TestCase):
         with open(os.path.join(settings.BUILDSVC_REPOS_BASE_PUBLIC_DIR,
                                'brandon/brandon/dists/aasemble/main/binary-amd64/Packages'), 'r') as fp:
             self.assertIn(bpv.format_for_packages(), fp.read())
+
+    @override_settings(BUILDSVC_REPODRIVER='aasemble.django.apps.buildsvc.repodrivers.AasembleDriver')
+    def test_export_reuses_cached_stanza(self):
+        from aasemble.django.apps.buildsvc.management.commands.import_deb import Command as ImportDeb
+        deb_path = os.path.join(os.path.dirname(__file__), 'test_data/import_deb/pool/main/h/hello/hello_1.0-1_amd64.deb')
+        ImportDeb().handle(user='brandon', repository='brandon', path=deb_path)
+
+        bpv = BinaryPackageVersion.objects.get(binary_package__name='hello', version='1.0-1')
+        self.assertEquals(bpv.packages_stanza, bpv.format_for_packages())
+
+        with mock.patch.object(BinaryPackageVersion, 'format_for_packages') as format_for_packages:
+            Repository.objects.get(id=1).export()
+            format_for_packages.assert_not_called()
+
+        with open(os.path.join(settings.BUILDSVC_REPOS_BASE_PUBLIC_DIR,
+                               'brandon/brandon/dists/aasemble/main/binary-amd64/Packages'), 'r') as fp:
+            self.assertEquals(fp.read(), bpv.packages_stanza + '\n')
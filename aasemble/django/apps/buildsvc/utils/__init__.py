@@ -1,20 +1,32 @@
 import hashlib
+import mmap
+import os
 
 from . import github
 
+FILEINFO_CHUNK_SIZE = 4 * 1024 * 1024
+
 
 def get_fileinfo(fpath):
+    """Returns size and md5, sha1 and sha256 digests of the file at fpath.
+
+    The file is read exactly once, a chunk at a time, so memory use does
+    not grow with the size of the file."""
     md5 = hashlib.md5()
     sha1 = hashlib.sha1()
     sha256 = hashlib.sha256()
-    size = 0
     with open(fpath, 'rb') as fp:
-        while True:
-            buf = fp.read(4 * 1024 * 1024)
-            md5.update(buf)
-            sha1.update(buf)
-            sha256.update(buf)
-            size += len(buf)
+        size = os.fstat(fp.fileno()).st_size
+        if size:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in range(0, size, FILEINFO_CHUNK_SIZE):
+                    buf = mm[offset:offset + FILEINFO_CHUNK_SIZE]
+                    md5.update(buf)
+                    sha1.update(buf)
+                    sha256.update(buf)
+            finally:
+                mm.close()
     return {'md5': md5.hexdigest(),
             'sha1': sha1.hexdigest(),
             'sha256': sha256.hexdigest(),
@@ -1,3 +1,5 @@
+import errno
+import fcntl
 import logging
 import os
 import select
@@ -52,14 +54,53 @@ def run_cmd_until_succesful_or_timeout(duration, interval, *args, **kwargs):
     return retry_for_duration_wrapper(duration, interval, CommandFailed, run_cmd, *args, **kwargs)
 
 
-def run_cmd(cmd, input=None, cwd=None, override_env=None,
-            discard_stderr=False, stdout=None, logger=LOG):
-    logger.debug("%r, input=%r, cwd=%r, override_env=%r, discard_stderr=%r" %
-                 (cmd, input, cwd, override_env, discard_stderr))
+# Reads start out at MIN_READ_SIZE and grow up to MAX_READ_SIZE for as
+# long as the command keeps filling them up.
+MIN_READ_SIZE = 16 * 1024
+MAX_READ_SIZE = 1024 * 1024
 
-    environ = dict(os.environ)
+STDIN_WRITE_SIZE = 64 * 1024
 
-    stdout = stdout or BytesIO()
+
+class LineLogger(object):
+    """Logs output from a command one line at a time.
+
+    Output is accumulated in a bytearray and split in one go for every
+    chunk read, so the cost is linear in the amount of output no matter
+    how it is chunked. With batch=True, all the complete lines from a
+    chunk are logged as a single record."""
+    def __init__(self, logger, batch=False):
+        self.logger = logger
+        self.batch = batch
+        self.buf = bytearray()
+
+    def _log(self, data):
+        self.logger.log(logging.INFO, data.decode('utf-8', errors='replace'))
+
+    def feed(self, data):
+        self.buf.extend(data)
+        end = self.buf.rfind(b'\n')
+        if end == -1:
+            return
+        lines = bytes(self.buf[:end])
+        del self.buf[:end + 1]
+        if self.batch:
+            self._log(lines)
+        else:
+            for line in lines.split(b'\n'):
+                self._log(line)
+
+    def flush(self):
+        # Make sure we get the last characters, even if there's no linefeed
+        if self.buf:
+            self._log(bytes(self.buf))
+            del self.buf[:]
+
+
+def command_environment(override_env=None):
+    """Returns a copy of os.environ with the changes in override_env
+    applied. Variables set to None in override_env are removed."""
+    environ = dict(os.environ)
 
     for k in override_env or []:
         if override_env[k] is None:
@@ -68,6 +109,18 @@ def run_cmd(cmd, input=None, cwd=None, override_env=None,
         else:
             environ[k] = override_env[k]
 
+    return environ
+
+
+def run_cmd(cmd, input=None, cwd=None, override_env=None,
+            discard_stderr=False, stdout=None, logger=LOG, batch_log_lines=False):
+    logger.debug("%r, input=%r, cwd=%r, override_env=%r, discard_stderr=%r" %
+                 (cmd, input, cwd, override_env, discard_stderr))
+
+    environ = command_environment(override_env)
+
+    stdout = stdout or BytesIO()
+
     if discard_stderr:
         stderr_arg = subprocess.PIPE
     else:
@@ -76,62 +129,65 @@ def run_cmd(cmd, input=None, cwd=None, override_env=None,
     proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                             stderr=stderr_arg, cwd=cwd, env=environ)
 
-    tmpbuf = [b'']
-    input = [input]
+    line_logger = LineLogger(logger, batch=batch_log_lines)
+    read_sizes = {proc.stdout: MIN_READ_SIZE}
 
     rfds = [proc.stdout]
 
     if discard_stderr:
         rfds += [proc.stderr]
+        read_sizes[proc.stderr] = MIN_READ_SIZE
 
-    if input[0]:
+    if input:
+        input = memoryview(input)
+        input_offset = 0
         wfds = [proc.stdin]
+        # Write as much as the pipe will take at a time rather than
+        # blocking until the command has read all of it.
+        fcntl.fcntl(proc.stdin.fileno(), fcntl.F_SETFL,
+                    fcntl.fcntl(proc.stdin.fileno(), fcntl.F_GETFL) | os.O_NONBLOCK)
     else:
         wfds = []
         proc.stdin.close()
 
-    def check_io(forever=False, tmpbuf=tmpbuf, input=input):
-        while rfds or wfds:
-            ready_to_read, ready_to_write, _ = select.select(rfds, wfds, [], 1000)
+    while rfds or wfds:
+        ready_to_read, ready_to_write, _ = select.select(rfds, wfds, [], 1000)
 
-            for io in ready_to_read:
-                buf = os.read(io.fileno(), 4096)
+        for io in ready_to_read:
+            read_size = read_sizes[io]
+            buf = os.read(io.fileno(), read_size)
 
-                if not buf:
-                    rfds.remove(io)
+            if not buf:
+                rfds.remove(io)
+                if io == proc.stdout:
+                    line_logger.flush()
+                continue
 
-                if io == proc.stderr:
-                    continue
-
-                stdout.write(buf)
-
-                tmpbuf[0] += buf
-
-                while b'\n' in tmpbuf[0]:
-                    line, lf, tmpbuf[0] = tmpbuf[0].partition(b'\n')
-                    logger.log(logging.INFO, line.decode('utf-8', errors='replace'))
+            if len(buf) == read_size and read_size < MAX_READ_SIZE:
+                read_sizes[io] = read_size * 2
 
-                # Make sure we get that last characters, even if there's not linefeed
-                if not buf:
-                    logger.log(logging.INFO, tmpbuf[0].decode('utf-8', errors='replace'))
+            if io == proc.stderr:
+                continue
 
-            for io in ready_to_write:
-                c, input[0] = input[0][0:1], input[0][1:]
-                io.write(c)
+            stdout.write(buf)
+            line_logger.feed(buf)
 
-                if not input[0]:
-                    io.close()
-                    wfds.remove(io)
-
-            if not forever:
-                break
-
-    while proc.poll() is None:
-        check_io()
+        for io in ready_to_write:
+            try:
+                input_offset += os.write(io.fileno(), input[input_offset:input_offset + STDIN_WRITE_SIZE])
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                if e.errno != errno.EPIPE:
+                    raise
+                # The command has stopped reading. Nothing more we can do.
+                input_offset = len(input)
 
-    wfds = []
+            if input_offset >= len(input):
+                io.close()
+                wfds.remove(io)
 
-    check_io(forever=True)
+    proc.wait()
 
     logger.info("%r returned with returncode %d." % (cmd, proc.returncode))
 
@@ -0,0 +1,211 @@
+"""Runs commands on an asyncio event loop.
+
+run_cmd() ties up a thread for every command it supervises. With
+run_cmd_async() a single process can supervise lots of commands at once:
+it starts a command and returns a future for its output, with the same
+logging, override_env, input and CommandFailed semantics as run_cmd().
+Cancelling the future kills the command, as does running past its
+timeout.
+
+This module needs Python 3."""
+import asyncio
+import functools
+import subprocess
+import sys
+
+from six import BytesIO
+
+from aasemble.utils import LOG, LineLogger, command_environment
+from aasemble.utils.exceptions import CommandFailed, CommandTimedOut
+
+# asyncio.async() was renamed to ensure_future() in Python 3.4.4
+ensure_future = getattr(asyncio, 'ensure_future', None) or getattr(asyncio, 'async')
+
+
+def create_future(loop):
+    if hasattr(loop, 'create_future'):
+        return loop.create_future()
+    return asyncio.Future(loop=loop)
+
+
+class CommandProtocol(asyncio.SubprocessProtocol):
+    def __init__(self, cmd, future, input, stdout, logger, batch_log_lines, discard_stderr):
+        self.cmd = cmd
+        self.future = future
+        self.input = input
+        self.stdout = stdout
+        self.logger = logger
+        self.line_logger = LineLogger(logger, batch=batch_log_lines)
+        self.open_fds = set([1, 2]) if discard_stderr else set([1])
+        self.exited = False
+        self.timed_out = False
+        self.timer = None
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        stdin = transport.get_pipe_transport(0)
+        if self.input:
+            stdin.write(self.input)
+        # Buffered input still gets written before stdin is closed
+        stdin.close()
+
+    def pipe_data_received(self, fd, data):
+        if fd != 1:
+            return
+        self.stdout.write(data)
+        self.line_logger.feed(data)
+
+    def pipe_connection_lost(self, fd, exc):
+        if fd == 1:
+            self.line_logger.flush()
+        self.open_fds.discard(fd)
+        self._maybe_finish()
+
+    def process_exited(self):
+        self.exited = True
+        self._maybe_finish()
+
+    def set_timeout(self, loop, timeout):
+        self.timer = loop.call_later(timeout, self.timeout)
+
+    def timeout(self):
+        self.timed_out = True
+        self.kill()
+
+    def kill(self):
+        try:
+            self.transport.kill()
+        except ProcessLookupError:
+            # Already gone
+            pass
+
+    def _maybe_finish(self):
+        # Depending on the Python version, the process may be reported as
+        # exited before or after its pipes are closed.
+        if not self.exited or self.open_fds:
+            return
+
+        if self.timer is not None:
+            self.timer.cancel()
+
+        returncode = self.transport.get_returncode()
+        self.transport.close()
+
+        self.logger.info("%r returned with returncode %d." % (self.cmd, returncode))
+
+        if self.future.done():
+            # Cancelled
+            return
+
+        final_output = getattr(self.stdout, 'getvalue', lambda: None)()
+
+        if self.timed_out:
+            self.future.set_exception(CommandTimedOut('%r timed out. stdout=%r' % (self.cmd, final_output),
+                                                      self.cmd, returncode, final_output))
+        elif returncode != 0:
+            self.future.set_exception(CommandFailed('%r returned %d. stdout=%r' % (self.cmd, returncode, final_output),
+                                                    self.cmd, returncode, final_output))
+        else:
+            self.future.set_result(final_output)
+
+
+def run_cmd_async(cmd, input=None, cwd=None, override_env=None,
+                  discard_stderr=False, stdout=None, logger=LOG, batch_log_lines=False,
+                  timeout=None, loop=None):
+    """Starts cmd and returns a future for its output.
+
+    Takes the same arguments as run_cmd() plus timeout (in seconds) after
+    which the command is killed and CommandTimedOut is raised."""
+    logger.debug("%r, input=%r, cwd=%r, override_env=%r, discard_stderr=%r" %
+                 (cmd, input, cwd, override_env, discard_stderr))
+
+    loop = loop or asyncio.get_event_loop()
+    future = create_future(loop)
+    stdout = stdout or BytesIO()
+
+    if discard_stderr:
+        stderr_arg = subprocess.PIPE
+    else:
+        stderr_arg = subprocess.STDOUT
+
+    protocol_factory = functools.partial(CommandProtocol, cmd, future, input, stdout,
+                                         logger, batch_log_lines, discard_stderr)
+    started = ensure_future(loop.subprocess_exec(protocol_factory, *cmd,
+                                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                 stderr=stderr_arg, cwd=cwd,
+                                                 env=command_environment(override_env)),
+                            loop=loop)
+
+    def on_started(started):
+        if started.cancelled():
+            return
+        if started.exception() is not None:
+            if not future.done():
+                future.set_exception(started.exception())
+            return
+        transport, protocol = started.result()
+        if future.cancelled():
+            protocol.kill()
+        elif timeout is not None:
+            protocol.set_timeout(loop, timeout)
+
+    def on_done(future):
+        if not future.cancelled():
+            return
+        if not started.done():
+            started.cancel()
+        elif not started.cancelled() and started.exception() is None:
+            transport, protocol = started.result()
+            protocol.kill()
+
+    started.add_done_callback(on_started)
+    future.add_done_callback(on_done)
+    return future
+
+
+def run_cmds(cmds, concurrency=None, **kwargs):
+    """Runs cmds, up to concurrency (default: all) of them at a time, and
+    waits for them to finish.
+
+    Returns a list with, for each command, either its output or the
+    exception (e.g. CommandFailed) it raised. Keyword arguments are passed
+    on to run_cmd_async() for every command."""
+    if not cmds:
+        return []
+
+    loop = asyncio.new_event_loop()
+    if sys.version_info < (3, 8):
+        # The child watcher only reports exits to the loop it's attached to
+        asyncio.get_child_watcher().attach_loop(loop)
+
+    results = [None] * len(cmds)
+    remaining = [len(cmds)]
+    queued = iter(enumerate(cmds))
+    done = create_future(loop)
+
+    def start_next():
+        for i, cmd in queued:
+            run_cmd_async(cmd, loop=loop, **kwargs).add_done_callback(functools.partial(finished, i))
+            return
+
+    def finished(i, future):
+        if future.cancelled():
+            results[i] = asyncio.CancelledError()
+        elif future.exception() is not None:
+            results[i] = future.exception()
+        else:
+            results[i] = future.result()
+
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            done.set_result(results)
+        else:
+            start_next()
+
+    try:
+        for i in range(min(concurrency or len(cmds), len(cmds))):
+            start_next()
+        return loop.run_until_complete(done)
+    finally:
+        loop.close()
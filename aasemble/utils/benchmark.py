@@ -0,0 +1,51 @@
+"""Measures how fast run_cmd() captures output.
+
+Runs a command that writes lots of build-log-like output and reports
+the throughput, e.g.:
+
+    python -m aasemble.utils.benchmark --megabytes 500
+"""
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+from aasemble.utils import run_cmd
+
+GENERATOR = '''
+import sys
+line = (b'gcc -c -O2 -Wall -o build/foo.o src/foo.c # ' + b'x' * 64 + b'\\n') * 1024
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+for i in range(%d // len(line)):
+    out.write(line)
+'''
+
+
+def benchmark(megabytes, batch_log_lines=False):
+    logger = logging.getLogger('aasemble.utils.benchmark')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    with open(os.devnull, 'wb') as devnull:
+        start = time.time()
+        run_cmd([sys.executable, '-c', GENERATOR % (megabytes * 1024 * 1024,)],
+                stdout=devnull, logger=logger, batch_log_lines=batch_log_lines)
+        return time.time() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark run_cmd output capture')
+    parser.add_argument('--megabytes', type=int, default=500, help='Amount of output to generate')
+    parser.add_argument('--batch-log-lines', action='store_true', help='Log all lines from each read as one record')
+    args = parser.parse_args(argv)
+
+    elapsed = benchmark(args.megabytes, batch_log_lines=args.batch_log_lines)
+    print('%d MB in %.2fs (%.1f MB/s)' % (args.megabytes, elapsed, args.megabytes / elapsed))
+
+
+if __name__ == '__main__':
+    main()
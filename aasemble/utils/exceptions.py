@@ -4,3 +4,7 @@ class CommandFailed(Exception):
         self.returncode = returncode
         self.stdout = stdout
         super(CommandFailed, self).__init__(msg)
+
+
+class CommandTimedOut(CommandFailed):
+    pass
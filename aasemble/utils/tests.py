@@ -2,13 +2,15 @@ import os
 import os.path
 import shutil
 import tempfile
-from unittest import TestCase
+import time
+from unittest import TestCase, skipIf
 
 import mock
 
 from six import assertRaisesRegex
 
-from aasemble.utils import (TemporaryDirectory,
+from aasemble.utils import (LineLogger,
+                            TemporaryDirectory,
                             ensure_dir,
                             escape_cmd_for_ssh,
                             retry_for_duration_wrapper,
@@ -17,7 +19,13 @@ from aasemble.utils import (TemporaryDirectory,
                             ssh_get,
                             ssh_run_cmd)
 
-from aasemble.utils.exceptions import CommandFailed
+from aasemble.utils.exceptions import CommandFailed, CommandTimedOut
+
+try:
+    import asyncio
+    from aasemble.utils import aio
+except ImportError:
+    aio = None
 
 stdout_stderr_script = '''#!/bin/sh
 
@@ -84,6 +92,45 @@ class UtilsTestCase(TestCase):
         self.assertEquals(stdout, b'foo')
         logger.log.assert_called_with(20, 'foo')
 
+    def test_run_cmd_with_large_input(self):
+        # Much more than fits in a pipe buffer
+        data = b''.join([('line %d\n' % (i,)).encode('utf-8') for i in range(100000)])
+        self.assertEquals(run_cmd(['cat'], input=data), data)
+
+    def test_run_cmd_input_not_read(self):
+        self.assertEquals(run_cmd(['true'], input=b'x' * 1024 * 1024), b'')
+
+    def test_run_cmd_logs_each_line(self):
+        logger = mock.MagicMock()
+        stdout = run_cmd(['seq', '1', '100000'], logger=logger)
+        self.assertEquals(stdout.count(b'\n'), 100000)
+        self.assertEquals([c[0] for c in logger.log.call_args_list],
+                          [(20, str(i)) for i in range(1, 100001)])
+
+    def test_run_cmd_batch_log_lines(self):
+        logger = mock.MagicMock()
+        run_cmd(['bash', '-c', 'echo foo; echo bar; echo -n baz'], logger=logger, batch_log_lines=True)
+        self.assertEquals(''.join([c[0][1] + '\n' for c in logger.log.call_args_list]), 'foo\nbar\nbaz\n')
+
+    def test_line_logger_split_across_chunks(self):
+        logger = mock.MagicMock()
+        line_logger = LineLogger(logger)
+        for chunk in [b'fo', b'o\nb', b'ar\n\nba', b'z']:
+            line_logger.feed(chunk)
+        line_logger.flush()
+        line_logger.flush()
+        self.assertEquals(logger.log.call_args_list,
+                          [mock.call(20, 'foo'), mock.call(20, 'bar'), mock.call(20, ''), mock.call(20, 'baz')])
+
+    def test_line_logger_batch(self):
+        logger = mock.MagicMock()
+        line_logger = LineLogger(logger, batch=True)
+        line_logger.feed(b'foo\nbar\nba')
+        line_logger.feed(b'z')
+        line_logger.flush()
+        self.assertEquals(logger.log.call_args_list,
+                          [mock.call(20, 'foo\nbar'), mock.call(20, 'baz')])
+
     def test_run_cmd_fail_raises_exception_and_includes_stderr(self):
         assertRaisesRegex(self, CommandFailed, 'STDERR', run_cmd, ['bash', '-c', 'echo STDOUT; echo STDERR >&2; false'])
 
@@ -197,3 +244,65 @@ class UtilsTestCase(TestCase):
             with open(fpath, 'w') as fp:
                 fp.write('foo')
         self.assertFalse(os.path.exists(tmpdir))
+
+
+@skipIf(aio is None, 'asyncio not available')
+class AsyncRunCmdTestCase(TestCase):
+    def test_run_cmds(self):
+        self.assertEquals(aio.run_cmds([['echo', 'foo'], ['echo', 'bar']]),
+                          [b'foo\n', b'bar\n'])
+
+    def test_run_cmds_with_input(self):
+        data = b'x' * 1024 * 1024
+        self.assertEquals(aio.run_cmds([['cat']], input=data), [data])
+
+    def test_run_cmds_override_env(self):
+        os.environ['TESTVAR'] = 'foo'
+        self.addCleanup(os.environ.pop, 'TESTVAR')
+        self.assertEquals(aio.run_cmds([['env']], override_env={'TESTVAR': 'bar'})[0].count(b'TESTVAR=bar'), 1)
+
+    def test_run_cmds_discard_stderr(self):
+        self.assertEquals(aio.run_cmds([['sh', '-c', 'echo out; echo err >&2']], discard_stderr=True),
+                          [b'out\n'])
+
+    def test_run_cmds_logs_each_line(self):
+        logger = mock.MagicMock()
+        aio.run_cmds([['printf', 'foo\nbar']], logger=logger)
+        logger.log.assert_any_call(20, 'foo')
+        logger.log.assert_any_call(20, 'bar')
+
+    def test_run_cmds_failure(self):
+        ok, failed = aio.run_cmds([['true'], ['sh', '-c', 'echo oops; exit 3']])
+        self.assertEquals(ok, b'')
+        self.assertIsInstance(failed, CommandFailed)
+        self.assertEquals(failed.returncode, 3)
+        self.assertEquals(failed.stdout, b'oops\n')
+
+    def test_run_cmds_concurrently(self):
+        start = time.time()
+        aio.run_cmds([['sleep', '1']] * 5)
+        self.assertLess(time.time() - start, 4)
+
+    def test_run_cmds_bounded_concurrency(self):
+        start = time.time()
+        results = aio.run_cmds([['sh', '-c', 'sleep 0.3; echo %d' % (i,)] for i in range(4)], concurrency=2)
+        self.assertGreaterEqual(time.time() - start, 0.6)
+        self.assertEquals(results, [b'0\n', b'1\n', b'2\n', b'3\n'])
+
+    def test_run_cmds_timeout(self):
+        start = time.time()
+        ok, timed_out = aio.run_cmds([['true'], ['sleep', '10']], timeout=0.5)
+        self.assertLess(time.time() - start, 5)
+        self.assertEquals(ok, b'')
+        self.assertIsInstance(timed_out, CommandTimedOut)
+
+    def test_run_cmd_async_cancel(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        stdout = mock.MagicMock()
+        future = aio.run_cmd_async(['sh', '-c', 'sleep 0.5; echo done'], loop=loop, stdout=stdout)
+        loop.call_later(0.1, future.cancel)
+        self.assertRaises(asyncio.CancelledError, loop.run_until_complete, future)
+        # Give it enough time to finish if it was not killed
+        loop.run_until_complete(asyncio.sleep(1))
+        self.assertFalse(stdout.write.called)
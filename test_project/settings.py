@@ -145,6 +145,14 @@ CELERYBEAT_SCHEDULE = {
         'task': 'aasemble.django.apps.buildsvc.tasks.poll_all',
         'schedule': timedelta(seconds=10),
     },
+    'prune-build-logs-daily': {
+        'task': 'aasemble.django.apps.buildsvc.tasks.prune_build_logs',
+        'schedule': timedelta(days=1),
+    },
+    'maintain-build-node-pool': {
+        'task': 'aasemble.django.apps.buildsvc.tasks.maintain_build_node_pool',
+        'schedule': timedelta(minutes=1),
+    },
 }
 
 CELERY_TIMEZONE = TIME_ZONE